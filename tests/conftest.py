@@ -0,0 +1,26 @@
+""" Userman: Test fixtures. """
+
+import copy
+import uuid
+
+import pytest
+
+from userman import settings
+from userman import utils
+
+
+@pytest.fixture(autouse=True)
+def restore_settings():
+    "Restore the global settings after each test."
+    saved = copy.deepcopy(settings)
+    yield
+    settings.clear()
+    settings.update(saved)
+
+
+@pytest.fixture
+def db():
+    "Return a new, empty in-memory database, used by all handles."
+    settings['DB_BACKEND'] = 'memory'
+    settings['DB_DATABASE'] = "test_{0}".format(uuid.uuid4().hex)
+    return utils.get_db()
@@ -0,0 +1,224 @@
+""" Userman: Tests of the API, using the in-memory database. """
+
+import json
+import urllib.parse
+
+import pytest
+import tornado.testing
+import tornado.web
+
+from userman import constants
+from userman import settings
+from userman import utils
+from userman.user import UserSaver
+from userman.service import ServiceSaver
+
+
+class ApiTestCase(tornado.testing.AsyncHTTPTestCase):
+    """The service 'svc', the admin 'admin@example.com', and the users
+    'u1@example.com' and 'u2@example.com' having the service enabled."""
+
+    cookie_secret = '0123456789abcdef'
+
+    @pytest.fixture(autouse=True)
+    def set_db(self, db):
+        "Settings are restored by the fixture 'restore_settings'."
+        settings['API_TOKENS'] = ['token']
+        self.db = db
+
+    def setUp(self):
+        self.create_service('svc')
+        self.create_user('admin', role=constants.ADMIN)
+        for name in ['u1', 'u2']:
+            self.create_user(name, services=['svc'])
+        super(ApiTestCase, self).setUp()
+
+    def get_app(self):
+        from userman.app_userman import handlers
+        return tornado.web.Application(handlers=handlers,
+                                       cookie_secret=self.cookie_secret)
+
+    def create_service(self, name):
+        with ServiceSaver(db=self.db) as saver:
+            saver['name'] = name
+            saver['href'] = 'http://localhost/'
+            saver['status'] = 'active'
+            saver['public'] = True
+        return saver.doc
+
+    def create_user(self, name, role=constants.USER, services=[],
+                    status=constants.ACTIVE):
+        with UserSaver(db=self.db) as saver:
+            saver['email'] = "{0}@example.com".format(name)
+            saver['role'] = role
+            saver['status'] = status
+            saver['teams'] = []
+            saver['services'] = list(services)
+        return saver.doc
+
+    def fetch_json(self, path, user=None, code=200, **kwargs):
+        """Fetch the path using the API token, or logged in as the user,
+        check the response code, and return the JSON data, if any,
+        otherwise the response."""
+        headers = kwargs.pop('headers', dict())
+        if user is None:
+            headers.setdefault('X-Userman-API-token', 'token')
+        else:
+            cookie = tornado.web.create_signed_value(
+                self.cookie_secret, constants.USER_COOKIE_NAME,
+                "{0}@example.com".format(user))
+            headers['Cookie'] = "{0}={1}".format(constants.USER_COOKIE_NAME,
+                                                 cookie.decode('utf-8'))
+        response = self.fetch(path, headers=headers, **kwargs)
+        self.assertEqual(response.code, code, response.reason)
+        content_type = response.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(response.body)
+        return response
+
+
+class TestApiServiceUsers(ApiTestCase):
+    "The incremental feed of the users of a service."
+
+    def get_users(self, since=None):
+        path = '/api/v1/service/svc/users'
+        if since:
+            path += "?since={0}".format(since)
+        return self.fetch_json(path)
+
+    def test_deleted_user_removed(self):
+        data = self.get_users()
+        self.assertEqual(sorted([u['email'] for u in data['users']]),
+                         ['u1@example.com', 'u2@example.com'])
+        user = utils.get_user_doc(self.db, 'u1@example.com')
+        self.db.delete(user)
+        data = self.get_users(since=data['seq'])
+        self.assertEqual(data['added'], [])
+        self.assertEqual([u['iuid'] for u in data['removed']], [user['_id']])
+        data = self.get_users(since=data['seq'])
+        self.assertEqual(data['added'], [])
+        self.assertEqual(data['removed'], [])
+
+    def test_removed_only_if_granted(self):
+        seq = self.get_users()['seq']
+        pending = self.create_user('u3', services=['svc'],
+                                   status=constants.PENDING)
+        with UserSaver(doc=pending, db=self.db) as saver:
+            saver['status'] = constants.BLOCKED
+        other = self.create_user('u4', services=['other'])
+        with UserSaver(doc=other, db=self.db) as saver:
+            saver['status'] = constants.BLOCKED
+        user = utils.get_user_doc(self.db, 'u1@example.com')
+        with UserSaver(doc=user, db=self.db) as saver:
+            saver['services'] = []
+        data = self.get_users(since=seq)
+        self.assertEqual(data['added'], [])
+        self.assertEqual(data['removed'], [dict(iuid=user['_id'],
+                                                email='u1@example.com',
+                                                status=constants.ACTIVE)])
+
+    def test_log_tombstones_dropped(self):
+        seq = self.get_users()['seq']
+        logs = [r['doc'] for r in self.db.view('log/doc', include_docs=True)]
+        self.assertTrue(logs)
+        self.db.bulk_save([{'_id': log['_id'], '_rev': log['_rev'],
+                            '_deleted': True,
+                            constants.DB_DOCTYPE: constants.LOG}
+                           for log in logs])
+        data = self.get_users(since=seq)
+        self.assertEqual(data['added'], [])
+        self.assertEqual(data['removed'], [])
+
+
+class TestApiMetrics(ApiTestCase):
+    "Access to the metrics."
+
+    def test_access(self):
+        response = self.fetch_json('/metrics')
+        self.assertIn(b'userman_users{status="active"} 3', response.body)
+        self.fetch_json('/metrics', user='admin')
+        self.fetch_json('/metrics', user='u1', code=403)
+        self.fetch_json('/metrics', headers={'X-Userman-API-token': 'bad'},
+                        user=None, code=401)
+
+
+class TestApiRevocations(ApiTestCase):
+    "The revocations of accounts, for the signed identity assertions."
+
+    def get_revocations(self, **params):
+        path = '/api/v1/revocations'
+        if params:
+            path += '?' + urllib.parse.urlencode(params)
+        return self.fetch_json(path)
+
+    def save_user(self, name, status, revoke=False):
+        user = utils.get_user_doc(self.db, "{0}@example.com".format(name))
+        with UserSaver(doc=user, db=self.db) as saver:
+            saver['status'] = status
+            if revoke:
+                saver.revoke()
+
+    def test_revocations(self):
+        settings['ASSERTION_SECRET'] = 'secret'
+        self.save_user('u1', constants.BLOCKED, revoke=True)
+        self.create_user('u3')
+        self.save_user('u3', constants.APPROVED)
+        self.save_user('u2', constants.APPROVED, revoke=True)
+        data = self.get_revocations()
+        self.assertEqual(sorted(data['revocations']),
+                         ['u1@example.com', 'u2@example.com'])
+        self.assertIsNone(data['cursor'])
+        rseq = data['rseq']
+        self.assertEqual(rseq, data['revocations']['u2@example.com'])
+        # Paged; the same 'since' is used while following the cursor.
+        first = self.get_revocations(limit=1)
+        self.assertEqual(len(first['revocations']), 1)
+        data = self.get_revocations(limit=1, cursor=first['cursor'])
+        self.assertEqual(sorted(list(first['revocations']) +
+                                list(data['revocations'])),
+                         ['u1@example.com', 'u2@example.com'])
+        self.assertIsNone(data['cursor'])
+        self.assertEqual(data['rseq'], rseq)
+        # Revocations within the overlap before 'since' are returned again.
+        data = self.get_revocations(since=rseq)
+        self.assertEqual(len(data['revocations']), 2)
+        self.assertEqual(data['rseq'], rseq)
+        settings['ASSERTION_OVERLAP'] = 0
+        data = self.get_revocations(since=utils.timestamp(days=1))
+        self.assertEqual(data['revocations'], {})
+        self.fetch_json('/api/v1/revocations?since=x', code=400)
+
+
+class TestApiLogs(ApiTestCase):
+    "Access to the log entries."
+
+    def get_docs(self, user=None, code=200, **params):
+        path = '/api/v1/logs'
+        if params:
+            path += '?' + urllib.parse.urlencode(params)
+        data = self.fetch_json(path, user=user, code=code)
+        if code == 200:
+            return set([log['doc'] for log in data['logs']])
+
+    def test_scope(self):
+        ids = dict([(r['key'], r['id'])
+                    for r in self.db.view('user/email')])
+        service = self.db.view('service/name', key='svc')[0]['id']
+        self.assertEqual(self.get_docs(user='admin'),
+                         set(list(ids.values()) + [service]))
+        self.get_docs(code=400)
+        self.get_docs(service='nosuch', code=404)
+        self.assertEqual(self.get_docs(service='svc'),
+                         set([ids['u1@example.com'], ids['u2@example.com'],
+                              service]))
+        self.get_docs(user='u1', code=403)
+
+
+class TestApiUsersSearch(ApiTestCase):
+    "Access to the user search."
+
+    def test_access(self):
+        self.fetch_json('/api/v1/users/search?q=u', user='u1', code=403)
+        # The search requires the mirror, which is not running here.
+        self.fetch_json('/api/v1/users/search?q=u', code=404)
+        self.fetch_json('/api/v1/users/search?q=u', user='admin', code=404)
@@ -0,0 +1,49 @@
+""" Userman: Tests of the coroutine interface to the database. """
+
+import asyncio
+
+from userman import asyncdb
+
+
+class SlowDatabase(asyncdb.AsyncDatabase):
+    "Record the reads made; each takes a while, so that they overlap."
+
+    def __init__(self):
+        self.reads = []
+
+    async def __getitem__(self, doc_id):
+        self.reads.append(('get', doc_id))
+        await asyncio.sleep(0.05)
+        return {'_id': doc_id}
+
+    async def view(self, viewname, **options):
+        self.reads.append(('view', viewname))
+        await asyncio.sleep(0.05)
+        return []
+
+    async def save(self, document):
+        return document
+
+
+def test_single_flight_forget():
+    adb = SlowDatabase()
+    sfdb = asyncdb.SingleFlightDatabaseWrapper(adb, 'test')
+
+    async def run():
+        first = [asyncio.ensure_future(read)
+                 for read in [sfdb['u1'], sfdb['u2'], sfdb.view('user/email')]]
+        await asyncio.sleep(0.01)
+        await sfdb.save({'_id': 'u1'})
+        second = [sfdb['u1'], sfdb['u2'], sfdb.view('user/email')]
+        return await asyncio.gather(*(first + second))
+
+    counters = asyncdb.get_flight_counters()
+    results = asyncio.run(run())
+    assert results[1] == results[4] == {'_id': 'u2'}
+    # The read of 'u2' was kept; those of 'u1' and the view were forgotten.
+    assert sorted(adb.reads) == [('get', 'u1'), ('get', 'u1'), ('get', 'u2'),
+                                 ('view', 'user/email'),
+                                 ('view', 'user/email')]
+    after = asyncdb.get_flight_counters()
+    assert after['calls'] - counters['calls'] == 5
+    assert after['merged'] - counters['merged'] == 1
@@ -0,0 +1,125 @@
+""" Userman: Tests of the background mailer, using a local SMTP server. """
+
+import os
+import socketserver
+import threading
+import time
+
+import pytest
+
+from userman import settings
+from userman import mailer
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP session. The reply to the end of the data is taken
+    from the server's 'failures' for the first recipient, if any left."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 localhost')
+        recipients = []
+        while True:
+            line = self.rfile.readline().decode('ascii').strip()
+            command = line[:4].upper()
+            if not line or command == 'QUIT':
+                self.reply('221 bye')
+                return
+            elif command in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif command == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                recipients.append(line.split(':', 1)[1].strip('<> '))
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 go ahead')
+                while self.rfile.readline().rstrip(b'\r\n') != b'.':
+                    pass
+                with server.lock:
+                    server.attempts.append((recipients[0], time.time()))
+                    failures = server.failures.get(recipients[0])
+                    code = failures.pop(0) if failures else None
+                    if code is None:
+                        server.received.extend(recipients)
+                self.reply("{0} failed".format(code) if code else '250 OK')
+            else:
+                self.reply('250 OK')
+
+
+class SmtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    block_on_close = False
+    allow_reuse_address = True
+
+    def __init__(self):
+        super(SmtpServer, self).__init__(('127.0.0.1', 0), SmtpHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.received = []      # Recipients of the messages received.
+        self.attempts = []      # (first recipient, time) of each message.
+        self.failures = dict()  # Recipient -> list of reply codes to give.
+
+
+@pytest.fixture
+def smtp():
+    server = SmtpServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    settings['EMAIL'] = dict(HOST='127.0.0.1', PORT=server.server_address[1])
+    settings['EMAIL_TIMEOUT'] = 5.0
+    settings['EMAIL_RETRY_DELAY'] = 0.05
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def wait_for(condition, timeout=5.0):
+    "Wait until the condition is true; fail if it is not within the timeout."
+    start = time.time()
+    while not condition():
+        assert time.time() - start < timeout, 'timed out'
+        time.sleep(0.01)
+
+
+def test_persistent_session_and_spool(smtp, tmp_path):
+    spool = str(tmp_path)
+    # An undelivered message spooled by a previous process.
+    mailer.Mailer(spool=spool).enqueue('a@x.org', ['old@x.org'], 'Subject: old')
+    instance = mailer.Mailer(spool=spool)
+    instance.start()
+    for number in range(5):
+        instance.enqueue('a@x.org', ["u{0}@x.org".format(number)], 'Subject: t')
+    wait_for(lambda: instance.get_counters()['sent'] == 6)
+    assert sorted(smtp.received) == ['old@x.org'] + \
+        ["u{0}@x.org".format(number) for number in range(5)]
+    assert smtp.connections == 1
+    assert instance.get_counters()['connections'] == 1
+    assert os.listdir(spool) == ['failed']
+
+
+def test_retry_backoff_and_failure(smtp, tmp_path):
+    spool = str(tmp_path)
+    smtp.failures['retry@x.org'] = ['451', '451']
+    smtp.failures['bad@x.org'] = ['550']
+    instance = mailer.Mailer(spool=spool)
+    instance.start()
+    instance.enqueue('a@x.org', ['retry@x.org'], 'Subject: retry')
+    iuid = instance.enqueue('a@x.org', ['bad@x.org'], 'Subject: bad')
+    wait_for(lambda: instance.get_counters()['sent'] == 1)
+    counters = instance.get_counters()
+    assert counters['retried'] == 2
+    assert counters['failed'] == 1
+    assert counters['queue_depth'] == 0
+    assert smtp.received == ['retry@x.org']
+    times = [t for recipient, t in smtp.attempts if recipient == 'retry@x.org']
+    assert len(times) == 3
+    assert times[1] - times[0] >= 0.05
+    assert times[2] - times[1] >= 0.1
+    assert os.listdir(spool) == ['failed']
+    assert os.listdir(os.path.join(spool, 'failed')) == [iuid + '.json']
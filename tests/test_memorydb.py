@@ -0,0 +1,205 @@
+""" Userman: Tests of the in-memory database. """
+
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+import ibm_cloud_sdk_core
+import pytest
+
+from userman import constants
+from userman import memorydb
+
+
+DESIGNS = os.path.join(os.path.dirname(memorydb.__file__), 'designs')
+
+# Documents covering the branches of the map functions of all views.
+DOCS = [
+    dict(_id='u1', userman_doctype='user', email='Bob@example.com',
+         username='bob', role='admin', status='active',
+         modified='2020-01-02T00:00:00Z', teams=['t1', 't2'],
+         services=['s1', 's2']),
+    dict(_id='u2', userman_doctype='user', email='alice@example.com',
+         role='user', status='pending', modified='2020-01-03T00:00:00Z',
+         teams=[], services=['s1']),
+    dict(_id='u3', userman_doctype='user', email='carl@example.com',
+         username='carl', role='user', status='blocked',
+         modified='2020-01-01T00:00:00Z', teams=['t1'], services=['s1']),
+    dict(_id='u4', userman_doctype='user', email='dora@example.com',
+         role='user', status='approved', modified='2020-01-04T00:00:00Z',
+         revoked='2020-01-04T00:00:00Z', teams=['t2'], services=[]),
+    dict(_id='u5', userman_doctype='user', email='eve@example.com',
+         role='user', modified='2020-01-05T00:00:00Z'),
+    dict(_id='s1', userman_doctype='service', name='s1', public=True),
+    dict(_id='s2', userman_doctype='service', name='s2', public=False),
+    dict(_id='t1', userman_doctype='team', name='t1',
+         leaders=['Bob@example.com', 'carl@example.com']),
+    dict(_id='t2', userman_doctype='team', name='t2'),
+    dict(_id='l1', userman_doctype='log', doc='u1', doctype='user',
+         operator='Bob@example.com', timestamp='2020-01-02T00:00:00Z'),
+    dict(_id='l2', userman_doctype='log', doc='t1', doctype='team',
+         timestamp='2020-01-01T00:00:00Z'),
+    dict(_id='x1', userman_doctype='other', name='x', email='x@example.com'),
+    ]
+
+NODE_SCRIPT = """
+const fs = require('fs');
+const input = JSON.parse(fs.readFileSync(0, 'utf8'));
+const result = {};
+for (const [name, code] of Object.entries(input.views)) {
+    const rows = [];
+    let emit = function(key, value) {
+        rows.push([key === undefined ? null : key,
+                   value === undefined ? null : value]);
+    };
+    const map = eval('(' + code + ')');
+    for (const doc of input.docs) {
+        const start = rows.length;
+        map(doc);
+        for (let i = start; i < rows.length; i++) rows[i].unshift(doc._id);
+    }
+    result[name] = rows;
+}
+process.stdout.write(JSON.stringify(result));
+"""
+
+def get_js_views():
+    "Return the JavaScript code of the map functions, by view name."
+    result = dict()
+    for design in os.listdir(DESIGNS):
+        path = os.path.join(DESIGNS, design, 'views')
+        for filename in os.listdir(path):
+            name, ext = os.path.splitext(filename)
+            if ext != '.js' or name.startswith('reduce_'): continue
+            if name.startswith('map_'):
+                name = name[len('map_'):]
+            with open(os.path.join(path, filename)) as codefile:
+                result["{0}/{1}".format(design, name)] = codefile.read()
+    return result
+
+
+def test_check_views():
+    assert memorydb.check_views() == []
+
+
+@pytest.mark.skipif(not shutil.which('node'), reason='node not installed')
+def test_views_equivalent():
+    "Each Python map function emits the same rows as its JavaScript."
+    views = get_js_views()
+    process = subprocess.run(['node', '-e', NODE_SCRIPT],
+                             input=json.dumps(dict(views=views, docs=DOCS)),
+                             capture_output=True, text=True, check=True)
+    expected = json.loads(process.stdout)
+    assert sorted(expected) == sorted(memorydb.VIEWS)
+    for viewname, (map_func, fingerprint, reduce_func) in memorydb.VIEWS.items():
+        rows = [[doc['_id'], key, value]
+                for doc in DOCS for key, value in map_func(doc)]
+        assert rows == expected[viewname], viewname
+
+
+def test_collation():
+    values = [None, False, True, -1, 2.5, 10, 'a', 'A', 'aa', 'B', 'b2',
+              [], ['a'], ['a', None], ['a', 1], ['b'], {}]
+    shuffled = values[::2] + values[1::2]
+    assert sorted(shuffled, key=memorydb.get_collation_key) == values
+
+
+@pytest.fixture
+def mdb():
+    result = memorydb.MemoryDatabase('test')
+    for doc in DOCS:
+        result.save(dict(doc))
+    return result
+
+def test_view_range(mdb):
+    rows = mdb.view('user/email')
+    assert [r['key'] for r in rows] == ['alice@example.com', 'Bob@example.com',
+                                        'carl@example.com', 'dora@example.com',
+                                        'eve@example.com']
+    rows = mdb.view('user/email', start_key='b', end_key='d',
+                    inclusive_end=False)
+    assert [r['id'] for r in rows] == ['u1', 'u3']
+    rows = mdb.view('user/email', descending=True, skip=1, limit=2)
+    assert [r['id'] for r in rows] == ['u4', 'u3']
+    rows = mdb.view('user/email', keys=['eve@example.com', 'nobody', 'alice@example.com'],
+                    include_docs=True)
+    assert [r['doc']['_id'] for r in rows] == ['u5', 'u2']
+    rows = mdb.view('user/team_email', start_key=['t1', ''], end_key=['t1', {}])
+    assert [r['id'] for r in rows] == ['u1', 'u3']
+
+def test_start_key_doc_id(mdb):
+    for number in range(5):
+        mdb.save(dict(_id="log{0}".format(number), userman_doctype='log',
+                      doc='d', timestamp='2021'))
+    rows = mdb.view('log/doc_timestamp', start_key=['d', '2021'],
+                    start_key_doc_id='log2', end_key=['d', {}])
+    assert [r['id'] for r in rows] == ['log2', 'log3', 'log4']
+    rows = mdb.view('log/doc_timestamp', start_key=['d', '2021'],
+                    start_key_doc_id='log2', end_key=['d'], descending=True)
+    assert [r['id'] for r in rows] == ['log2', 'log1', 'log0']
+
+def test_count_reduce(mdb):
+    assert mdb.view('user/count') == [dict(key=None, value=4)]
+    assert mdb.view('user/count', key='active') == [dict(key=None, value=1)]
+    assert mdb.view('user/count', group=True) == [
+        dict(key='active', value=1), dict(key='approved', value=1),
+        dict(key='blocked', value=1), dict(key='pending', value=1)]
+    assert len(mdb.view('user/count', reduce=False)) == 4
+    assert mdb.view('user/count', key='nosuch') == []
+
+def test_conflicts(mdb):
+    doc = mdb['u1']
+    rev = doc['_rev']
+    doc['name'] = 'Bob'
+    mdb.save(doc)
+    assert doc['_rev'] != rev and doc['_rev'].startswith('2-')
+    with pytest.raises(ibm_cloud_sdk_core.ApiException) as error:
+        mdb.save(dict(_id='u1', _rev=rev, userman_doctype='user'))
+    assert error.value.status_code == 409
+    with pytest.raises(ibm_cloud_sdk_core.ApiException) as error:
+        mdb.save(dict(_id='u2', userman_doctype='user'))
+    assert error.value.status_code == 409
+    results = mdb.bulk_save([dict(_id='u1', _rev=rev), dict(_id='new')])
+    assert results[0]['error'] == 'conflict' and 'rev' in results[1]
+
+def test_delete(mdb):
+    mdb.delete(mdb['u1'])
+    with pytest.raises(ibm_cloud_sdk_core.ApiException) as error:
+        mdb['u1']
+    assert error.value.status_code == 404
+    assert mdb.view('user/email', key='Bob@example.com') == []
+    mdb.save(dict(_id='u1', userman_doctype='user', email='new@example.com'))
+    assert mdb.view('user/email', key='new@example.com')[0]['id'] == 'u1'
+
+def test_changes_selector(mdb):
+    seq = mdb.info()['update_seq']
+    mdb.save(dict(mdb['u2'], name='Alice'))
+    mdb.save(dict(mdb['t1'], description='d'))
+    mdb.delete(mdb['u3'])
+    selector = {'$or': [{constants.DB_DOCTYPE: constants.USER},
+                        {'_deleted': True}]}
+    result = mdb.changes(since=seq, filter='_selector', selector=selector,
+                         include_docs=True)
+    assert [(c['id'], c.get('deleted', False)) for c in result['results']] == \
+        [('u2', False), ('u3', True)]
+    result = mdb.changes(since=seq, limit=1)
+    assert result['pending'] == 2 and result['results'][0]['id'] == 'u2'
+    result = mdb.changes(since=result['last_seq'])
+    assert [c['id'] for c in result['results']] == ['t1', 'u3']
+
+def test_changes_longpoll(mdb):
+    seq = mdb.info()['update_seq']
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        mdb.changes(since=seq, feed='longpoll', timeout=5000)))
+    thread.start()
+    time.sleep(0.05)
+    mdb.save(dict(_id='new', userman_doctype='team', name='new'))
+    thread.join()
+    assert [c['id'] for c in results[0]['results']] == ['new']
+    start = time.time()
+    result = mdb.changes(since='now', feed='longpoll', timeout=100)
+    assert result['results'] == [] and time.time() - start >= 0.09
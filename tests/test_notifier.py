@@ -0,0 +1,152 @@
+""" Userman: Tests of the push notifications, using a local HTTP stub. """
+
+import hashlib
+import hmac
+import http.server
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from userman import constants
+from userman import settings
+from userman import notifier
+from userman.service import ServiceSaver
+from userman.user import UserSaver
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    "Record the POSTed body and signature; fail while 'failures' remain."
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with server.lock:
+            if server.failures:
+                server.failures -= 1
+                code = 500
+            else:
+                server.requests.append(
+                    (body, self.headers['X-Userman-Signature']))
+                code = 200
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.failures = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    settings['NOTIFY_SECRET'] = 'secret'
+    settings['NOTIFY_DELAY'] = 0.2
+    settings['NOTIFY_BATCH'] = 2
+    settings['NOTIFY_RETRY_DELAY'] = 0.05
+    settings['NOTIFY_FEED_TIMEOUT'] = 1.0
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_changes(stub):
+    "Return the items received by the stub, checking the signatures."
+    result = []
+    with stub.lock:
+        requests = list(stub.requests)
+    for body, signature in requests:
+        expected = hmac.new(b'secret', body, hashlib.sha256).hexdigest()
+        assert hmac.compare_digest(signature, expected)
+        result.append(json.loads(body)['changes'])
+    return result
+
+def wait_for(condition, timeout=5.0):
+    "Wait until the condition is true; fail if it is not within the timeout."
+    start = time.time()
+    while not condition():
+        assert time.time() - start < timeout, 'timed out'
+        time.sleep(0.01)
+
+def create_service(db, stub):
+    with ServiceSaver(db=db) as saver:
+        saver['name'] = 'svc'
+        saver['status'] = constants.ACTIVE
+        saver['notify_href'] = "http://127.0.0.1:{0}/".format(
+            stub.server_address[1])
+
+def save_user(db, name, doc=None, **fields):
+    with UserSaver(doc=doc, db=db) as saver:
+        if doc is None:
+            saver['email'] = "{0}@example.com".format(name)
+            saver['role'] = constants.USER
+            saver['status'] = constants.ACTIVE
+        for key, value in fields.items():
+            saver[key] = value
+    return saver.doc
+
+
+def test_coalesce_batch_and_delete(db, stub):
+    create_service(db, stub)
+    instance = notifier.Notifier(db)
+    instance.start()
+    users = [save_user(db, name, services=['svc'])
+             for name in ['u1', 'u2', 'u3']]
+    # The feed gives only the latest revision; coalescing is of changes
+    # read from the feed in different polls.
+    wait_for(lambda: instance.get_counters()['changes'] == 3)
+    save_user(db, 'u1', doc=users[0], university='Changed')
+    wait_for(lambda: instance.get_counters()['sent'] == 3)
+    counters = instance.get_counters()
+    assert counters['coalesced'] == 1
+    assert counters['batches'] == 2
+    changes = get_changes(stub)
+    assert [len(c) for c in changes] == [2, 1]
+    items = dict([(i['iuid'], i) for c in changes for i in c])
+    assert items[users[0]['_id']]['email'] == 'u1@example.com'
+    assert len(items) == 3
+    db.delete(db[users[1]['_id']])
+    wait_for(lambda: instance.get_counters()['sent'] == 4)
+    assert get_changes(stub)[-1] == [dict(doctype=constants.USER,
+                                          iuid=users[1]['_id'],
+                                          deleted=True)]
+
+
+def test_retry(db, stub):
+    create_service(db, stub)
+    stub.failures = 2
+    instance = notifier.Notifier(db)
+    instance.start()
+    save_user(db, 'u1', services=['svc'])
+    wait_for(lambda: instance.get_counters()['sent'] == 1)
+    counters = instance.get_counters()
+    assert counters['retried'] == 2
+    assert counters['errors'] == 2
+    assert len(get_changes(stub)) == 1
+
+
+def test_outbox_replay(db, stub, tmp_path):
+    outbox = str(tmp_path)
+    create_service(db, stub)
+    user = save_user(db, 'u1', services=['svc'])
+    # State saved by a previous process, which had not yet seen the
+    # removal of the service from the account.
+    item = dict(doctype=constants.TEAM, iuid='t1', name='t1')
+    with open(os.path.join(outbox, 'outbox.json'), 'w') as outfile:
+        json.dump(dict(seq=db.info()['update_seq'],
+                       outboxes=dict(svc=[item])), outfile)
+    save_user(db, 'u1', doc=user, services=[])
+    instance = notifier.Notifier(db, outbox=outbox)
+    instance.start()
+    wait_for(lambda: instance.get_counters()['sent'] == 2)
+    items = [i for c in get_changes(stub) for i in c]
+    assert items[0] == item
+    assert items[1]['iuid'] == user['_id']
+    with open(os.path.join(outbox, 'outbox.json')) as infile:
+        assert json.load(infile)['outboxes'] == {}
@@ -0,0 +1,34 @@
+""" Userman: Tests of the document savers. """
+
+from userman import constants
+from userman import settings
+from userman import authcache
+from userman.saver import SaveBatch
+from userman.user import UserSaver
+
+
+def create_user(db, name):
+    with UserSaver(db=db) as saver:
+        saver['email'] = "{0}@example.com".format(name)
+        saver['role'] = constants.USER
+        saver['status'] = constants.ACTIVE
+    return saver.doc
+
+
+def test_after_save_invalidates_auth_cache(db):
+    settings['AUTH_CACHE_SIZE'] = 10
+    user = create_user(db, 'u1')
+    authcache.put_user(user)
+    authcache.put_missing('u2@example.com')
+    with UserSaver(doc=user, db=db) as saver:
+        saver['status'] = constants.BLOCKED
+    assert authcache.get_user('u1@example.com') is None
+    authcache.put_user(saver.doc)
+    with SaveBatch(db=db) as batch:
+        with UserSaver(doc=saver.doc, db=db, batch=batch) as saver:
+            saver['status'] = constants.ACTIVE
+        with UserSaver(db=db, batch=batch) as other:
+            other['email'] = 'u2@example.com'
+    assert not batch.errors
+    assert authcache.get_user('u1@example.com') is None
+    assert not authcache.is_missing('u2@example.com')
@@ -0,0 +1,35 @@
+""" Userman: Tests of the utility functions and classes. """
+
+from userman import constants
+from userman import utils
+
+
+def test_document_cache():
+    cache = utils.DocumentCache(2, 10000, 60.0)
+    for doc_id in ['u1', 'u2', 'u3']:
+        cache.put({'_id': doc_id, '_rev': '1-a',
+                   constants.DB_DOCTYPE: constants.USER})
+    assert cache.get('u1') is None
+    assert cache.get('u3')['_rev'] == '1-a'
+    cache.put({'_id': 'l1', '_rev': '1-a',
+               constants.DB_DOCTYPE: constants.LOG})
+    assert cache.get('l1') is None
+    assert cache.get('u2') is not None
+    assert cache.get_counters()['evictions'] == 1
+
+
+def test_lru_cache():
+    cache = utils.LruCache(2, 60.0)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    cache.remove_if(lambda value: value == 3)
+    assert cache.get('c') is None
+    cache.ttl = -1
+    assert cache.get('a') is None
+    counters = cache.get_counters()
+    assert counters['hits'] == 1 and counters['misses'] == 3
+    assert counters['evictions'] == 1 and counters['invalidations'] == 1
+    assert counters['entries'] == 0 and counters['hit_ratio'] == 0.25
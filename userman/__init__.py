@@ -9,11 +9,62 @@ __version__ = '14.8.0'
 # The actual values are read in by utils.load_settings()
 settings = dict(BASE_URL='http://localhost:8880/',
                 DB_SERVER='http://localhost:5984/',
+                DB_BACKEND='couchdb',  # Or 'memory'; in-process, for tests
+                DB_MEMORY_DUMP=None,   # Dump file loaded into 'memory' at start
                 DB_DATABASE='userman',
+                DB_POOL_SIZE=10,       # Max number of kept-alive connections
+                DB_CONNECT_TIMEOUT=60, # Unit: seconds
+                DB_READ_TIMEOUT=150,   # Unit: seconds
+                DB_THREADS=10,         # Threads for blocking database calls
+                DB_ASYNC_DRIVER='executor', # Or 'http'; native async client
+                DB_MAX_CLIENTS=50,     # Max concurrent 'http' driver requests
+                DB_SINGLE_FLIGHT=False, # Merge concurrent identical reads
+                METRICS=True,          # Collect metrics; '/metrics' endpoint
+                DB_TRACE=False,        # Server-Timing header; slow request log
+                DB_TRACE_SLOW=1000,    # Unit: milliseconds; None no log
+                DOC_CACHE_SIZE=0,      # Max number of cached documents; 0 off
+                DOC_CACHE_BYTES=10000000, # Max approximate size of cache
+                DOC_CACHE_TTL=600.0,   # Unit: seconds
+                AUTH_CACHE_SIZE=0,     # Max number of cached API users; 0 off
+                AUTH_NEGATIVE_SIZE=10000, # Max number of cached unknown names
+                AUTH_CACHE_TTL=60.0,   # Unit: seconds
+                MIRROR=False,          # In-memory mirror of users, teams...
+                MIRROR_TIMEOUT=60.0,   # Unit: seconds; changes feed longpoll
+                MIRROR_BATCH=1000,     # Max number of changes per poll
+                EMAIL_SPOOL=None,      # Directory for undelivered email
+                EMAIL_BATCH=20,        # Max number of messages per batch
+                EMAIL_IDLE=30.0,       # Unit: seconds; SMTP session kept open
+                EMAIL_TIMEOUT=30.0,    # Unit: seconds
+                EMAIL_RETRY_DELAY=10.0, # Unit: seconds; doubled each retry
+                EMAIL_MAX_ATTEMPTS=8,
+                ASSERTION_SECRET=None, # Shared with services; None disables
+                ASSERTION_TTL=300,     # Unit: seconds
+                ASSERTION_OVERLAP=60.0, # Unit: seconds; revocations resent
+                NOTIFY=False,          # Push changes to services' notify_href
+                NOTIFY_SECRET=None,    # For signing; required if NOTIFY
+                NOTIFY_OUTBOX=None,    # Directory for undelivered notifications
+                NOTIFY_DELAY=1.0,      # Unit: seconds; coalescing changes
+                NOTIFY_FEED_BATCH=1000, # Max number of changes per poll
+                NOTIFY_FEED_TIMEOUT=60.0, # Unit: seconds; changes feed longpoll
+                NOTIFY_BATCH=100,      # Max number of changes per request
+                NOTIFY_CONCURRENCY=4,  # Max number of concurrent requests
+                NOTIFY_TIMEOUT=10.0,   # Unit: seconds
+                NOTIFY_RETRY_DELAY=5.0, # Unit: seconds; doubled each retry
+                NOTIFY_MAX_DELAY=600.0, # Unit: seconds
+                PAGE_SIZE=100,         # Max number of items in a page of a list
+                LOG_PAGE_SIZE=20,      # Max number of log entries in a page
+                LOG_RETENTION=dict(),  # Unit: days, per doctype; kept if absent
+                LOG_ARCHIVE_DIR=None,  # Directory for archived log entries
+                LOG_ARCHIVE_BATCH=500, # Number of log entries per batch
+                LOG_WRITE_BEHIND=False, # Write log entries in bulk, delayed
+                LOG_FLUSH_INTERVAL=500, # Unit: milliseconds
+                LOG_FLUSH_SIZE=100,    # Max number of log entries per write
+                LOG_JOURNAL=None,      # File for entries if database down
                 TORNADO_DEBUG=True,
                 LOGGING_DEBUG=True,
                 LOGGING_FORMAT='%(levelname)s [%(asctime)s] %(message)s',
                 API_KEYS=[],
+                API_BULK_MAX=1000,     # Max number of users in a bulk request
                 ACTIVATION_EMAIL='messages/activation_email.txt',
                 RESET_EMAIL='messages/reset_email.txt',
                 ACTIVATION_PERIOD=7.0, # Unit: days
@@ -2,26 +2,41 @@
 
 import logging
 import json
+import time
 
 import tornado.web
 import ibm_cloud_sdk_core
 
 from . import settings
+from . import constants
 from . import utils
+from . import asyncdb
+from . import assertion
+from . import mirror
+from . import authcache
+from . import metrics
 from .requesthandler import RequestHandler
+from .log import LogsMixin
 
 
 class ApiRequestHandler(RequestHandler):
-    "Check API token unless logged in."
+    """Check API token unless logged in.
+    If 'admin_only' is set, a logged-in user must be admin."""
 
-    def prepare(self):
-        super(ApiRequestHandler, self).prepare()
+    admin_only = False
+
+    async def prepare(self):
+        await super(ApiRequestHandler, self).prepare()
         self.check_api_token()
 
     def check_api_token(self):
         """Check the API token given in the header.
-        Return HTTP 401 if invalid or missing token."""
-        if self.get_current_user(): return
+        Return HTTP 401 if invalid or missing token.
+        Return HTTP 403 if logged in, not admin, and admin required."""
+        if self.get_current_user():
+            if self.admin_only:
+                self.check_admin()
+            return
         try:
             api_token = self.request.headers['X-Userman-API-token']
         except KeyError:
@@ -35,14 +50,24 @@ class ApiDoc(ApiRequestHandler):
     """Return a document as is.
     Change '_id' to 'iuid'.
     Remove '_rev' and 'password'.
+    The ETag is the revision; return HTTP 304 if it matches If-None-Match.
     """
 
-    def get(self, iuid):
+    async def get(self, iuid):
+        # The revision suffices to check whether the client has it already.
+        if self.request.headers.get('If-None-Match'):
+            try:
+                self.set_etag(await self.get_doc_rev(iuid))
+            except ibm_cloud_sdk_core.api_exception.ApiException:
+                self.send_error(404, reason='no such item')
+                return
+            if self.is_not_modified(): return
         try:
-            doc = self.db[iuid]
+            doc = await self.adb[iuid]
         except ibm_cloud_sdk_core.api_exception.ApiException:
             self.send_error(404, reason='no such item')
         else:
+            self.set_etag(doc['_rev'])
             # Remove sensitive or irrelevant items
             doc['iuid'] = doc.pop('_id')
             del doc['_rev']
@@ -60,8 +85,49 @@ class ApiAuth(ApiRequestHandler):
     Return HTTP 401 if wrong password or service.
     Return HTTP 404 if no such user, or blocked."""
 
-    def post(self, email):
-        user = self.get_user(email, require_active=True)
+    async def post(self, email):
+        try:
+            user, service = self.check_user(await self.get_api_user(email))
+        except tornado.web.HTTPError as error:
+            if settings['METRICS']:
+                metrics.count_auth(self, reason=error.reason)
+            raise
+        if settings['METRICS']:
+            metrics.count_auth(self)
+        self.write(self.get_user_data(user))
+
+    async def get_api_user(self, name):
+        """Get the user document by the account's username or email,
+        using the auth caches for accounts and for nonexistent accounts.
+        Return HTTP 404 if no such user, or blocked."""
+        if authcache.is_missing(name):
+            raise tornado.web.HTTPError(
+                404, reason="no such user account '{0}'".format(name))
+        user = authcache.get_user(name)
+        if user is None:
+            try:
+                user = await self.get_user(name)
+            except tornado.web.HTTPError as error:
+                if error.status_code == 404:
+                    authcache.put_missing(name)
+                raise
+            authcache.put_user(user)
+        if user.get('status') != constants.ACTIVE:
+            raise tornado.web.HTTPError(404, reason='blocked user')
+        return user
+
+    def get_user_data(self, user):
+        "Return the user document without sensitive or irrelevant items."
+        user['iuid'] = user.pop('_id')
+        del user['_rev']
+        user.pop('password', None)
+        del user['services']
+        user.pop('services_granted', None)
+        return user
+
+    def check_user(self, user):
+        """Check the password and service given in the JSON body.
+        Return the user document and the service name."""
         try:
             data = json.loads(self.request.body)
         except Exception as msg:
@@ -74,12 +140,7 @@ class ApiAuth(ApiRequestHandler):
             raise tornado.web.HTTPError(400, reason='no service specified')
         if service not in user['services']:
             raise tornado.web.HTTPError(401, reason='service not enabled')
-        # Remove sensitive or irrelevant items
-        user['iuid'] = user.pop('_id')
-        del user['_rev']
-        del user['password']
-        del user['services']
-        self.write(user)
+        return user, service
 
     def check_password(self, user, data):
         try:
@@ -100,3 +161,286 @@ class ApiUser(ApiAuth):
 
     def check_password(self, user, data):
         pass
+
+
+class ApiUsers(ApiAuth):
+    """Return the user information for several users given by their emails
+    or usernames and the service as JSON data: {"users": [...], "service": ...}.
+    Does not need, nor check, any password.
+    NOTE: Will still check the Userman API token!
+    The users are fetched in one multi-key request, and the information
+    is as for ApiUser. Users not found, blocked, or without the service
+    enabled are listed in 'missing'.
+    Return HTTP 400 if missing parameter, invalid JSON or too many users."""
+
+    async def post(self):
+        try:
+            data = json.loads(self.request.body)
+            names = [str(n) for n in data['users']]
+            service = data['service']
+        except (ValueError, KeyError, TypeError) as msg:
+            logging.debug(str(msg))
+            raise tornado.web.HTTPError(400, reason="invalid JSON, or 'users'"
+                                        " or 'service' missing")
+        if len(names) > settings['API_BULK_MAX']:
+            raise tornado.web.HTTPError(400, reason='too many users')
+        result = []
+        found = set()
+        for user in await self.get_users(names):
+            if user['_id'] in found: continue
+            if user.get('status') != constants.ACTIVE: continue
+            if service not in user['services']: continue
+            found.add(user['_id'])
+            found.add(user['email'])
+            if user.get('username'):
+                found.add(user['username'])
+            result.append(self.get_user_data(dict(user)))
+        self.write(dict(users=result,
+                        missing=[n for n in names if n not in found]))
+
+
+class ApiServiceUsers(ApiAuth):
+    """Return the users authorized for the service as JSON data.
+    Without argument 'since', return all active users having the service
+    enabled, as for ApiUser, and the sequence token 'seq' for the next call.
+    With 'since', return the changes after that sequence token: the users
+    'added' or changed, and those 'removed' (status not active, or service
+    not enabled, or document deleted), and the new 'seq'. If 'pending' is
+    not zero, there are more changes to get. The changes are read from the
+    '_changes' feed, so the cost depends on the number of changes, not of users.
+    Only users having had the service enabled while active are reported
+    as removed. A document deleted without its fields may not have been
+    a user; only its 'iuid' is reported, and callers ignore unknown ones.
+    NOTE: Will still check the Userman API token!
+    Return HTTP 404 if no such service."""
+
+    async def get(self, name):
+        service = await self.get_service(name)
+        since = self.get_argument('since', None)
+        if since:
+            self.write(await self.get_changes(service['name'], since))
+            return
+        seq = (await self.adb.info())['update_seq']
+        view_rows = await self.adb.view('user/service',
+                                        start_key=[service['name'], ''],
+                                        end_key=[service['name'], {}],
+                                        include_docs=True)
+        self.write(dict(users=[self.get_user_data(r['doc']) for r in view_rows],
+                        seq=seq))
+
+    async def get_changes(self, name, since):
+        """Return the changes of user documents after the sequence token.
+        The tombstones written by Userman, such as those of archived log
+        entries, keep their doctype; those without are also included.
+        Documents saved before 'services_granted' was recorded are taken
+        to have been granted the services they have."""
+        result = await self.adb.changes(
+            since=since,
+            filter='_selector',
+            selector={'$or': [{constants.DB_DOCTYPE: constants.USER},
+                              {'_deleted': True,
+                               constants.DB_DOCTYPE: {'$exists': False}}]},
+            include_docs=True,
+            limit=settings['API_BULK_MAX'])
+        added = []
+        removed = []
+        for change in result.get('results', []):
+            doc = change.get('doc') or dict(_id=change['id'])
+            if not change.get('deleted') and \
+               doc.get('status') == constants.ACTIVE and \
+               name in doc.get('services', []):
+                added.append(self.get_user_data(doc))
+            elif constants.DB_DOCTYPE not in doc:
+                removed.append(dict(iuid=doc['_id'], email=None, status=None))
+            elif name in doc.get('services_granted', doc.get('services', [])):
+                removed.append(dict(iuid=doc['_id'],
+                                    email=doc.get('email'),
+                                    status=doc.get('status')))
+        return dict(added=added,
+                    removed=removed,
+                    seq=result['last_seq'],
+                    pending=result.get('pending', 0))
+
+
+class ApiRevocationsMixin(object):
+    "Revocation sequence for the signed identity assertions."
+
+    def check_assertions_enabled(self):
+        if not settings.get('ASSERTION_SECRET'):
+            raise tornado.web.HTTPError(404, reason='assertions not enabled')
+
+    async def get_revocation_seq(self):
+        "Return the current revocation sequence; empty string if none."
+        rows = await self.adb.view('user/revoked', descending=True, limit=1)
+        try:
+            return rows[0]['key']
+        except IndexError:
+            return ''
+
+
+class ApiAssertion(ApiRevocationsMixin, ApiAuth):
+    """Return a signed identity assertion for the user, given the password
+    and service, as JSON data. See the module 'assertion'.
+    Return HTTP 400 if missing parameter or invalid JSON.
+    Return HTTP 401 if wrong password or service.
+    Return HTTP 404 if no such user, or blocked, or assertions not enabled."""
+
+    async def post(self, email):
+        self.check_assertions_enabled()
+        # The revocation sequence must be obtained before the user document:
+        # an account revoked after this point gets a later sequence.
+        # The user document is read from the database, not the mirror,
+        # since the mirror may lag behind the revocation sequence.
+        rseq = await self.get_revocation_seq()
+        try:
+            user = await asyncdb.get_user_doc(self.adb, email)
+        except ValueError as msg:
+            raise tornado.web.HTTPError(404, reason=str(msg))
+        if user.get('status') != constants.ACTIVE:
+            raise tornado.web.HTTPError(404, reason='blocked user')
+        user, service = self.check_user(user)
+        now = int(time.time())
+        payload = dict(email=user['email'],
+                       role=user['role'],
+                       teams=user['teams'],
+                       service=service,
+                       iat=now,
+                       exp=now + settings['ASSERTION_TTL'],
+                       rseq=rseq)
+        self.write(dict(assertion=assertion.create(payload,
+                                                   settings['ASSERTION_SECRET']),
+                        expires=payload['exp'],
+                        rseq=rseq))
+
+
+class ApiRevocations(ApiRevocationsMixin, ApiRequestHandler):
+    """Return the accounts revoked after the given revocation sequence
+    'since' as JSON data: a dictionary of email to revocation sequence,
+    the revocation sequence to use as 'since' for the next call, and the
+    cursor for the next page of at most 'limit' accounts, or null if no more.
+    Follow the cursor, with the same 'since', until null.
+    The revocation sequence is a wall-clock timestamp, so revocations
+    saved by other processes may appear after 'since' was obtained, with
+    the same or a slightly earlier timestamp. Therefore the revocations
+    from ASSERTION_OVERLAP seconds before 'since' are returned again;
+    merge them into the dictionary kept from previous calls.
+    Return HTTP 400 if invalid parameter.
+    Return HTTP 404 if assertions not enabled."""
+
+    async def get(self):
+        self.check_assertions_enabled()
+        since = self.get_argument('since', '')
+        try:
+            limit = int(self.get_argument('limit', settings['PAGE_SIZE']))
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason='invalid limit')
+        limit = max(1, min(limit, settings['PAGE_SIZE']))
+        options = dict(end_key=constants.HIGH_CHAR, limit=limit + 1)
+        cursor = self.get_argument('cursor', None)
+        if cursor:
+            try:
+                key, iuid = utils.parse_log_cursor(cursor)
+            except ValueError:
+                raise tornado.web.HTTPError(400, reason='invalid cursor')
+            options['start_key'] = key
+            options['start_key_doc_id'] = iuid
+        elif since:
+            try:
+                options['start_key'] = utils.timestamp_before(
+                    since, settings['ASSERTION_OVERLAP'])
+            except ValueError:
+                raise tornado.web.HTTPError(400, reason='invalid since')
+        rows = await self.adb.view('user/revoked', **options)
+        if len(rows) > limit:
+            row = rows.pop()
+            cursor = "{0},{1}".format(row['key'], row['id'])
+        else:
+            cursor = None
+        revocations = dict([(r['value'], r['key']) for r in rows])
+        rseq = max([since] + [r['key'] for r in rows])
+        self.write(dict(revocations=revocations, rseq=rseq, cursor=cursor))
+
+
+class ApiLogs(LogsMixin, ApiRequestHandler):
+    """Return the log entries selected by operator or doctype, and time range,
+    latest first, as JSON data: a list of entries, and the cursor for the
+    next page, or null if no more. The entries are streamed, being
+    flushed to the client every 'flush_count' entries.
+    With the API token, the argument 'service' is required, and only the
+    entries for that service and for the active users having it enabled
+    are returned. A logged-in admin gets all entries.
+    Change '_id' to 'iuid'. Remove '_rev'.
+    Return HTTP 400 if invalid parameter, or no service given with the token.
+    Return HTTP 403 if logged in and not admin.
+    Return HTTP 404 if no such service."""
+
+    admin_only = True
+    flush_count = 100
+
+    async def get(self):
+        query = self.get_logs_query()
+        limit = self.get_logs_limit()
+        ids = await self.get_scope()
+        count = 0
+        cursor = None
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write('{"logs": [')
+        async for log in self.iter_logs(chunk=limit + 1, **query):
+            if ids is not None and log.get('doc') not in ids: continue
+            if count == limit:
+                cursor = utils.get_log_cursor(log)
+                break
+            if count:
+                self.write(', ')
+            log['iuid'] = log.pop('_id')
+            del log['_rev']
+            self.write(json.dumps(log))
+            count += 1
+            if count % self.flush_count == 0:
+                await self.flush()
+        self.write('], "cursor": {0}}}'.format(json.dumps(cursor)))
+
+    async def get_scope(self):
+        """Return the set of ids of the documents whose log entries may be
+        returned, or None for all entries, when logged in as admin."""
+        if self.current_user: return None
+        name = self.get_argument('service', None)
+        if not name:
+            raise tornado.web.HTTPError(400, reason='service required')
+        service = await self.get_service(name)
+        view_rows = await self.adb.view('user/service',
+                                        start_key=[service['name'], ''],
+                                        end_key=[service['name'], {}])
+        return set([service['_id']] + [r['id'] for r in view_rows])
+
+
+class ApiUsersSearch(ApiRequestHandler):
+    """Return the user accounts having an email, username, name or university
+    (or a word in these) beginning with the argument 'q', as JSON data.
+    Only the email, username, name and university are given.
+    Requires the API token, unless logged in as admin.
+    The in-memory search index of the mirror is used; the database
+    has no equivalent index.
+    Return HTTP 400 if invalid limit.
+    Return HTTP 403 if logged in and not admin.
+    Return HTTP 404 if the mirror is not running."""
+
+    admin_only = True
+    fields = ('email', 'username', 'name', 'university')
+
+    async def get(self):
+        index = mirror.get_mirror()
+        if index is None:
+            raise tornado.web.HTTPError(404, reason='search not enabled')
+        prefix = self.get_argument('q', '')
+        try:
+            limit = int(self.get_argument('limit', 10))
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason='invalid limit')
+        limit = max(1, min(limit, settings['PAGE_SIZE']))
+        if prefix.strip():
+            users = index.search_users(prefix, limit)
+        else:
+            users = []
+        self.write(dict(users=[dict([(k, u.get(k)) for k in self.fields])
+                               for u in users]))
@@ -12,29 +12,36 @@ import userman
 from userman import settings
 from userman import constants
 from userman import utils
+from userman import asyncdb
 from userman import uimodules
+from userman import mirror
+from userman import mailer
+from userman import logsink
+from userman import notifier
+from userman import authcache
+from userman import metrics
 from userman.requesthandler import RequestHandler
 
 from userman.user import *
 from userman.service import *
 from userman.team import *
 from userman.login import *
+from userman.log import *
 from userman.api import *
 
 
 class Home(RequestHandler):
     "Home page: Form to login or link to create new account."
 
-    def get(self):
+    async def get(self):
         services = teams = []
         pending_count = 0
         if self.current_user:
-            services = [self.get_service(n)
-                        for n in self.current_user['services']]
-            teams = [self.get_team(n) for n in self.current_user['teams']]
+            services = await self.get_services(self.current_user['services'])
+            teams = await self.get_teams(self.current_user['teams'])
             if self.is_admin():
                 try:
-                    view_rows = self.db.view('user/count', key='pending')
+                    view_rows = await self.adb.view('user/count', key='pending')
                     pending_count = view_rows[0]['value']
                 except IndexError:
                     pass
@@ -54,7 +61,86 @@ class Version(RequestHandler):
                     ('tornado', tornado.version),
                     ('CouchDB server', settings['DB_SERVER_VERSION']),
                     ('CouchDB module', version('ibmcloudant'))]
-        self.render('version.html', versions=versions)
+        counters = []
+        if self.is_admin():
+            counters.append(('CouchDB client',
+                             sorted(utils.get_couchdb_client_counters().items())))
+            if settings['DB_SINGLE_FLIGHT']:
+                counters.append(('Single-flight reads',
+                                 sorted(asyncdb.get_flight_counters().items())))
+            cache = utils.get_document_cache(settings['DB_DATABASE'])
+            if cache is not None:
+                counters.append(('Document cache',
+                                 sorted(cache.get_counters().items())))
+            auth = authcache.get_counters()
+            if auth is not None:
+                counters.append(('Auth user cache', sorted(auth[0].items())))
+                counters.append(('Auth negative cache',
+                                 sorted(auth[1].items())))
+            index = mirror.get_mirror()
+            if index is not None:
+                counters.append(('In-memory mirror',
+                                 sorted(index.get_counters().items())))
+            sink = logsink.get_sink()
+            if sink is not None:
+                counters.append(('Log sink',
+                                 sorted(sink.get_counters().items())))
+            notify = notifier.get_notifier()
+            if notify is not None:
+                counters.append(('Service notifications',
+                                 sorted(notify.get_counters().items())))
+            counters.append(('Email queue',
+                             sorted(mailer.get_mailer().get_counters().items())))
+        self.render('version.html', versions=versions, counters=counters)
+
+
+class Metrics(ApiRequestHandler):
+    """Metrics in the Prometheus text exposition format.
+    Requires the API token, unless logged in as admin."""
+
+    admin_only = True
+
+    async def get(self):
+        if not settings['METRICS']:
+            raise tornado.web.HTTPError(404, reason='metrics not enabled')
+        extra = []
+        view_rows = await self.adb.view('user/count', group=True)
+        extra.append(('userman_users', 'gauge',
+                      'Number of user accounts, per status.',
+                      ('status', ),
+                      [((r['key'], ), r['value']) for r in view_rows]))
+        mail = mailer.get_mailer().get_counters()
+        extra.append(('userman_email_queue_depth', 'gauge',
+                      'Number of email messages not yet sent.',
+                      (), [((), mail['queue_depth'])]))
+        extra.append(('userman_email_messages_total', 'counter',
+                      'Number of email messages, per result.',
+                      ('result', ),
+                      [((k, ), mail[k]) for k in ['sent', 'retried', 'failed']]))
+        caches = []
+        cache = utils.get_document_cache(settings['DB_DATABASE'])
+        if cache is not None:
+            caches.append(('document', cache.get_counters()))
+        auth = authcache.get_counters()
+        if auth is not None:
+            caches.append(('auth_user', auth[0]))
+            caches.append(('auth_negative', auth[1]))
+        for name, type, help in [
+                ('hits', 'counter', 'Number of cache hits.'),
+                ('misses', 'counter', 'Number of cache misses.'),
+                ('entries', 'gauge', 'Number of entries in the cache.')]:
+            metric = 'userman_cache_' + name
+            if type == 'counter':
+                metric += '_total'
+            extra.append((metric, type, help, ('cache', ),
+                          [((c, ), counters[name]) for c, counters in caches]))
+        if settings['DB_SINGLE_FLIGHT']:
+            flights = asyncdb.get_flight_counters()
+            extra.append(('userman_db_reads_merged_total', 'counter',
+                          'Number of database reads merged into another.',
+                          (), [((), flights['merged'])]))
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.get_text(extra))
 
 
 URL = tornado.web.url
@@ -89,15 +175,27 @@ handlers = \
      URL(r'/teams', Teams, name='teams'),
      URL(constants.LOGIN_URL, Login, name='login'),
      URL(r'/logout', Logout, name='logout'),
+     URL(r'/logs', Logs, name='logs'),
      URL(r'/version', Version, name='version'),
+     URL(r'/metrics', Metrics, name='metrics'),
      URL(r'/api/v1/auth/(.+)', ApiAuth, name='api_auth'),
+     URL(r'/api/v1/users/search', ApiUsersSearch, name='api_users_search'),
+     URL(r'/api/v1/users', ApiUsers, name='api_users'),
+     URL(r'/api/v1/service/([^/]+)/users', ApiServiceUsers,
+         name='api_service_users'),
      URL(r'/api/v1/user/(.+)', ApiUser, name='api_user'),
+     URL(r'/api/v1/assertion/(.+)', ApiAssertion, name='api_assertion'),
+     URL(r'/api/v1/revocations', ApiRevocations, name='api_revocations'),
+     URL(r'/api/v1/logs', ApiLogs, name='api_logs'),
      URL(r'/api/v1/doc/([a-f0-9]{32})', ApiDoc, name='api_doc'),
      ]
 
+metrics.set_routes(handlers)
+
 
 if __name__ == "__main__":
     import sys
+    import signal
     import tornado.ioloop
     try:
         utils.load_settings(filepath=sys.argv[1])
@@ -112,6 +210,26 @@ if __name__ == "__main__":
         static_path=constants.STATIC_PATH,
         static_url_prefix=constants.STATIC_URL,
         login_url=constants.LOGIN_URL)
+    if settings['DB_BACKEND'] == 'memory':
+        # The in-memory database is empty at start.
+        from userman.dump import undump
+        from userman.init_database import create_user_admin
+        if settings['DB_MEMORY_DUMP']:
+            count_items, count_files = undump(utils.get_db(),
+                                              settings['DB_MEMORY_DUMP'])
+            logging.info("loaded %s items from %s", count_items,
+                         settings['DB_MEMORY_DUMP'])
+        if sys.stdin.isatty():
+            print(create_user_admin(utils.get_db()))
+    if settings['MIRROR']:
+        mirror.start(utils.get_db())
+    if settings['LOG_WRITE_BEHIND']:
+        logsink.start(utils.get_db())
+        # Exit normally on SIGTERM, so that the queued log entries are written.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if settings['NOTIFY']:
+        notifier.start(utils.get_db())
+    mailer.get_mailer()     # Start sending any spooled email.
     application.listen(settings['PORT'])
     logging.info("Userman web server on port %s", settings['PORT'])
     tornado.ioloop.IOLoop.instance().start()
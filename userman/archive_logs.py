@@ -0,0 +1,120 @@
+""" Userman: Archive and purge expired log documents.
+
+The retention period is given per doctype by LOG_RETENTION (days);
+doctypes not given there are kept forever. Expired log documents are
+appended to compressed monthly files 'logs-YYYY-MM.jsonl.gz' in the
+directory LOG_ARCHIVE_DIR, one JSON document per line, and are then
+deleted from the database in batches.
+
+The timestamp and id of the last archived log document of each doctype
+are recorded in the file 'checkpoint.json' in the archive directory,
+so that an interrupted run does not archive documents twice when
+it is started again. Intended to be run regularly, e.g. from cron.
+"""
+
+import os
+import json
+import gzip
+import logging
+
+from userman import constants
+from userman import settings
+from userman import utils
+
+
+def archive_logs(db, dirpath, retention, batch_size=500):
+    """Archive and delete the log documents older than the retention period
+    in days for their doctype. Return the number of documents archived,
+    and the number deleted."""
+    checkpoint = load_checkpoint(dirpath)
+    count_archived = 0
+    count_deleted = 0
+    for doctype, days in sorted(retention.items()):
+        if days is None: continue
+        cutoff = utils.timestamp(days=-days)
+        options = dict(start_key=[doctype, ''],
+                       end_key=[doctype, cutoff],
+                       include_docs=True,
+                       limit=batch_size)
+        while True:
+            view_rows = db.view('log/doctype', **options)
+            docs = [r['doc'] for r in view_rows]
+            if not docs: break
+            done = checkpoint.get(doctype)
+            archive = [d for d in docs
+                       if not done or [d['timestamp'], d['_id']] > done]
+            if archive:
+                write_archive(dirpath, archive)
+                count_archived += len(archive)
+                last = archive[-1]
+                checkpoint[doctype] = [last['timestamp'], last['_id']]
+                save_checkpoint(dirpath, checkpoint)
+            # The tombstones keep the doctype, for filtering the changes feed.
+            deletes = [{'_id': d['_id'], '_rev': d['_rev'], '_deleted': True,
+                        constants.DB_DOCTYPE: constants.LOG}
+                       for d in docs]
+            failed = set()
+            for result in db.bulk_save(deletes):
+                if result.get('error'):
+                    logging.warning("could not delete log %s: %s",
+                                    result['id'], result['error'])
+                    failed.add(result['id'])
+                else:
+                    count_deleted += 1
+            if len(view_rows) < batch_size: break
+            # Continue after the last row; skip it if it was not deleted.
+            options['start_key'] = view_rows[-1]['key']
+            options['start_key_doc_id'] = view_rows[-1]['id']
+            options['skip'] = int(view_rows[-1]['id'] in failed)
+    return count_archived, count_deleted
+
+def write_archive(dirpath, docs):
+    "Append the log documents to the archive files for their months."
+    months = dict()
+    for doc in docs:
+        doc = dict(doc)
+        doc.pop('_rev', None)
+        months.setdefault(doc['timestamp'][:7], []).append(doc)
+    for month, docs in sorted(months.items()):
+        filepath = os.path.join(dirpath, "logs-{0}.jsonl.gz".format(month))
+        with open(filepath, 'ab') as outfile:
+            with gzip.GzipFile(fileobj=outfile, mode='ab') as zipfile:
+                for doc in docs:
+                    zipfile.write(json.dumps(doc).encode('utf-8') + b'\n')
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+def load_checkpoint(dirpath):
+    "Return the checkpoint: the last archived [timestamp, id] per doctype."
+    try:
+        with open(os.path.join(dirpath, 'checkpoint.json')) as infile:
+            return json.load(infile)
+    except IOError:
+        return dict()
+
+def save_checkpoint(dirpath, checkpoint):
+    filepath = os.path.join(dirpath, 'checkpoint.json')
+    with open(filepath + '.tmp', 'w') as outfile:
+        json.dump(checkpoint, outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(filepath + '.tmp', filepath)
+
+
+if __name__ == '__main__':
+    import sys
+    try:
+        utils.load_settings(filepath=sys.argv[1])
+    except IndexError:
+        utils.load_settings()
+    dirpath = settings.get('LOG_ARCHIVE_DIR')
+    if not dirpath:
+        sys.exit('LOG_ARCHIVE_DIR not defined in settings')
+    os.makedirs(dirpath, exist_ok=True)
+    count_archived, count_deleted = archive_logs(
+        utils.get_db(),
+        dirpath,
+        settings['LOG_RETENTION'],
+        batch_size=settings['LOG_ARCHIVE_BATCH'])
+    print('archived', count_archived, 'and deleted', count_deleted,
+          'log documents in', dirpath)
@@ -0,0 +1,75 @@
+""" Userman: Signed identity assertions for downstream services.
+
+An assertion is a short-lived statement of a user's identity, signed
+with HMAC-SHA256 using the secret shared with the services, so that a
+service can verify it locally without calling Userman.
+
+The format is: base64url(JSON payload) + '.' + base64url(signature)
+
+The payload contains the user's email, role and teams, the service,
+the time of issue 'iat' and of expiry 'exp' (seconds since the epoch),
+and the revocation sequence 'rseq'. The revocation sequence is the
+time of revocation of the most recently revoked (blocked or reset)
+account at the time of issue. A service which polls the revocations API
+rejects any assertion for an account revoked at a later sequence.
+The revocations are merged into a dictionary, since the API returns
+each again for some time; see 'ApiRevocations'.
+
+This module depends only on the Python standard library, so that it may
+be copied to a downstream service and used there for verification.
+"""
+
+import json
+import hmac
+import time
+import base64
+import hashlib
+
+
+def _encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _decode(text):
+    text = text.encode('ascii')
+    return base64.urlsafe_b64decode(text + b'=' * (-len(text) % 4))
+
+def _signature(secret, data):
+    if isinstance(secret, str):
+        secret = secret.encode('utf-8')
+    return hmac.new(secret, data, hashlib.sha256).digest()
+
+
+def create(payload, secret):
+    "Return the signed assertion for the payload dictionary."
+    data = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    data = _encode(data.encode('utf-8'))
+    return data + '.' + _encode(_signature(secret, data.encode('ascii')))
+
+def verify(assertion, secret, service=None, now=None):
+    """Return the payload of the assertion, if the signature is valid,
+    it has not expired, and it is for the service, if given.
+    Raise ValueError otherwise."""
+    try:
+        data, signature = assertion.split('.')
+        signature = _decode(signature)
+        data = data.encode('ascii')
+    except (AttributeError, ValueError, TypeError):
+        raise ValueError('invalid assertion format')
+    if not hmac.compare_digest(signature, _signature(secret, data)):
+        raise ValueError('invalid assertion signature')
+    payload = json.loads(_decode(data.decode('ascii')).decode('utf-8'))
+    if now is None:
+        now = time.time()
+    if payload['exp'] <= now:
+        raise ValueError('assertion expired')
+    if service is not None and payload['service'] != service:
+        raise ValueError('assertion not for this service')
+    return payload
+
+def is_revoked(payload, revocations):
+    """Is the assertion revoked, given the revocations dictionary
+    of email to revocation sequence, as obtained from the API?"""
+    try:
+        return revocations[payload['email']] > payload['rseq']
+    except KeyError:
+        return False
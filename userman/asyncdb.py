@@ -0,0 +1,548 @@
+" Userman: Coroutine interface to the CouchDB database. "
+
+import os
+import copy
+import json
+import uuid
+import asyncio
+import weakref
+import functools
+import threading
+import http.cookies
+import urllib.parse
+import concurrent.futures
+
+import tornado.ioloop
+import ibm_cloud_sdk_core
+try:
+    from tornado.curl_httpclient import CurlAsyncHTTPClient as DbHTTPClient
+except ImportError:
+    from tornado.simple_httpclient import SimpleAsyncHTTPClient as DbHTTPClient
+
+from . import settings
+from . import utils
+from . import logsink
+
+
+# The process-wide bounded thread pool for blocking database calls.
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    "Return the thread pool in which the blocking database calls are run."
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=settings['DB_THREADS'],
+                thread_name_prefix='userman-db')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+class AsyncDatabase:
+    """Abstract coroutine interface to the database.
+    It has the methods of CloudantDatabaseWrapper, with the same arguments
+    and results, but every method returns an awaitable instead;
+    'await adb[doc_id]' is the equivalent of db[doc_id]. The implementations
+    and the wrappers adding behaviour to another handle are subclasses."""
+
+    def __getitem__(self, doc_id):
+        raise NotImplementedError
+
+    def get_rev(self, doc_id):
+        raise NotImplementedError
+
+    def view(self, viewname, **options):
+        raise NotImplementedError
+
+    def view_docs(self, viewname, keys):
+        raise NotImplementedError
+
+    def save(self, document):
+        raise NotImplementedError
+
+    def bulk_save(self, documents):
+        raise NotImplementedError
+
+    def delete(self, document):
+        raise NotImplementedError
+
+    def get_attachment(self, doc_id, attachment_name):
+        raise NotImplementedError
+
+    def put_attachment(self, doc_id, data, attachment_name, content_type, rev):
+        raise NotImplementedError
+
+    def all_docs(self):
+        "Return the list of all document IDs."
+        raise NotImplementedError
+
+    def changes(self, **options):
+        raise NotImplementedError
+
+    def info(self):
+        raise NotImplementedError
+
+
+class ExecutorDatabaseWrapper(AsyncDatabase):
+    """Coroutine interface to a CloudantDatabaseWrapper.
+    Each blocking call is run in the bounded thread pool, leaving
+    the IOLoop free to serve other requests meanwhile."""
+
+    def __init__(self, db, executor=None):
+        self.db = db
+        self.executor = executor or get_executor()
+
+    def run(self, func, *args, **kwargs):
+        "Run the blocking function in the thread pool; return a future."
+        return tornado.ioloop.IOLoop.current().run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs))
+
+    def __getitem__(self, doc_id):
+        return self.run(self.db.__getitem__, doc_id)
+
+    def get_rev(self, doc_id):
+        return self.run(self.db.get_rev, doc_id)
+
+    def view(self, viewname, **options):
+        return self.run(self.db.view, viewname, **options)
+
+    def view_docs(self, viewname, keys):
+        return self.run(self.db.view_docs, viewname, keys)
+
+    def save(self, document):
+        return self.run(self.db.save, document)
+
+    def bulk_save(self, documents):
+        return self.run(self.db.bulk_save, documents)
+
+    def delete(self, document):
+        return self.run(self.db.delete, document)
+
+    def get_attachment(self, doc_id, attachment_name):
+        return self.run(self.db.get_attachment, doc_id, attachment_name)
+
+    def put_attachment(self, doc_id, data, attachment_name, content_type, rev):
+        return self.run(self.db.put_attachment, doc_id, data,
+                        attachment_name, content_type, rev)
+
+    def all_docs(self):
+        "Return the list of all document IDs."
+        return self.run(lambda: list(self.db))
+
+    def changes(self, **options):
+        return self.run(self.db.changes, **options)
+
+    def info(self):
+        return self.run(self.db.info)
+
+
+# One HTTP client per IOLoop; it bounds the number of concurrent connections.
+_http_clients = weakref.WeakKeyDictionary()
+
+def get_http_client():
+    "Return the HTTP client for CouchDB requests in the current IOLoop."
+    ioloop = tornado.ioloop.IOLoop.current()
+    try:
+        return _http_clients[ioloop]
+    except KeyError:
+        client = DbHTTPClient(force_instance=True,
+                              max_clients=settings['DB_MAX_CLIENTS'])
+        _http_clients[ioloop] = client
+        return client
+
+
+class HttpDatabaseWrapper(AsyncDatabase):
+    """Native coroutine implementation of the CloudantDatabaseWrapper
+    interface, talking CouchDB HTTP directly through tornado's
+    AsyncHTTPClient, or its curl variant when pycurl is installed.
+    No threads are used; the number of concurrent connections is
+    bounded by DB_MAX_CLIENTS, and further requests are queued."""
+
+    # The session cookie and any ongoing login are shared in the process.
+    _cookie = None
+    _login = None
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        parts = urllib.parse.urlsplit(settings['DB_SERVER'])
+        netloc = parts.hostname
+        if parts.port:
+            netloc += ":{0}".format(parts.port)
+        self.base_url = urllib.parse.urlunsplit(
+            (parts.scheme, netloc, parts.path.rstrip('/'), '', ''))
+        # Credentials in the URL are sent as basic authentication;
+        # otherwise, if a username is given, a session cookie is used.
+        if parts.username:
+            self.auth = dict(auth_username=urllib.parse.unquote(parts.username),
+                             auth_password=urllib.parse.unquote(parts.password or ''))
+            self.session = False
+        else:
+            self.auth = dict()
+            self.session = bool(settings.get('DB_USERNAME'))
+        self.cache = utils.get_document_cache(db_name)
+
+    def get_path(self, doc_id, *parts):
+        "Return the quoted URL path for the document, or database if no id."
+        path = '/' + urllib.parse.quote(self.db_name, safe='')
+        if doc_id is None: return path
+        if doc_id.startswith('_design/'):
+            path += '/_design/' + urllib.parse.quote(doc_id[len('_design/'):],
+                                                     safe='')
+        else:
+            path += '/' + urllib.parse.quote(doc_id, safe='')
+        for part in parts:
+            path += '/' + urllib.parse.quote(part, safe='')
+        return path
+
+    async def login(self):
+        "Obtain a session cookie; concurrent callers share the same login."
+        login = HttpDatabaseWrapper._login
+        if login is None or login.done():
+            login = asyncio.ensure_future(self.request_session_cookie())
+            HttpDatabaseWrapper._login = login
+        await login
+
+    async def request_session_cookie(self):
+        response = await get_http_client().fetch(
+            self.base_url + '/_session',
+            method='POST',
+            headers={'Content-Type': 'application/json'},
+            body=json.dumps(dict(name=settings['DB_USERNAME'],
+                                 password=settings.get('DB_PASSWORD', ''))),
+            connect_timeout=settings['DB_CONNECT_TIMEOUT'],
+            request_timeout=settings['DB_READ_TIMEOUT'],
+            raise_error=False)
+        if response.code != 200:
+            raise ibm_cloud_sdk_core.ApiException(
+                response.code, message='CouchDB session login failed')
+        for header in response.headers.get_list('Set-Cookie'):
+            cookie = http.cookies.SimpleCookie(header)
+            if 'AuthSession' in cookie:
+                value = cookie['AuthSession'].value
+                HttpDatabaseWrapper._cookie = "AuthSession={0}".format(value)
+
+    async def request(self, method, path, params=None, body=None,
+                      content_type='application/json', headers=None):
+        """Perform the HTTP request, logging in if required.
+        Return the response, which has a 'json' attribute if JSON.
+        Raise ApiException if CouchDB returned an error status."""
+        url = self.base_url + path
+        if params:
+            params = dict([(k, json.dumps(v) if isinstance(v, bool) else v)
+                           for k, v in params.items()])
+            url += '?' + urllib.parse.urlencode(params)
+        headers = dict(headers or {})
+        headers['Accept'] = 'application/json'
+        if body is not None:
+            headers['Content-Type'] = content_type
+            if content_type == 'application/json':
+                body = json.dumps(body)
+        for attempt in range(2):
+            if self.session:
+                if HttpDatabaseWrapper._cookie is None:
+                    await self.login()
+                headers['Cookie'] = HttpDatabaseWrapper._cookie
+            response = await get_http_client().fetch(
+                url,
+                method=method,
+                headers=headers,
+                body=body,
+                allow_nonstandard_methods=True,
+                connect_timeout=settings['DB_CONNECT_TIMEOUT'],
+                request_timeout=settings['DB_READ_TIMEOUT'],
+                raise_error=False,
+                **self.auth)
+            # Session expired, or invalidated by server; login again once.
+            if response.code == 401 and self.session and attempt == 0:
+                HttpDatabaseWrapper._cookie = None
+                continue
+            break
+        if response.code == 599:   # No response at all from the server.
+            response.rethrow()
+        if method != 'HEAD' and \
+           response.headers.get('Content-Type', '').startswith('application/json'):
+            response.json = json.loads(response.body)
+        else:
+            response.json = None
+        if response.code >= 400:
+            try:
+                message = response.json['reason']
+            except (TypeError, KeyError):
+                message = response.reason
+            raise ibm_cloud_sdk_core.ApiException(response.code,
+                                                  message=message)
+        return response
+
+    async def get(self, doc_id):
+        "A cached document is revalidated by its revision; unchanged if 304."
+        if self.cache is None:
+            response = await self.request('GET', self.get_path(doc_id))
+            return response.json
+        cached = self.cache.get(doc_id)
+        if cached is None:
+            headers = None
+        else:
+            headers = {'If-None-Match': '"{0}"'.format(cached['_rev'])}
+        try:
+            response = await self.request('GET', self.get_path(doc_id),
+                                          headers=headers)
+        except ibm_cloud_sdk_core.ApiException:
+            self.cache.remove(doc_id)
+            raise
+        if response.code == 304:
+            self.cache.count('unchanged')
+            return cached
+        if cached is not None:
+            self.cache.count('changed')
+        self.cache.put(response.json)
+        return response.json
+
+    def __getitem__(self, doc_id):
+        return self.get(doc_id)
+
+    async def get_rev(self, doc_id):
+        "Return the current revision of the document, without its body."
+        response = await self.request('HEAD', self.get_path(doc_id))
+        return response.headers['ETag'].strip('"')
+
+    async def view(self, viewname, **options):
+        ddoc, view = viewname.split('/')
+        path = self.get_path("_design/{0}".format(ddoc), '_view', view)
+        response = await self.request('POST', path, body=options)
+        return response.json.get('rows', [])
+
+    async def view_docs(self, viewname, keys):
+        """Return the documents for the given keys in the view, in one
+        multi-key request, as a dict keyed by view key. Missing keys are absent."""
+        rows = await self.view(viewname, keys=list(keys), include_docs=True)
+        return utils.get_view_docs(rows)
+
+    async def save(self, document):
+        if '_id' not in document:
+            document['_id'] = uuid.uuid4().hex
+        response = await self.request('PUT', self.get_path(document['_id']),
+                                      body=document)
+        document['_rev'] = response.json['rev']
+        if self.cache is not None:
+            self.cache.put(document)
+        return response.json
+
+    async def bulk_save(self, documents):
+        """Save the documents in one '_bulk_docs' request.
+        Return the list of results, in the same order as the documents;
+        each has 'id', and either 'rev', or 'error' and 'reason'."""
+        for document in documents:
+            if '_id' not in document:
+                document['_id'] = uuid.uuid4().hex
+        response = await self.request('POST', self.get_path('_bulk_docs'),
+                                      body=dict(docs=documents))
+        return utils.set_bulk_saved(documents, response.json, self.cache)
+
+    async def delete(self, document):
+        if '_id' not in document or '_rev' not in document:
+            raise ValueError("Document must have '_id' and '_rev' to be deleted")
+        if self.cache is not None:
+            self.cache.remove(document['_id'])
+        response = await self.request('DELETE',
+                                      self.get_path(document['_id']),
+                                      params=dict(rev=document['_rev']))
+        return response.json
+
+    async def get_attachment(self, doc_id, attachment_name):
+        "Return the attachment data as bytes."
+        response = await self.request('GET',
+                                      self.get_path(doc_id, attachment_name))
+        return response.body
+
+    async def put_attachment(self, doc_id, data, attachment_name, content_type, rev):
+        response = await self.request('PUT',
+                                      self.get_path(doc_id, attachment_name),
+                                      params=dict(rev=rev),
+                                      body=data,
+                                      content_type=content_type)
+        return response.json
+
+    async def all_docs(self):
+        "Return the list of all document IDs."
+        response = await self.request('GET', self.get_path('_all_docs'))
+        return [row['id'] for row in response.json.get('rows', [])]
+
+    async def changes(self, **options):
+        """Return the changes feed result; a dict with 'results' and 'last_seq'.
+        A 'selector' or 'doc_ids' option is sent in the body of a POST."""
+        body = dict()
+        for key in ['selector', 'doc_ids']:
+            if key in options:
+                body[key] = options.pop(key)
+        if body:
+            response = await self.request('POST', self.get_path('_changes'),
+                                          params=options, body=body)
+        else:
+            response = await self.request('GET', self.get_path('_changes'),
+                                          params=options)
+        return response.json
+
+    async def info(self):
+        "Return the database information, such as 'update_seq'."
+        response = await self.request('GET', self.get_path(None))
+        return response.json
+
+
+# The reads in progress, per IOLoop; (db name, operation, args) -> future.
+_flights = weakref.WeakKeyDictionary()
+_flight_counters = dict(calls=0, merged=0)
+_flight_lock = threading.Lock()    # For the counters, shared by the IOLoops.
+
+def get_flights():
+    "Return the table of reads in progress in the current IOLoop."
+    ioloop = tornado.ioloop.IOLoop.current()
+    try:
+        return _flights[ioloop]
+    except KeyError:
+        flights = dict()
+        _flights[ioloop] = flights
+        return flights
+
+def get_flight_counters():
+    "Return the number of reads made, and the number merged into another."
+    with _flight_lock:
+        return dict(_flight_counters)
+
+def count_flight(name):
+    "Increment the given read counter."
+    with _flight_lock:
+        _flight_counters[name] += 1
+
+
+class SingleFlightDatabaseWrapper(AsyncDatabase):
+    """Coroutine interface merging concurrent identical reads into one.
+    A read of a document, or a view query with the same options, which is
+    made while an identical read is in progress, waits for that read and
+    gets a copy of its result, instead of making another database call.
+    A write of a document forgets the reads in progress of that document
+    and of all views, which it may affect, so that reads after it are new."""
+
+    def __init__(self, adb, db_name):
+        self.adb = adb
+        self.db_name = db_name
+
+    async def read(self, flight_key, func, *args, **kwargs):
+        """Return the result of the read given by the key, from the one
+        in progress, if any, otherwise from a new call of the function.
+        The result is copied if shared, since callers may modify it."""
+        flights = get_flights()
+        key = (self.db_name, ) + flight_key
+        try:
+            flight = flights[key]
+        except KeyError:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            flight = flights[key] = dict(future=future, shared=False)
+            def done(future):
+                if flights.get(key) is flight:
+                    del flights[key]
+            future.add_done_callback(done)
+            count_flight('calls')
+        else:
+            flight['shared'] = True
+            count_flight('merged')
+        result = await flight['future']
+        if flight['shared']:
+            result = copy.deepcopy(result)
+        return result
+
+    def forget(self, doc_id):
+        """Let subsequent reads of the document, and all view queries,
+        make new database calls. Reads of other documents are kept."""
+        flights = get_flights()
+        for key in list(flights):
+            if key[0] != self.db_name: continue
+            if key[1] in ('view', 'view_docs') or \
+               key[1:] in (('get', doc_id), ('rev', doc_id)):
+                del flights[key]
+
+    def __getitem__(self, doc_id):
+        return self.read(('get', doc_id), self.adb.__getitem__, doc_id)
+
+    def get_rev(self, doc_id):
+        return self.read(('rev', doc_id), self.adb.get_rev, doc_id)
+
+    def view(self, viewname, **options):
+        key = ('view', viewname, json.dumps(options, sort_keys=True))
+        return self.read(key, self.adb.view, viewname, **options)
+
+    def view_docs(self, viewname, keys):
+        key = ('view_docs', viewname, json.dumps(list(keys)))
+        return self.read(key, self.adb.view_docs, viewname, keys)
+
+    def save(self, document):
+        self.forget(document.get('_id'))
+        return self.adb.save(document)
+
+    def bulk_save(self, documents):
+        for document in documents:
+            self.forget(document.get('_id'))
+        return self.adb.bulk_save(documents)
+
+    def delete(self, document):
+        self.forget(document['_id'])
+        return self.adb.delete(document)
+
+    def get_attachment(self, doc_id, attachment_name):
+        return self.adb.get_attachment(doc_id, attachment_name)
+
+    def put_attachment(self, doc_id, data, attachment_name, content_type, rev):
+        self.forget(doc_id)
+        return self.adb.put_attachment(doc_id, data, attachment_name,
+                                       content_type, rev)
+
+    def all_docs(self):
+        return self.adb.all_docs()
+
+    def changes(self, **options):
+        return self.adb.changes(**options)
+
+    def info(self):
+        return self.adb.info()
+
+
+def get_db():
+    """Return the coroutine handle for the CouchDB database.
+    The implementation is chosen by the DB_ASYNC_DRIVER setting:
+    'executor' runs the blocking client in threads, 'http' is native.
+    The in-memory database of DB_BACKEND 'memory' is always run in threads.
+    Concurrent identical reads are merged if DB_SINGLE_FLIGHT is set."""
+    if settings['DB_ASYNC_DRIVER'] == 'http' and \
+       settings['DB_BACKEND'] != 'memory':
+        adb = HttpDatabaseWrapper(settings['DB_DATABASE'])
+    else:
+        adb = ExecutorDatabaseWrapper(utils.get_db())
+    if settings['DB_SINGLE_FLIGHT']:
+        adb = SingleFlightDatabaseWrapper(adb, settings['DB_DATABASE'])
+    return adb
+
+async def get_user_doc(db, name):
+    """Get the document for the account given by name (email or username).
+    Raise ValueError if no such account."""
+    # 'name' is the email address for the account
+    if '@' in name:
+        viewname = 'user/email'
+    # else 'name' is the username for the account
+    else:
+        viewname = 'user/username'
+    result = list(await db.view(viewname, include_docs=True, key=name))
+    if len(result) != 1:
+        raise ValueError("no such user account '{0}'".format(name))
+    return result[0]['doc']
+
+async def log(db, doc, changed={}, deleted={}, current_user=None):
+    """Create a log entry for the given document.
+    It is queued for writing if the write-behind log sink is running."""
+    entry = utils.get_log_entry(doc,
+                                changed=changed,
+                                deleted=deleted,
+                                current_user=current_user)
+    if not logsink.add(entry):
+        await db.save(entry)
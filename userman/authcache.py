@@ -0,0 +1,83 @@
+""" Userman: Caches for user lookups in the authentication API.
+
+Two bounded LRU caches, shared between requests and threads:
+one for the user accounts most recently looked up, keyed by email and
+username, and one for names for which there is no account, so that
+repeated requests for nonexistent accounts do not each query the view.
+Both are invalidated for an account by 'after_save' of its saver in this
+process. The caches are off unless AUTH_CACHE_SIZE is set. Other processes,
+and writes made directly in the database, do not invalidate them: such a
+change, for instance the blocking of an account, is seen here only when its
+entry expires, so it may be stale for at most AUTH_CACHE_TTL seconds.
+"""
+
+import copy
+import threading
+
+from . import constants
+from . import settings
+from . import utils
+
+
+_lock = threading.Lock()
+_users = None           # email or username -> user document
+_missing = None         # email or username -> True
+
+def get_caches():
+    "Return the user cache and the negative cache, or None if disabled."
+    global _users, _missing
+    if not settings['AUTH_CACHE_SIZE']: return None
+    with _lock:
+        if _users is None:
+            _users = utils.LruCache(settings['AUTH_CACHE_SIZE'],
+                                    settings['AUTH_CACHE_TTL'])
+            _missing = utils.LruCache(settings['AUTH_NEGATIVE_SIZE'],
+                                      settings['AUTH_CACHE_TTL'])
+        return _users, _missing
+
+def get_user(name):
+    "Return a copy of the cached user document, or None if not cached."
+    caches = get_caches()
+    if caches is None: return None
+    doc = caches[0].get(name)
+    if doc is None: return None
+    return copy.deepcopy(doc)
+
+def put_user(doc):
+    "Cache a copy of the user document by its email and username."
+    caches = get_caches()
+    if caches is None: return
+    doc = copy.deepcopy(doc)
+    caches[0].put(doc['email'], doc)
+    if doc.get('username'):
+        caches[0].put(doc['username'], doc)
+
+def is_missing(name):
+    "Is the name known not to be the email or username of any account?"
+    caches = get_caches()
+    if caches is None: return False
+    return bool(caches[1].get(name))
+
+def put_missing(name):
+    "Record that the name is not the email or username of any account."
+    caches = get_caches()
+    if caches is None: return
+    caches[1].put(name, True)
+
+def invalidate(doc):
+    """Remove the entries for the user document from the caches.
+    Entries for its previous email or username are also removed."""
+    if doc.get(constants.DB_DOCTYPE) != constants.USER: return
+    caches = get_caches()
+    if caches is None: return
+    caches[0].remove_if(lambda d: d['_id'] == doc['_id'])
+    for name in [doc.get('email'), doc.get('username')]:
+        if name:
+            caches[1].remove(name)
+
+def get_counters():
+    """Return the counters for the user cache and the negative cache,
+    or None if disabled."""
+    caches = get_caches()
+    if caches is None: return None
+    return caches[0].get_counters(), caches[1].get_counters()
@@ -0,0 +1,8 @@
+/* Userman
+   Index log documents by operator and timestamp.
+   Value: null.
+*/
+function(doc) {
+    if (doc.userman_doctype !== 'log') return;
+    if (doc.operator) emit([doc.operator, doc.timestamp], null);
+}
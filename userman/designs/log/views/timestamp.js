@@ -0,0 +1,8 @@
+/* Userman
+   Index log documents by timestamp.
+   Value: null.
+*/
+function(doc) {
+    if (doc.userman_doctype !== 'log') return;
+    emit(doc.timestamp, null);
+}
@@ -0,0 +1,14 @@
+/* Userman
+   Index user documents whose access has been revoked, i.e. which are
+   in status 'blocked', or 'approved' after a password reset. Approval
+   of a new account is not a revocation; it has no 'revoked' timestamp.
+   Key: revocation timestamp. Value: email.
+*/
+function(doc) {
+    if (doc.userman_doctype !== 'user') return;
+    if (doc.status === 'blocked') {
+	emit(doc.revoked || doc.modified, doc.email);
+    } else if (doc.status === 'approved' && doc.revoked) {
+	emit(doc.revoked, doc.email);
+    }
+}
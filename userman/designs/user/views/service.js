@@ -0,0 +1,11 @@
+/* Userman
+   Index active user documents by service and email.
+   Value: null.
+*/
+function(doc) {
+    if (doc.userman_doctype !== 'user') return;
+    if (doc.status !== 'active') return;
+    for (var i in doc.services) {
+	emit([doc.services[i], doc.email], null);
+    }
+}
@@ -0,0 +1,8 @@
+/* Userman
+   Index user documents by status and email.
+   Value: null.
+*/
+function(doc) {
+    if (doc.userman_doctype !== 'user') return;
+    emit([doc.status, doc.email], null);
+}
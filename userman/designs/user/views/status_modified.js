@@ -0,0 +1,8 @@
+/* Userman
+   Index user documents by status and modification timestamp.
+   Value: null.
+*/
+function(doc) {
+    if (doc.userman_doctype !== 'user') return;
+    emit([doc.status, doc.modified], null);
+}
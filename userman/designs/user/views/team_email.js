@@ -0,0 +1,10 @@
+/* Userman
+   Index user documents by team and email.
+   Value: null.
+*/
+function(doc) {
+    if (doc.userman_doctype !== 'user') return;
+    for (var i in doc.teams) {
+	emit([doc.teams[i], doc.email], null);
+    }
+}
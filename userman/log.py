@@ -0,0 +1,95 @@
+" Userman: Log handlers. "
+
+import urllib.parse
+
+import tornado.web
+
+from . import constants
+from . import settings
+from . import utils
+from .requesthandler import RequestHandler
+
+
+class LogsMixin(object):
+    "Query the log entries by operator or doctype, and time range."
+
+    def get_logs_query(self):
+        """Return the query given by the arguments 'operator', 'doctype',
+        'since', 'until' and 'cursor'. Timestamps may be truncated,
+        e.g. to a date; 'since' is inclusive, and 'until' exclusive."""
+        query = dict()
+        for name in ['operator', 'doctype', 'since', 'until', 'cursor']:
+            query[name] = self.get_argument(name, None) or None
+        if query['doctype'] and \
+           query['doctype'] not in (constants.USER, constants.TEAM,
+                                    constants.SERVICE):
+            raise tornado.web.HTTPError(400, reason='invalid doctype')
+        return query
+
+    def get_logs_limit(self):
+        "Return the max number of log entries in a page."
+        try:
+            limit = int(self.get_argument('limit', settings['PAGE_SIZE']))
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason='invalid limit')
+        return max(1, min(limit, settings['PAGE_SIZE']))
+
+    async def iter_logs(self, operator=None, doctype=None,
+                        since=None, until=None, cursor=None, chunk=None):
+        """Yield the log documents matching the query, latest first.
+        They are fetched from the view in chunks of the given size."""
+        if operator:
+            viewname, prefix = 'log/operator', [operator]
+        elif doctype:
+            viewname, prefix = 'log/doctype', [doctype]
+        else:
+            viewname, prefix = 'log/timestamp', None
+        def key(timestamp):
+            return timestamp if prefix is None else prefix + [timestamp]
+        options = dict(start_key=key(until or {}),
+                       descending=True,
+                       include_docs=True,
+                       limit=chunk or settings['PAGE_SIZE'])
+        if since:
+            options['end_key'] = key(since)
+        elif prefix:
+            options['end_key'] = prefix
+        if cursor:
+            try:
+                timestamp, iuid = utils.parse_log_cursor(cursor)
+            except ValueError:
+                raise tornado.web.HTTPError(400, reason='invalid cursor')
+            options['start_key'] = key(timestamp)
+            options['start_key_doc_id'] = iuid
+        while True:
+            view_rows = await self.adb.view(viewname, **options)
+            for row in view_rows:
+                # The entry exactly at 'until' is at the start of the range.
+                if until and row['doc']['timestamp'] >= until: continue
+                if doctype and row['doc'].get('doctype') != doctype: continue
+                yield row['doc']
+            if len(view_rows) < options['limit']: return
+            options['start_key'] = view_rows[-1]['key']
+            options['start_key_doc_id'] = view_rows[-1]['id']
+            options['skip'] = 1
+
+
+class Logs(LogsMixin, RequestHandler):
+    "Page of log entries, selected by operator, doctype and time range."
+
+    @tornado.web.authenticated
+    async def get(self):
+        self.check_admin()
+        query = self.get_logs_query()
+        limit = self.get_logs_limit()
+        logs = []
+        older_url = None
+        async for log in self.iter_logs(chunk=limit + 1, **query):
+            if len(logs) == limit:
+                params = dict([(k, v) for k, v in query.items() if v])
+                params['cursor'] = utils.get_log_cursor(log)
+                older_url = self.reverse_url('logs') + '?' + \
+                            urllib.parse.urlencode(params)
+                break
+            logs.append(log)
+        self.render('logs.html', logs=logs, query=query, older_url=older_url)
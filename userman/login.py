@@ -8,6 +8,7 @@ import tornado.web
 from userman import settings
 from userman import constants
 from userman import utils
+from userman import asyncdb
 from userman.requesthandler import RequestHandler
 
 
@@ -19,7 +20,7 @@ class Login(RequestHandler):
                     error=None,
                     next=self.get_argument('next', None))
 
-    def post(self):
+    async def post(self):
         self.check_xsrf_cookie()
         try:
             try:
@@ -30,12 +31,12 @@ class Login(RequestHandler):
             except (tornado.web.MissingArgumentError, ValueError):
                 raise ValueError('missing user email or password')
             try:
-                user = self.get_user(email, require_active=True)
+                user = await self.get_user(email, require_active=True)
             except tornado.web.HTTPError as msg:
                 raise ValueError('invalid user email')
             if user.get('password') != utils.hashed_password(password):
                 changed = dict(login_failure=self.request.remote_ip)
-                utils.log(self.db, user, changed=changed)
+                await asyncdb.log(self.adb, user, changed=changed)
                 raise ValueError('invalid password')
             self.set_secure_cookie(constants.USER_COOKIE_NAME, email)
             self._user = user
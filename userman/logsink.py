@@ -0,0 +1,157 @@
+""" Userman: Write-behind sink for log entries.
+
+Log entries are queued in memory and written by a worker thread in bulk,
+every LOG_FLUSH_INTERVAL milliseconds or LOG_FLUSH_SIZE entries, whichever
+comes first, so that saving a document costs one database round-trip
+instead of two. The queue is flushed on shutdown. If the database cannot
+be reached, the entries are appended to the local journal file given by
+LOG_JOURNAL, and written to the database when it can be reached again.
+The log entries are the same documents as when written directly.
+"""
+
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+
+from . import settings
+from . import worker
+
+
+class LogSink(object):
+    "Queue of log entries, and the worker thread writing them in bulk."
+
+    def __init__(self, db, journal=None):
+        self.db = db
+        self.journal = journal
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()    # Held while writing.
+        self.counters_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.counters = dict(queued=0, written=0, batches=0,
+                             journaled=0, replayed=0, errors=0)
+        self.thread = None
+
+    def start(self):
+        "Write any journaled entries, and start the worker."
+        with self.lock:
+            self.replay()
+        self.thread = worker.start_thread(self.run, 'userman-logsink')
+        atexit.register(self.stop)
+
+    def add(self, entry):
+        "Queue the log entry for writing."
+        self.queue.put(entry)
+        self.count('queued')
+
+    def run(self):
+        "Write the queued entries in batches, until stopped."
+        interval = settings['LOG_FLUSH_INTERVAL'] / 1000.0
+        while not self.stopped.is_set():
+            try:
+                batch = [self.queue.get(timeout=interval)]
+            except queue.Empty:
+                continue
+            deadline = time.time() + interval
+            while len(batch) < settings['LOG_FLUSH_SIZE']:
+                timeout = deadline - time.time()
+                if timeout <= 0: break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            with self.lock:
+                self.write(batch)
+
+    def stop(self):
+        "Stop the worker, and write all queued entries."
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        size = settings['LOG_FLUSH_SIZE']
+        with self.lock:
+            for start in range(0, len(batch), size):
+                self.write(batch[start:start+size])
+
+    def write(self, entries):
+        """Write the entries to the database, or to the journal if that fails.
+        Lock must be held."""
+        try:
+            self.db.bulk_save(entries)
+        except Exception as msg:
+            logging.warning("log sink could not write %s entries: %s",
+                            len(entries), msg)
+            self.count('errors')
+            self.write_journal(entries)
+        else:
+            self.count('written', len(entries))
+            self.count('batches')
+            self.replay()
+
+    def write_journal(self, entries):
+        "Append the entries to the journal file. Lock must be held."
+        if not self.journal:
+            logging.error("log sink lost %s entries", len(entries))
+            return
+        with open(self.journal, 'a') as outfile:
+            for entry in entries:
+                outfile.write(json.dumps(entry) + '\n')
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        self.count('journaled', len(entries))
+
+    def replay(self):
+        """Write the entries in the journal file, if any, to the database.
+        Those already written fail by conflict, and are ignored.
+        Lock must be held."""
+        if not self.journal or not os.path.exists(self.journal): return
+        with open(self.journal) as infile:
+            entries = [json.loads(line) for line in infile if line.strip()]
+        size = settings['LOG_FLUSH_SIZE']
+        try:
+            for start in range(0, len(entries), size):
+                self.db.bulk_save(entries[start:start+size])
+        except Exception as msg:
+            logging.warning("log sink could not replay journal: %s", msg)
+            return
+        os.remove(self.journal)
+        self.count('replayed', len(entries))
+        logging.info("log sink replayed %s entries from journal", len(entries))
+
+    def count(self, name, value=1):
+        with self.counters_lock:
+            self.counters[name] += value
+
+    def get_counters(self):
+        "Return the counters, and the number of entries not yet written."
+        with self.counters_lock:
+            result = dict(self.counters)
+        result['queue_depth'] = self.queue.qsize()
+        return result
+
+
+_sink = worker.Singleton()
+
+def start(db):
+    "Start the process-wide log sink using the given database handle."
+    _sink.start(lambda: LogSink(db, journal=settings.get('LOG_JOURNAL')))
+
+def get_sink():
+    "Return the process-wide log sink, or None if not started."
+    return _sink.get()
+
+def add(entry):
+    "Queue the log entry if the log sink is running. Return False if not."
+    sink = _sink.get()
+    if sink is None: return False
+    sink.add(entry)
+    return True
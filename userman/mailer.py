@@ -0,0 +1,192 @@
+""" Userman: Background queue for outbound email.
+
+Messages are queued by the request handlers and sent by a worker thread
+which keeps a persistent SMTP session, sending queued messages in batches.
+Failed deliveries are retried with exponential backoff. If EMAIL_SPOOL is
+set, each message is kept as a file in that directory until delivered,
+so that undelivered mail survives a restart.
+"""
+
+import os
+import json
+import time
+import heapq
+import queue
+import smtplib
+import logging
+import threading
+
+from . import settings
+from . import utils
+from . import metrics
+from . import worker
+
+
+class Mailer(object):
+    "Queue of outbound email messages, and the worker thread sending them."
+
+    def __init__(self, spool=None):
+        self.spool = spool
+        self.queue = queue.Queue()
+        self.retries = []       # Heap of (time, iuid, message) to retry.
+        self.server = None
+        self.lock = threading.Lock()    # Held for counters and retries.
+        self.counters = dict(queued=0, sent=0, retried=0, failed=0,
+                             connections=0, send_seconds=0.0)
+        self.thread = None
+        if self.spool:
+            os.makedirs(os.path.join(self.spool, 'failed'), exist_ok=True)
+
+    def start(self):
+        "Load any undelivered messages from the spool, and start the worker."
+        if self.spool:
+            for filename in sorted(os.listdir(self.spool)):
+                if not filename.endswith('.json'): continue
+                with open(os.path.join(self.spool, filename)) as infile:
+                    self.queue.put(json.load(infile))
+            logging.info("mailer loaded %s messages from spool",
+                         self.queue.qsize())
+        self.thread = worker.start_thread(self.run, 'userman-mailer')
+
+    def enqueue(self, sender, recipients, data):
+        "Queue the message for sending. Return its identifier."
+        message = dict(iuid=utils.get_iuid(),
+                       sender=sender,
+                       recipients=recipients,
+                       data=data,
+                       attempts=0,
+                       queued=utils.timestamp())
+        self.write_spool(message)
+        self.queue.put(message)
+        self.count('queued')
+        return message['iuid']
+
+    def run(self):
+        "Send queued messages, reusing the SMTP session, forever."
+        while True:
+            timeout = settings['EMAIL_IDLE']
+            with self.lock:
+                if self.retries:
+                    timeout = max(0.0,
+                                  min(timeout, self.retries[0][0]-time.time()))
+            try:
+                batch = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < settings['EMAIL_BATCH']:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            now = time.time()
+            with self.lock:
+                while self.retries and self.retries[0][0] <= now:
+                    batch.append(heapq.heappop(self.retries)[2])
+            if not batch:
+                self.disconnect()
+            for message in batch:
+                self.deliver(message)
+
+    def deliver(self, message):
+        "Send the message; on failure, schedule a retry or give up."
+        started = time.time()
+        try:
+            self.connect().sendmail(message['sender'],
+                                    message['recipients'],
+                                    message['data'])
+        except (smtplib.SMTPException, OSError) as msg:
+            self.disconnect()
+            message['attempts'] += 1
+            message['error'] = str(msg)
+            permanent = isinstance(msg, smtplib.SMTPResponseException) and \
+                        msg.smtp_code >= 500
+            if permanent or message['attempts'] >= settings['EMAIL_MAX_ATTEMPTS']:
+                logging.error("email %s to %s failed: %s", message['iuid'],
+                              message['recipients'], msg)
+                self.fail_spool(message)
+                self.count('failed')
+            else:
+                delay = settings['EMAIL_RETRY_DELAY'] * \
+                        2 ** (message['attempts'] - 1)
+                logging.warning("email %s to %s retry in %s s: %s",
+                                message['iuid'], message['recipients'],
+                                delay, msg)
+                self.write_spool(message)
+                with self.lock:
+                    heapq.heappush(self.retries, (time.time() + delay,
+                                                  message['iuid'], message))
+                self.count('retried')
+        else:
+            logging.debug("sent email %s to %s", message['iuid'],
+                          message['recipients'])
+            self.remove_spool(message)
+            self.count('sent')
+            self.count('send_seconds', time.time() - started)
+            metrics.email_seconds.observe(time.time() - started)
+
+    def connect(self):
+        "Return the SMTP session, connecting and logging in if required."
+        if self.server is None:
+            server = smtplib.SMTP(host=settings['EMAIL']['HOST'],
+                                  port=settings['EMAIL']['PORT'],
+                                  timeout=settings['EMAIL_TIMEOUT'])
+            if settings['EMAIL'].get('TLS'):
+                server.starttls()
+            try:
+                server.login(settings['EMAIL']['ACCOUNT'],
+                             settings['EMAIL']['PASSWORD'])
+            except KeyError:
+                pass
+            self.server = server
+            self.count('connections')
+        return self.server
+
+    def disconnect(self):
+        "Close the SMTP session, if any."
+        if self.server is None: return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.server = None
+
+    def write_spool(self, message):
+        if not self.spool: return
+        filepath = os.path.join(self.spool, message['iuid'] + '.json')
+        with open(filepath + '.tmp', 'w') as outfile:
+            json.dump(message, outfile)
+        os.replace(filepath + '.tmp', filepath)
+
+    def remove_spool(self, message):
+        if not self.spool: return
+        try:
+            os.remove(os.path.join(self.spool, message['iuid'] + '.json'))
+        except OSError:
+            pass
+
+    def fail_spool(self, message):
+        "Move the message to the 'failed' subdirectory of the spool."
+        if not self.spool: return
+        self.write_spool(message)
+        filename = message['iuid'] + '.json'
+        os.replace(os.path.join(self.spool, filename),
+                   os.path.join(self.spool, 'failed', filename))
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def get_counters(self):
+        "Return the counters, and the number of messages not yet sent."
+        with self.lock:
+            result = dict(self.counters)
+            result['queue_depth'] = self.queue.qsize() + len(self.retries)
+        result['send_seconds'] = round(result['send_seconds'], 3)
+        return result
+
+
+_mailer = worker.Singleton()
+
+def get_mailer():
+    "Return the process-wide mailer, starting it if not already done."
+    return _mailer.get(lambda: Mailer(spool=settings.get('EMAIL_SPOOL')))
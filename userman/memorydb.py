@@ -0,0 +1,596 @@
+""" Userman: In-memory stand-in for the CouchDB database.
+
+Implements the CloudantDatabaseWrapper interface in the process, so that
+the application, tests and benchmarks run without a database server:
+documents with revisions and update conflicts, deletion, '_all_docs',
+attachments, the changes feed, and the views of 'designs' evaluated by
+Python equivalents of their map and reduce functions. The keys of the
+views are ordered according to the CouchDB collation, approximated
+for strings by case-insensitive order with lowercase first.
+
+Each Python view records the fingerprint of the JavaScript code which
+it is equivalent to; 'check_views' reports the views whose code in
+'designs' has changed, or which have no Python equivalent.
+
+Selected by DB_BACKEND 'memory'. The contents are lost on exit.
+"""
+
+import os
+import re
+import copy
+import time
+import uuid
+import bisect
+import hashlib
+import threading
+import collections
+
+import ibm_cloud_sdk_core
+
+from . import constants
+from . import utils
+
+
+def get_fingerprint(code):
+    "Return the fingerprint of the JavaScript code, ignoring comments."
+    code = re.sub(r'/\*.*?\*/', '', code, flags=re.DOTALL)
+    code = re.sub(r'//[^\n]*', '', code)
+    code = ' '.join(code.split())
+    return hashlib.sha1(code.encode('utf-8')).hexdigest()[:12]
+
+def is_doctype(doc, doctype):
+    return doc.get(constants.DB_DOCTYPE) == doctype
+
+# The Python equivalents of the map functions. Each yields (key, value).
+
+def log_doc(doc):
+    if not is_doctype(doc, constants.LOG): return
+    yield doc.get('doc'), doc.get('timestamp')
+
+def log_doc_timestamp(doc):
+    if not is_doctype(doc, constants.LOG): return
+    yield [doc.get('doc'), doc.get('timestamp')], None
+
+def log_doctype(doc):
+    if not is_doctype(doc, constants.LOG): return
+    yield [doc.get('doctype'), doc.get('timestamp')], None
+
+def log_operator(doc):
+    if not is_doctype(doc, constants.LOG): return
+    if doc.get('operator'):
+        yield [doc['operator'], doc.get('timestamp')], None
+
+def log_timestamp(doc):
+    if not is_doctype(doc, constants.LOG): return
+    yield doc.get('timestamp'), None
+
+def service_name(doc):
+    if not is_doctype(doc, constants.SERVICE): return
+    yield doc.get('name'), None
+
+def service_public(doc):
+    if not is_doctype(doc, constants.SERVICE): return
+    if not doc.get('public'): return
+    yield doc.get('name'), None
+
+def team_leader(doc):
+    if not is_doctype(doc, constants.TEAM): return
+    for leader in doc.get('leaders') or []:
+        yield leader, doc.get('name')
+
+def team_name(doc):
+    if not is_doctype(doc, constants.TEAM): return
+    yield doc.get('name'), None
+
+def user_blocked(doc):
+    if not is_doctype(doc, constants.USER): return
+    if doc.get('status') == constants.BLOCKED:
+        yield doc.get('modified'), None
+
+def user_email(doc):
+    if not is_doctype(doc, constants.USER): return
+    yield doc.get('email'), None
+
+def user_count(doc):
+    if not is_doctype(doc, constants.USER): return
+    if not doc.get('status'): return
+    yield doc['status'], 1
+
+def user_pending(doc):
+    if not is_doctype(doc, constants.USER): return
+    if doc.get('status') == constants.PENDING:
+        yield doc.get('modified'), None
+
+def user_revoked(doc):
+    if not is_doctype(doc, constants.USER): return
+    if doc.get('status') == constants.BLOCKED:
+        yield doc.get('revoked') or doc.get('modified'), doc.get('email')
+    elif doc.get('status') == constants.APPROVED and doc.get('revoked'):
+        yield doc['revoked'], doc.get('email')
+
+def user_role(doc):
+    if not is_doctype(doc, constants.USER): return
+    yield doc.get('role'), None
+
+def user_service(doc):
+    if not is_doctype(doc, constants.USER): return
+    if doc.get('status') != constants.ACTIVE: return
+    for service in doc.get('services') or []:
+        yield [service, doc.get('email')], None
+
+def user_status_email(doc):
+    if not is_doctype(doc, constants.USER): return
+    yield [doc.get('status'), doc.get('email')], None
+
+def user_status_modified(doc):
+    if not is_doctype(doc, constants.USER): return
+    yield [doc.get('status'), doc.get('modified')], None
+
+def user_team(doc):
+    if not is_doctype(doc, constants.USER): return
+    for team in doc.get('teams') or []:
+        yield team, doc.get('email')
+
+def user_team_email(doc):
+    if not is_doctype(doc, constants.USER): return
+    for team in doc.get('teams') or []:
+        yield [team, doc.get('email')], None
+
+def user_username(doc):
+    if not is_doctype(doc, constants.USER): return
+    if doc.get('username'):
+        yield doc['username'], None
+
+# View name -> (map function, fingerprint of its JavaScript code,
+#               reduce function name, or None).
+VIEWS = {
+    'log/doc': (log_doc, 'f295818f1f9e', None),
+    'log/doc_timestamp': (log_doc_timestamp, '4d5b49ad26f3', None),
+    'log/doctype': (log_doctype, '794cfa884b2e', None),
+    'log/operator': (log_operator, 'e851f04e6f1d', None),
+    'log/timestamp': (log_timestamp, 'e12411459e70', None),
+    'service/name': (service_name, '6d12d3eb3814', None),
+    'service/public': (service_public, '704f7638fb34', None),
+    'team/leader': (team_leader, '875e7dd11bf0', None),
+    'team/name': (team_name, 'bd4c056a70b3', None),
+    'user/blocked': (user_blocked, '50b001515c24', None),
+    'user/count': (user_count, '2d878c74b54f', '_count'),
+    'user/email': (user_email, '2586108c8ba5', None),
+    'user/pending': (user_pending, '36f5d9765d65', None),
+    'user/revoked': (user_revoked, '769b75870079', None),
+    'user/role': (user_role, 'c24e9393a54d', None),
+    'user/service': (user_service, '47bdca013271', None),
+    'user/status_email': (user_status_email, '970b07b9f1b4', None),
+    'user/status_modified': (user_status_modified, '5283ece89218', None),
+    'user/team': (user_team, 'fae84df02a42', None),
+    'user/team_email': (user_team_email, '67ead07e1535', None),
+    'user/username': (user_username, 'd301caff5017', None),
+    }
+
+def check_views(root=None):
+    """Return the list of problems with the Python views: the views in
+    'designs' whose code has changed since its Python equivalent was
+    written, those having no Python equivalent, and vice versa."""
+    root = root or os.path.join(os.path.dirname(__file__), 'designs')
+    result = []
+    found = set()
+    for design in sorted(os.listdir(root)):
+        path = os.path.join(root, design, 'views')
+        if not os.path.isdir(path): continue
+        for filename in sorted(os.listdir(path)):
+            name, ext = os.path.splitext(filename)
+            if ext != '.js': continue
+            with open(os.path.join(path, filename)) as codefile:
+                code = codefile.read()
+            if name.startswith('reduce_'):
+                viewname = "{0}/{1}".format(design, name[len('reduce_'):])
+                if viewname in VIEWS and VIEWS[viewname][2] != code.strip():
+                    result.append("view {0}: reduce differs".format(viewname))
+                continue
+            if name.startswith('map_'):
+                name = name[len('map_'):]
+            viewname = "{0}/{1}".format(design, name)
+            found.add(viewname)
+            try:
+                fingerprint = VIEWS[viewname][1]
+            except KeyError:
+                result.append("view {0}: no Python equivalent".format(viewname))
+                continue
+            if get_fingerprint(code) != fingerprint:
+                result.append("view {0}: code changed; fingerprint {1}".format(
+                    viewname, get_fingerprint(code)))
+    for viewname in sorted(set(VIEWS).difference(found)):
+        result.append("view {0}: not in designs".format(viewname))
+    return result
+
+
+def get_collation_key(value):
+    """Return the sort key for the value according to the CouchDB collation:
+    null, false, true, numbers, strings, arrays, objects."""
+    if value is None:
+        return (0, )
+    if value is False:
+        return (1, )
+    if value is True:
+        return (2, )
+    if isinstance(value, (int, float)):
+        return (3, value)
+    if isinstance(value, str):
+        return (4, value.casefold(), value.swapcase())
+    if isinstance(value, (list, tuple)):
+        return (5, tuple([get_collation_key(v) for v in value]))
+    if isinstance(value, dict):
+        return (6, tuple([(get_collation_key(k), get_collation_key(v))
+                          for k, v in value.items()]))
+    raise ValueError("cannot collate {0!r}".format(value))
+
+def is_selected(doc, selector):
+    """Does the document match the selector? Handles field equality,
+    '$eq', '$ne', '$in', '$exists', '$and' and '$or'."""
+    for field, condition in selector.items():
+        if field == '$and':
+            if not all([is_selected(doc, s) for s in condition]): return False
+            continue
+        if field == '$or':
+            if not any([is_selected(doc, s) for s in condition]): return False
+            continue
+        value = doc
+        for part in field.split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        if not isinstance(condition, dict):
+            condition = {'$eq': condition}
+        for operator, operand in condition.items():
+            if operator == '$eq' and value != operand: return False
+            if operator == '$ne' and value == operand: return False
+            if operator == '$in' and value not in operand: return False
+            if operator == '$exists' and (value is not None) != operand:
+                return False
+    return True
+
+def get_error(code, message):
+    return ibm_cloud_sdk_core.ApiException(code, message=message)
+
+
+class MemoryDatabase(object):
+    """In-memory implementation of the CloudantDatabaseWrapper interface.
+    The documents given and returned are copies. Thread-safe.
+    The index entries of a view are (sort key, id, number, key, value)."""
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.lock = threading.Condition()   # Notified on every update.
+        self.docs = dict()          # id -> doc; deleted are tombstones
+        self.attachments = dict()   # (id, name) -> bytes
+        self.seqs = collections.OrderedDict() # id -> update seq; in seq order
+        self.seq = 0
+        self.indexes = dict()       # view name -> sorted index entries
+        self.emitted = dict()       # view name -> id -> list of index entries
+        for viewname in VIEWS:
+            self.indexes[viewname] = []
+            self.emitted[viewname] = dict()
+
+    def get_doc(self, doc_id):
+        "Return the current document. Lock must be held."
+        doc = self.docs.get(doc_id)
+        if doc is None:
+            raise get_error(404, 'missing')
+        if doc.get('_deleted'):
+            raise get_error(404, 'deleted')
+        return doc
+
+    def __getitem__(self, doc_id):
+        "Mimics db['doc_id']"
+        with self.lock:
+            return copy.deepcopy(self.get_doc(doc_id))
+
+    def get_rev(self, doc_id):
+        "Return the current revision of the document."
+        with self.lock:
+            return self.get_doc(doc_id)['_rev']
+
+    def __iter__(self):
+        "Make the database iterable by document IDs"
+        for row in self.all_docs():
+            yield row['id']
+
+    def all_docs(self, **options):
+        """Return the rows of '_all_docs'; ordered by id, not collated.
+        The options 'key', 'keys', 'start_key', 'end_key', 'descending',
+        'skip', 'limit' and 'include_docs' are handled."""
+        with self.lock:
+            docs = [d for d in self.docs.values() if not d.get('_deleted')]
+            entries = [(d['_id'], d['_id'], 0, d['_id'], dict(rev=d['_rev']))
+                       for d in sorted(docs, key=lambda d: d['_id'])]
+            return self.query(entries, options)
+
+    def view(self, viewname, **options):
+        """Mimics db.view(...); the CouchDB view query options are handled,
+        including 'reduce', 'group' and 'group_level'."""
+        try:
+            map_func, fingerprint, reduce_func = VIEWS[viewname]
+        except KeyError:
+            raise get_error(404, "no view {0}".format(viewname))
+        with self.lock:
+            entries = self.indexes[viewname]
+            if reduce_func and options.get('reduce', True) and \
+               not options.get('include_docs'):
+                rows = self.query(entries, options, collate=True, reduce=True)
+                return self.reduce(rows, options)
+            return self.query(entries, options, collate=True)
+
+    def query(self, entries, options, collate=False, reduce=False):
+        "Return the rows of the sorted index entries. Lock must be held."
+        sortkey = get_collation_key if collate else lambda k: k
+        if 'keys' in options:
+            rows = []
+            for key in options['keys']:
+                rows.extend(self.select(entries, dict(options, key=key),
+                                        sortkey))
+        else:
+            rows = self.select(entries, options, sortkey)
+        if not reduce:
+            skip = options.get('skip', 0)
+            rows = rows[skip:]
+            if options.get('limit') is not None:
+                rows = rows[:options['limit']]
+        result = []
+        for key, doc_id, value in rows:
+            row = dict(id=doc_id, key=key, value=value)
+            if options.get('include_docs'):
+                doc = self.docs.get(doc_id)
+                row['doc'] = None if doc is None or doc.get('_deleted') \
+                             else copy.deepcopy(doc)
+            result.append(row)
+        return result
+
+    def select(self, entries, options, sortkey):
+        "Return the (key, id, value) in the range. Lock must be held."
+        descending = options.get('descending', False)
+        if 'key' in options:
+            low = high = options['key']
+            low_id = high_id = None
+            inclusive = True
+        else:
+            low = options.get('start_key', options.get('startkey'))
+            high = options.get('end_key', options.get('endkey'))
+            low_id = options.get('start_key_doc_id')
+            high_id = options.get('end_key_doc_id')
+            inclusive = options.get('inclusive_end', True)
+            if descending:
+                low, high = high, low
+                low_id, high_id = high_id, low_id
+        if ('key' in options or low is not None) and entries:
+            start = bisect.bisect_left(entries, (sortkey(low), low_id or ''))
+        else:
+            start = 0
+        if 'key' in options or high is not None:
+            if high_id is None:
+                end = bisect.bisect_right(entries, (sortkey(high), '\uffff'))
+            else:
+                end = bisect.bisect_right(entries,
+                                          (sortkey(high), high_id + '\x00'))
+        else:
+            end = len(entries)
+        selected = entries[start:end]
+        if not inclusive and high is not None:
+            if descending:
+                selected = [e for e in selected if e[0] != sortkey(low)]
+            else:
+                selected = [e for e in selected if e[0] != sortkey(high)]
+        if descending:
+            selected.reverse()
+        return [(e[3], e[1], copy.deepcopy(e[4])) for e in selected]
+
+    def reduce(self, rows, options):
+        "Return the rows reduced by '_count', optionally grouped."
+        level = options.get('group_level')
+        if options.get('group') or level is not None:
+            groups = []
+            for row in rows:
+                key = row['key']
+                if level is not None and isinstance(key, list):
+                    key = key[:level]
+                if groups and groups[-1]['key'] == key:
+                    groups[-1]['value'] += 1
+                else:
+                    groups.append(dict(key=key, value=1))
+            return groups
+        if not rows: return []
+        return [dict(key=None, value=len(rows))]
+
+    def view_docs(self, viewname, keys):
+        """Return the documents for the given keys in the view, in one
+        multi-key request, as a dict keyed by view key. Missing keys are absent."""
+        rows = self.view(viewname, keys=list(keys), include_docs=True)
+        return utils.get_view_docs(rows)
+
+    def save(self, document):
+        "Mimics db.save(doc)"
+        if '_id' not in document:
+            document['_id'] = uuid.uuid4().hex
+        with self.lock:
+            result = self.put(copy.deepcopy(document))
+        if 'error' in result:
+            raise get_error(409, result['reason'])
+        document['_rev'] = result['rev']
+        return dict(ok=True, id=result['id'], rev=result['rev'])
+
+    def bulk_save(self, documents):
+        """Save the documents, as by '_bulk_docs'.
+        Return the list of results, in the same order as the documents;
+        each has 'id', and either 'rev', or 'error' and 'reason'."""
+        for document in documents:
+            if '_id' not in document:
+                document['_id'] = uuid.uuid4().hex
+        with self.lock:
+            results = [self.put(copy.deepcopy(d)) for d in documents]
+        return utils.set_bulk_saved(documents, results)
+
+    def delete(self, document):
+        "Mimics db.delete(doc)"
+        if '_id' not in document or '_rev' not in document:
+            raise ValueError("Document must have '_id' and '_rev' to be deleted")
+        with self.lock:
+            result = self.put(dict(_id=document['_id'],
+                                   _rev=document['_rev'],
+                                   _deleted=True))
+        if 'error' in result:
+            raise get_error(409 if result['error'] == 'conflict' else 404,
+                            result['reason'])
+        return dict(ok=True, id=result['id'], rev=result['rev'])
+
+    def put(self, doc):
+        """Store the document, if its revision is the current one.
+        Return the result as for '_bulk_docs'. Lock must be held."""
+        doc_id = doc['_id']
+        current = self.docs.get(doc_id)
+        if current is None or current.get('_deleted'):
+            if doc.get('_deleted'):
+                return dict(id=doc_id, error='not_found', reason='missing')
+            if doc.get('_rev') not in (None, current and current['_rev']):
+                return dict(id=doc_id, error='conflict',
+                            reason='Document update conflict.')
+        elif doc.get('_rev') != current['_rev']:
+            return dict(id=doc_id, error='conflict',
+                        reason='Document update conflict.')
+        number = int(current['_rev'].split('-')[0]) if current else 0
+        doc['_rev'] = "{0}-{1}".format(number + 1, uuid.uuid4().hex)
+        # As in CouchDB, a tombstone keeps any fields given on deletion.
+        # Attachments not given as stubs in the new revision are dropped.
+        stubs = doc.get('_attachments') or dict()
+        for key in [k for k in self.attachments
+                    if k[0] == doc_id and k[1] not in stubs]:
+            del self.attachments[key]
+        self.docs[doc_id] = doc
+        self.seq += 1
+        self.seqs.pop(doc_id, None)
+        self.seqs[doc_id] = self.seq
+        self.update_indexes(doc)
+        self.lock.notify_all()
+        return dict(ok=True, id=doc_id, rev=doc['_rev'])
+
+    def update_indexes(self, doc):
+        "Update the view indexes for the document. Lock must be held."
+        doc_id = doc['_id']
+        for viewname, (map_func, fingerprint, reduce_func) in VIEWS.items():
+            index = self.indexes[viewname]
+            for entry in self.emitted[viewname].pop(doc_id, []):
+                pos = bisect.bisect_left(index, entry)
+                if pos < len(index) and index[pos] is entry:
+                    del index[pos]
+                else:
+                    index.remove(entry)
+            if doc.get('_deleted') or doc_id.startswith('_design/'): continue
+            emitted = []
+            for number, (key, value) in enumerate(map_func(doc)):
+                entry = (get_collation_key(key), doc_id, number, key, value)
+                bisect.insort(index, entry)
+                emitted.append(entry)
+            if emitted:
+                self.emitted[viewname][doc_id] = emitted
+
+    def changes(self, **options):
+        """Return the changes feed result; a dict with 'results', 'last_seq'
+        and 'pending'. The options 'since', 'feed' ('normal' or 'longpoll'),
+        'timeout', 'limit', 'include_docs', and 'filter' '_selector' with
+        'selector' or '_doc_ids' with 'doc_ids' are handled."""
+        since = options.get('since') or 0
+        deadline = time.time() + options.get('timeout', 60000) / 1000.0
+        with self.lock:
+            if since == 'now':
+                since = self.seq
+            else:
+                since = int(str(since).split('-')[0])
+            while True:
+                ids = []
+                for doc_id in reversed(self.seqs):
+                    if self.seqs[doc_id] <= since: break
+                    ids.append(doc_id)
+                ids.reverse()
+                if options.get('filter') == '_selector':
+                    ids = [i for i in ids
+                           if is_selected(self.docs[i], options['selector'])]
+                elif options.get('filter') == '_doc_ids':
+                    ids = [i for i in ids if i in options['doc_ids']]
+                if ids or options.get('feed') != 'longpoll': break
+                timeout = deadline - time.time()
+                if timeout <= 0: break
+                self.lock.wait(timeout)
+            limit = options.get('limit')
+            pending = max(0, len(ids) - limit) if limit else 0
+            if limit:
+                ids = ids[:limit]
+            results = []
+            for doc_id in ids:
+                doc = self.docs[doc_id]
+                change = dict(seq=self.get_seq(self.seqs[doc_id]),
+                              id=doc_id,
+                              changes=[dict(rev=doc['_rev'])])
+                if doc.get('_deleted'):
+                    change['deleted'] = True
+                if options.get('include_docs'):
+                    change['doc'] = copy.deepcopy(doc)
+                results.append(change)
+            # The sequence is the current one, unless more are pending.
+            last_seq = self.seqs[ids[-1]] if pending else self.seq
+            return dict(results=results,
+                        last_seq=self.get_seq(last_seq),
+                        pending=pending)
+
+    def get_seq(self, number):
+        "Return the opaque sequence token for the update sequence number."
+        return "{0}-memory".format(number)
+
+    def info(self):
+        "Return the database information, such as 'update_seq'."
+        with self.lock:
+            deleted = len([d for d in self.docs.values() if d.get('_deleted')])
+            return dict(db_name=self.db_name,
+                        doc_count=len(self.docs) - deleted,
+                        doc_del_count=deleted,
+                        update_seq=self.get_seq(self.seq))
+
+    def get_attachment(self, doc_id, attachment_name):
+        "Get an attachment from a document, as bytes."
+        with self.lock:
+            self.get_doc(doc_id)
+            try:
+                return self.attachments[(doc_id, attachment_name)]
+            except KeyError:
+                raise get_error(404, 'missing attachment')
+
+    def put_attachment(self, doc_id, data, attachment_name, content_type, rev):
+        "Put an attachment to a document; creates a new revision."
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        elif not isinstance(data, bytes):
+            data = data.read()
+        with self.lock:
+            doc = copy.deepcopy(self.get_doc(doc_id))
+            if doc['_rev'] != rev:
+                raise get_error(409, 'Document update conflict.')
+            stubs = doc.setdefault('_attachments', dict())
+            stubs[attachment_name] = dict(
+                content_type=content_type,
+                length=len(data),
+                digest='md5-' + hashlib.md5(data).hexdigest(),
+                revpos=int(rev.split('-')[0]) + 1,
+                stub=True)
+            self.attachments[(doc_id, attachment_name)] = data
+            result = self.put(doc)
+        return result
+
+
+# The process-wide in-memory databases, one per database name.
+_databases = dict()
+_databases_lock = threading.Lock()
+
+def get_database(db_name):
+    "Return the in-memory database of the given name; created if none."
+    with _databases_lock:
+        try:
+            return _databases[db_name]
+        except KeyError:
+            db = MemoryDatabase(db_name)
+            _databases[db_name] = db
+            return db
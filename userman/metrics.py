@@ -0,0 +1,172 @@
+""" Userman: Metrics in the Prometheus text exposition format.
+
+Counters and histograms are kept in memory by the process, and are
+rendered as text by the '/metrics' handler; no client library is needed.
+Request latency is recorded per route, i.e. URL name, and database
+calls per operation and view, as made by the request handlers.
+"""
+
+import bisect
+import threading
+
+
+# Upper bounds of the histogram buckets. Unit: seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def get_labels(names, values):
+    "Return the label set as text: '{name=\"value\",...}', or empty."
+    if not names: return ''
+    items = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        value = value.replace('\n', '\\n')
+        items.append('{0}="{1}"'.format(name, value))
+    return '{' + ','.join(items) + '}'
+
+def get_reason(reason):
+    """Return the reason for failure as a label value: the text before any
+    quoted value or detail, to keep the number of label values bounded."""
+    return (reason or '').split("'")[0].split(':')[0].strip() or 'unknown'
+
+
+class Counter(object):
+    "Counter per label values."
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = dict()    # label values -> value
+
+    def inc(self, *values, amount=1):
+        with self.lock:
+            self.values[values] = self.values.get(values, 0) + amount
+
+    def get_lines(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return ["{0}{1} {2}".format(self.name, get_labels(self.labels, v), n)
+                for v, n in items]
+
+
+class Histogram(object):
+    "Histogram of observed values per label values."
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.values = dict()    # label values -> [bucket counts, sum, count]
+
+    def init(self, *values):
+        "Create the series for the label values, so that it is reported."
+        with self.lock:
+            self.values.setdefault(values, [[0] * len(self.buckets), 0.0, 0])
+
+    def observe(self, value, *values):
+        pos = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.setdefault(
+                values, [[0] * len(self.buckets), 0.0, 0])
+            if pos < len(self.buckets):
+                series[0][pos] += 1
+            series[1] += value
+            series[2] += 1
+
+    def get_lines(self):
+        with self.lock:
+            items = sorted([(v, (list(s[0]), s[1], s[2]))
+                            for v, s in self.values.items()])
+        result = []
+        labels = self.labels + ('le', )
+        for values, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                result.append("{0}_bucket{1} {2}".format(
+                    self.name, get_labels(labels, values + (bound, )),
+                    cumulative))
+            result.append("{0}_bucket{1} {2}".format(
+                self.name, get_labels(labels, values + ('+Inf', )), count))
+            result.append("{0}_sum{1} {2}".format(
+                self.name, get_labels(self.labels, values), total))
+            result.append("{0}_count{1} {2}".format(
+                self.name, get_labels(self.labels, values), count))
+        return result
+
+
+request_seconds = Histogram('userman_http_request_duration_seconds',
+                            'Time to handle a request, per route.',
+                            labels=('route', ))
+requests = Counter('userman_http_requests_total',
+                   'Number of requests handled, per route and status code.',
+                   labels=('route', 'code'))
+db_seconds = Histogram('userman_db_call_duration_seconds',
+                       'Time of database calls, per operation and view.',
+                       labels=('op', 'view'))
+db_calls = Counter('userman_db_calls_total',
+                   'Number of database calls, per operation and view.',
+                   labels=('op', 'view'))
+auth = Counter('userman_auth_total',
+               'Number of API authentications, per route, result and reason.',
+               labels=('route', 'result', 'reason'))
+email_seconds = Histogram('userman_email_send_duration_seconds',
+                          'Time to send an email message.')
+email_seconds.init()
+
+_routes = dict()        # handler class -> route name
+
+def set_routes(handlers):
+    "Record the route name for each handler class, and report them all."
+    for spec in handlers:
+        if not spec.name: continue
+        _routes[spec.handler_class] = spec.name
+        request_seconds.init(spec.name)
+
+def get_route(handler):
+    "Return the route name for the request handler, or None if none."
+    return _routes.get(type(handler))
+
+def observe_request(handler):
+    "Record the duration and status of the request."
+    route = get_route(handler)
+    if route is None: return
+    request_seconds.observe(handler.request.request_time(), route)
+    requests.inc(route, handler.get_status())
+
+def observe_db(op, view, seconds):
+    "Record the duration of the database call."
+    db_seconds.observe(seconds, op, view)
+    db_calls.inc(op, view)
+
+def count_auth(handler, reason=None):
+    "Count the authentication; failed if a reason is given."
+    if reason is None:
+        auth.inc(get_route(handler), 'success', '')
+    else:
+        auth.inc(get_route(handler), 'failure', get_reason(reason))
+
+def get_text(extra=()):
+    """Return all metrics as text, with the given metrics appended;
+    a list of (name, type, help, labels, [(label values, value)])."""
+    lines = []
+    for metric in [request_seconds, requests, db_seconds, db_calls, auth,
+                   email_seconds]:
+        lines.append("# HELP {0} {1}".format(metric.name, metric.help))
+        lines.append("# TYPE {0} {1}".format(metric.name, metric.type))
+        lines.extend(metric.get_lines())
+    for name, type, help, labels, values in extra:
+        lines.append("# HELP {0} {1}".format(name, help))
+        lines.append("# TYPE {0} {1}".format(name, type))
+        for label_values, value in values:
+            lines.append("{0}{1} {2}".format(
+                name, get_labels(labels, label_values), value))
+    return '\n'.join(lines) + '\n'
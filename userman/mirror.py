@@ -0,0 +1,227 @@
+""" Userman: In-memory mirror of the user, team and service documents.
+
+Loaded once at startup, then kept current by following the CouchDB
+'_changes' feed in a background thread. Lookups are answered from memory;
+a miss should be checked against the database, since the mirror may lag.
+"""
+
+import copy
+import time
+import logging
+import threading
+
+from . import constants
+from . import settings
+from . import search
+from . import worker
+
+
+def rev_generation(doc):
+    "Return the generation number of the document revision."
+    try:
+        return int(doc['_rev'].split('-')[0])
+    except (KeyError, ValueError):
+        return 0
+
+def seq_number(seq):
+    "Return the numeric part of a CouchDB update sequence."
+    try:
+        return int(str(seq).split('-')[0])
+    except ValueError:
+        return 0
+
+
+class Mirror(object):
+    "In-memory index of user, team and service documents."
+
+    doctypes = (constants.USER, constants.TEAM, constants.SERVICE)
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.docs = dict()      # id -> doc
+        self.users = dict()     # email or username -> id
+        self.teams = dict()     # name -> id
+        self.services = dict()  # name -> id
+        self.members = dict()   # team name -> set of member emails
+        self.search = search.SearchIndex()
+        self.seq = None
+        self.pending = 0
+        self.synced = None
+        self.counters = dict(hits=0, misses=0, changes=0, errors=0)
+        self.thread = None
+
+    def load(self):
+        "Load all user, team and service documents."
+        seq = self.db.info()['update_seq']
+        with self.lock:
+            for viewname in ['user/email', 'team/name', 'service/name']:
+                for row in self.db.view(viewname, include_docs=True):
+                    self.set_doc(row['doc'])
+            self.seq = seq
+            self.synced = time.time()
+        logging.info("mirror loaded %s documents", len(self.docs))
+
+    def start(self):
+        "Load the documents, and start following the changes feed."
+        self.load()
+        self.thread = worker.start_thread(self.follow, 'userman-mirror')
+
+    def follow(self):
+        "Apply the changes from the database, forever."
+        while True:
+            try:
+                result = self.db.changes(
+                    since=self.seq,
+                    feed='longpoll',
+                    include_docs=True,
+                    limit=settings['MIRROR_BATCH'],
+                    timeout=int(settings['MIRROR_TIMEOUT'] * 1000))
+            except Exception as msg:
+                logging.warning("mirror changes feed error: %s", msg)
+                self.counters['errors'] += 1
+                time.sleep(settings['MIRROR_TIMEOUT'] / 10.0)
+                continue
+            self.apply(result)
+
+    def apply(self, result):
+        "Apply the changes feed result."
+        with self.lock:
+            for change in result.get('results', []):
+                self.counters['changes'] += 1
+                if change.get('deleted'):
+                    self.remove_doc(change['id'])
+                elif change.get('doc', {}).get(constants.DB_DOCTYPE) \
+                     in self.doctypes:
+                    self.set_doc(change['doc'])
+            self.seq = result['last_seq']
+            self.pending = result.get('pending', 0)
+            self.synced = time.time()
+
+    def update(self, doc):
+        "Update with a document just saved in this process."
+        if doc.get(constants.DB_DOCTYPE) not in self.doctypes: return
+        with self.lock:
+            self.set_doc(copy.deepcopy(doc))
+
+    def set_doc(self, doc):
+        "Set the document in the indexes, unless older. Lock must be held."
+        try:
+            old = self.docs[doc['_id']]
+        except KeyError:
+            pass
+        else:
+            if rev_generation(old) > rev_generation(doc): return
+            self.remove_doc(doc['_id'])
+        self.docs[doc['_id']] = doc
+        doctype = doc[constants.DB_DOCTYPE]
+        if doctype == constants.USER:
+            self.users[doc['email']] = doc['_id']
+            if doc.get('username'):
+                self.users[doc['username']] = doc['_id']
+            for name in doc.get('teams', []):
+                self.members.setdefault(name, set()).add(doc['email'])
+            self.search.add(doc)
+        elif doctype == constants.TEAM:
+            self.teams[doc['name']] = doc['_id']
+        elif doctype == constants.SERVICE:
+            self.services[doc['name']] = doc['_id']
+
+    def remove_doc(self, id):
+        "Remove the document from the indexes. Lock must be held."
+        try:
+            doc = self.docs.pop(id)
+        except KeyError:
+            return
+        doctype = doc[constants.DB_DOCTYPE]
+        if doctype == constants.USER:
+            for key in [doc['email'], doc.get('username')]:
+                if self.users.get(key) == id:
+                    del self.users[key]
+            for name in doc.get('teams', []):
+                self.members.get(name, set()).discard(doc['email'])
+            self.search.remove(doc['email'])
+        elif doctype == constants.TEAM:
+            if self.teams.get(doc['name']) == id:
+                del self.teams[doc['name']]
+        elif doctype == constants.SERVICE:
+            if self.services.get(doc['name']) == id:
+                del self.services[doc['name']]
+
+    def lookup(self, index, key):
+        "Return a copy of the document in the given index, or None."
+        with self.lock:
+            try:
+                doc = copy.deepcopy(self.docs[index[key]])
+            except KeyError:
+                self.counters['misses'] += 1
+                return None
+            self.counters['hits'] += 1
+            return doc
+
+    def get_rev(self, id):
+        "Return the revision of the document given by id, or None."
+        with self.lock:
+            try:
+                rev = self.docs[id]['_rev']
+            except KeyError:
+                self.counters['misses'] += 1
+                return None
+            self.counters['hits'] += 1
+            return rev
+
+    def get_user(self, name):
+        "Return the user document given by email or username, or None."
+        return self.lookup(self.users, name)
+
+    def get_team(self, name):
+        "Return the team document given by name, or None."
+        return self.lookup(self.teams, name)
+
+    def get_service(self, name):
+        "Return the service document given by name, or None."
+        return self.lookup(self.services, name)
+
+    def get_admins(self):
+        "Return the active admin user documents."
+        with self.lock:
+            self.counters['hits'] += 1
+            return [copy.deepcopy(d) for d in self.docs.values()
+                    if d[constants.DB_DOCTYPE] == constants.USER and
+                    d.get('role') == constants.ADMIN and
+                    d.get('status') == constants.ACTIVE]
+
+    def get_members(self, name):
+        "Return the emails of the members of the team given by name."
+        with self.lock:
+            self.counters['hits'] += 1
+            return sorted(self.members.get(name, []))
+
+    def search_users(self, prefix, limit):
+        """Return the user documents having a search term beginning
+        with the prefix; at most 'limit' of them."""
+        with self.lock:
+            self.counters['hits'] += 1
+            return [copy.deepcopy(self.docs[self.users[email]])
+                    for email in self.search.search(prefix, limit)]
+
+    def get_counters(self):
+        "Return the counters, and the lag behind the database."
+        with self.lock:
+            result = dict(self.counters)
+            result['documents'] = len(self.docs)
+            result['seq'] = seq_number(self.seq)
+            result['lag_changes'] = self.pending
+            result['seconds_since_sync'] = round(time.time() - self.synced, 3)
+        return result
+
+
+_mirror = worker.Singleton()
+
+def start(db):
+    "Start the process-wide mirror using the given database handle."
+    _mirror.start(lambda: Mirror(db))
+
+def get_mirror():
+    "Return the process-wide mirror, or None if not started."
+    return _mirror.get()
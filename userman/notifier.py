@@ -0,0 +1,303 @@
+""" Userman: Push notifications of changes to services.
+
+Follows the CouchDB '_changes' feed for user, team and service documents
+in a background thread, polling for at most NOTIFY_FEED_BATCH changes
+with a timeout of NOTIFY_FEED_TIMEOUT seconds, and queues a notification
+item for each service having a 'notify_href' which is concerned: for a
+user, the services enabled for the account before or after the change;
+for a team, all services; for a service, the service itself. When a user
+document is deleted, an item with only 'doctype', 'iuid' and 'deleted'
+is queued for the services that were enabled for the account.
+
+Each service has an outbox of items keyed by document, so that rapid
+successive changes to the same document are coalesced into one item.
+The outbox is sent when its oldest item is NOTIFY_DELAY seconds old, as
+a batch of at most NOTIFY_BATCH items in one POST of JSON data to the
+'notify_href' of the service. The body is signed using HMAC-SHA256 with
+NOTIFY_SECRET; the hex digest is in the header 'X-Userman-Signature'.
+At most NOTIFY_CONCURRENCY requests are in progress at any time.
+Failed requests are retried with exponential backoff.
+
+If NOTIFY_OUTBOX is set, the outboxes and the feed sequence are kept as
+files in that directory, so that no notification is lost on restart.
+The services enabled for each account are not kept; on restart they are
+read from the database. For the accounts changed after the saved sequence,
+the services before the change are unknown, so all the services which
+have been granted to the account are notified. A user document deleted
+while not running is not notified, since its services are unknown.
+"""
+
+import os
+import hmac
+import json
+import time
+import hashlib
+import logging
+import threading
+import collections
+import urllib.request
+import concurrent.futures
+
+from . import constants
+from . import settings
+from . import worker
+
+
+def get_item(doc):
+    "Return the notification item for the document."
+    doctype = doc[constants.DB_DOCTYPE]
+    item = dict(doctype=doctype,
+                iuid=doc['_id'],
+                status=doc.get('status'),
+                modified=doc.get('modified'))
+    if doctype == constants.USER:
+        item['email'] = doc['email']
+        item['username'] = doc.get('username')
+        item['role'] = doc.get('role')
+        item['teams'] = doc.get('teams', [])
+    else:
+        item['name'] = doc['name']
+    if doctype == constants.TEAM:
+        item['leaders'] = doc.get('leaders', [])
+    return item
+
+def get_signature(body):
+    "Return the HMAC-SHA256 hex digest of the body."
+    return hmac.new(settings['NOTIFY_SECRET'].encode('utf-8'),
+                    body,
+                    hashlib.sha256).hexdigest()
+
+
+class Notifier(object):
+    "Outboxes of notifications to services, and the threads sending them."
+
+    doctypes = (constants.USER, constants.TEAM, constants.SERVICE)
+
+    def __init__(self, db, outbox=None):
+        self.db = db
+        self.outbox = outbox
+        self.hrefs = dict()         # service name -> notify_href
+        self.user_services = dict() # user id -> set of service names
+        self.outboxes = dict()      # service name -> OrderedDict iuid -> item
+        self.queued = dict()        # service name -> time of oldest item
+        self.retries = dict()       # service name -> (attempts, time)
+        self.sending = set()        # service names with request in progress
+        self.seq = None
+        self.condition = threading.Condition()
+        self.executor = None
+        self.counters = dict(changes=0, items=0, coalesced=0, sent=0,
+                             batches=0, retried=0, errors=0)
+
+    def start(self):
+        "Load the state, and start following the feed and dispatching."
+        self.seq = self.db.info()['update_seq']
+        for row in self.db.view('service/name', include_docs=True):
+            self.hrefs[row['key']] = row['doc'].get('notify_href')
+        for row in self.db.view('user/email', include_docs=True):
+            self.user_services[row['id']] = set(row['doc'].get('services', []))
+        if self.outbox:
+            self.load_outbox()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=settings['NOTIFY_CONCURRENCY'])
+        for target, name in [(self.follow, 'userman-notifier-feed'),
+                             (self.dispatch, 'userman-notifier')]:
+            worker.start_thread(target, name)
+
+    def follow(self):
+        "Queue the notifications for the changes in the database, forever."
+        while True:
+            try:
+                result = self.db.changes(
+                    since=self.seq,
+                    feed='longpoll',
+                    filter='_selector',
+                    selector={'$or': [
+                        {constants.DB_DOCTYPE: {'$in': list(self.doctypes)}},
+                        {'_deleted': True,
+                         constants.DB_DOCTYPE: {'$exists': False}}]},
+                    include_docs=True,
+                    limit=settings['NOTIFY_FEED_BATCH'],
+                    timeout=int(settings['NOTIFY_FEED_TIMEOUT'] * 1000))
+            except Exception as msg:
+                logging.warning("notifier changes feed error: %s", msg)
+                time.sleep(settings['NOTIFY_FEED_TIMEOUT'] / 10.0)
+                continue
+            with self.condition:
+                for change in result.get('results', []):
+                    if change.get('deleted'):
+                        self.apply_deleted(change['id'])
+                    elif change.get('doc'):
+                        self.apply(change['doc'])
+                self.seq = result['last_seq']
+                if self.outbox:
+                    self.save_outbox()
+                self.condition.notify()
+
+    def apply(self, doc):
+        "Queue the notification items for the document. Lock must be held."
+        self.counters['changes'] += 1
+        doctype = doc[constants.DB_DOCTYPE]
+        if doctype == constants.USER:
+            services = set(doc.get('services', []))
+            names = services.union(self.user_services.get(doc['_id'], set()))
+            self.user_services[doc['_id']] = services
+        elif doctype == constants.TEAM:
+            names = list(self.hrefs)
+        else:
+            self.hrefs[doc['name']] = doc.get('notify_href')
+            names = [doc['name']]
+            if not self.hrefs[doc['name']]:
+                self.outboxes.pop(doc['name'], None)
+                self.queued.pop(doc['name'], None)
+        self.enqueue(names, get_item(doc))
+
+    def apply_deleted(self, doc_id):
+        """Queue the removal item for the services of the deleted user.
+        Other deleted documents are ignored. Lock must be held."""
+        names = self.user_services.pop(doc_id, None)
+        if names is None: return
+        self.counters['changes'] += 1
+        self.enqueue(names,
+                     dict(doctype=constants.USER, iuid=doc_id, deleted=True))
+
+    def enqueue(self, names, item):
+        """Put the item in the outboxes of the services given by name,
+        replacing any previous item for the same document. Lock must be held."""
+        for name in names:
+            if not self.hrefs.get(name): continue
+            outbox = self.outboxes.setdefault(name, collections.OrderedDict())
+            if item['iuid'] in outbox:
+                del outbox[item['iuid']]
+                self.counters['coalesced'] += 1
+            else:
+                self.counters['items'] += 1
+            outbox[item['iuid']] = item
+            self.queued.setdefault(name, time.time())
+
+    def dispatch(self):
+        "Send the outboxes that are due, forever."
+        with self.condition:
+            while True:
+                now = time.time()
+                wait = settings['NOTIFY_DELAY']
+                for name, queued in list(self.queued.items()):
+                    if name in self.sending: continue
+                    due = max(queued + settings['NOTIFY_DELAY'],
+                              self.retries.get(name, (0, 0))[1])
+                    if due > now:
+                        wait = min(wait, due - now)
+                    elif len(self.sending) < settings['NOTIFY_CONCURRENCY']:
+                        self.submit(name)
+                self.condition.wait(max(wait, 0.01))
+
+    def submit(self, name):
+        "Send a batch of the outbox of the service. Lock must be held."
+        items = list(self.outboxes[name].values())[:settings['NOTIFY_BATCH']]
+        self.sending.add(name)
+        self.executor.submit(self.send, name, self.hrefs[name], items)
+
+    def send(self, name, href, items):
+        "POST the items to the service, and remove them from its outbox if OK."
+        body = json.dumps(dict(changes=items)).encode('utf-8')
+        request = urllib.request.Request(
+            href,
+            data=body,
+            method='POST',
+            headers={'Content-Type': 'application/json',
+                     'X-Userman-Signature': get_signature(body)})
+        try:
+            with urllib.request.urlopen(request,
+                                        timeout=settings['NOTIFY_TIMEOUT']):
+                pass
+            error = None
+        except (OSError, ValueError) as msg:
+            error = msg
+        with self.condition:
+            self.sending.discard(name)
+            if error is None:
+                self.remove_sent(name, items)
+            else:
+                attempts = self.retries.get(name, (0, 0))[0] + 1
+                delay = min(settings['NOTIFY_RETRY_DELAY'] * 2**(attempts-1),
+                            settings['NOTIFY_MAX_DELAY'])
+                self.retries[name] = (attempts, time.time() + delay)
+                logging.warning("notify %s failed, retry in %s s: %s",
+                                name, delay, error)
+                self.counters['errors'] += 1
+                self.counters['retried'] += 1
+            self.condition.notify()
+
+    def remove_sent(self, name, items):
+        """Remove the sent items from the outbox, unless replaced meanwhile.
+        Lock must be held."""
+        outbox = self.outboxes.get(name, dict())
+        for item in items:
+            if outbox.get(item['iuid']) is item:
+                del outbox[item['iuid']]
+        self.retries.pop(name, None)
+        if outbox:
+            self.queued[name] = time.time() - settings['NOTIFY_DELAY']
+        else:
+            self.queued.pop(name, None)
+        self.counters['sent'] += len(items)
+        self.counters['batches'] += 1
+        if self.outbox:
+            self.save_outbox()
+
+    def load_outbox(self):
+        """Load the outboxes and the feed sequence from the directory.
+        The accounts changed after the sequence are taken to have had
+        all the services granted to them."""
+        try:
+            with open(os.path.join(self.outbox, 'outbox.json')) as infile:
+                data = json.load(infile)
+        except IOError:
+            return
+        self.seq = data['seq']
+        result = self.db.changes(since=self.seq,
+                                 filter='_selector',
+                                 selector={constants.DB_DOCTYPE: constants.USER},
+                                 include_docs=True)
+        for change in result.get('results', []):
+            if change.get('deleted'): continue
+            doc = change['doc']
+            self.user_services[doc['_id']] = \
+                set(doc.get('services', [])).union(doc.get('services_granted', []))
+        for name, items in data['outboxes'].items():
+            if not items: continue
+            self.outboxes[name] = collections.OrderedDict(
+                [(i['iuid'], i) for i in items])
+            self.queued[name] = time.time()
+        logging.info("notifier loaded outboxes for %s services",
+                     len(self.outboxes))
+
+    def save_outbox(self):
+        "Save the outboxes and the feed sequence. Lock must be held."
+        filepath = os.path.join(self.outbox, 'outbox.json')
+        data = dict(seq=self.seq,
+                    outboxes=dict([(n, list(o.values()))
+                                   for n, o in self.outboxes.items() if o]))
+        with open(filepath + '.tmp', 'w') as outfile:
+            json.dump(data, outfile)
+        os.replace(filepath + '.tmp', filepath)
+
+    def get_counters(self):
+        "Return the counters, and the number of items not yet sent."
+        with self.condition:
+            result = dict(self.counters)
+            result['outbox'] = sum([len(o) for o in self.outboxes.values()])
+            result['sending'] = len(self.sending)
+        return result
+
+
+_notifier = worker.Singleton()
+
+def start(db):
+    "Start the process-wide notifier using the given database handle."
+    if settings['NOTIFY_OUTBOX']:
+        os.makedirs(settings['NOTIFY_OUTBOX'], exist_ok=True)
+    _notifier.start(lambda: Notifier(db, outbox=settings['NOTIFY_OUTBOX']))
+
+def get_notifier():
+    "Return the process-wide notifier, or None if not started."
+    return _notifier.get()
@@ -1,10 +1,9 @@
 " Userman: RequestHandler subclass."
 
 import logging
+import hashlib
 import urllib.parse
-import smtplib
 from email.mime.text import MIMEText
-import functools
 
 import tornado.web
 import ibm_cloud_sdk_core
@@ -13,17 +12,46 @@ import userman
 from . import settings
 from . import constants
 from . import utils
+from . import asyncdb
+from . import mirror
+from . import mailer
+from . import trace
+from . import metrics
 
 
 class RequestHandler(tornado.web.RequestHandler):
-    "Base request handler."
+    """Base request handler.
+    The database is available as 'db' for blocking calls, and as 'adb'
+    for awaitable calls; handler methods should use the latter."""
 
-    def prepare(self):
+    _user = None
+    _trace = None
+
+    async def prepare(self):
         self.db = utils.get_db()
+        self.adb = asyncdb.get_db()
+        if settings['DB_TRACE']:
+            self._trace = trace.Trace()
+        if self._trace is not None or settings['METRICS']:
+            self.adb = trace.TracingDatabaseWrapper(self.adb,
+                                                    trace=self._trace,
+                                                    metrics=settings['METRICS'])
         self._cache = {}
+        self._user = await self.fetch_current_user()
+
+    def flush(self, include_footers=False):
+        "Add the database call timings to the headers, if not yet sent."
+        if self._trace is not None and not self._headers_written:
+            self.set_header('Server-Timing', self._trace.get_server_timing())
+        return super(RequestHandler, self).flush(include_footers)
 
     def on_finish(self):
         self._cache.clear()
+        if settings['METRICS']:
+            metrics.observe_request(self)
+        if self._trace is not None and settings['DB_TRACE_SLOW'] is not None \
+           and self.request.request_time() * 1000 > settings['DB_TRACE_SLOW']:
+            logging.warning("slow request %s", self._trace.get_log(self))
 
     def get_template_namespace(self):
         result = super(RequestHandler, self).get_template_namespace()
@@ -46,69 +74,147 @@ class RequestHandler(tornado.web.RequestHandler):
             url += '?' + urllib.parse.urlencode(kwargs)
         return url
 
-    def get_current_user(self):
-        "Get the currently logged-in user."
+    async def fetch_current_user(self):
+        """Fetch the user document for the account given by the login cookie.
+        Return None if not logged in, or if the account is not active."""
+        email = self.get_secure_cookie(constants.USER_COOKIE_NAME)
+        if not email: return None
         try:
-            if self._user.get('status') != constants.ACTIVE:
-                self.set_secure_cookie(constants.USER_COOKIE_NAME, '')
-                return None
-        except AttributeError:
-            email = self.get_secure_cookie(constants.USER_COOKIE_NAME)
-            if not email: return None
-            try:
-                email = email.decode('utf-8')
-                user = self.get_user(email)
-                if user.get('status') != constants.ACTIVE:
-                    raise tornado.web.HTTPError(400)
-            except tornado.web.HTTPError:
-                return None
-            self._user = user
+            user = await self.get_user(email.decode('utf-8'))
+        except tornado.web.HTTPError:
+            return None
+        if user.get('status') != constants.ACTIVE: return None
+        return user
+
+    def get_current_user(self):
+        "Get the currently logged-in user, as fetched when preparing."
+        if self._user is None: return None
+        if self._user.get('status') != constants.ACTIVE:
+            self.set_secure_cookie(constants.USER_COOKIE_NAME, '')
+            return None
         return self._user
 
-    def get_user(self, name, require_active=False):
+    async def get_user(self, name, require_active=False):
         """Get the user document by the account's username or email.
         Return HTTP 404 if no such user, or blocked if active required."""
         try:
             key = "{0}:{1}".format(constants.USER, name)
             doc = self._cache[key]
         except KeyError:
-            try:
-                doc = utils.get_user_doc(self.db, name)
-            except ValueError as msg:
-                raise tornado.web.HTTPError(404, reason=str(msg))
-            self._cache[doc['_id']] = doc
-            key = "{0}:{1}".format(constants.USER, doc['email'])
-            self._cache[key] = doc
-            if doc.get('username'):
-                key = "{0}:{1}".format(constants.USER, doc['username'])
-                self._cache[key] = doc
+            doc = self.get_mirror_doc('get_user', name)
+            if doc is None:
+                try:
+                    doc = await asyncdb.get_user_doc(self.adb, name)
+                except ValueError as msg:
+                    raise tornado.web.HTTPError(404, reason=str(msg))
+            self.cache_user(doc)
         if require_active and doc.get('status') != constants.ACTIVE:
             raise tornado.web.HTTPError(404, reason='blocked user')
         return doc
 
-    def get_service(self, name):
+    def cache_user(self, doc):
+        "Store the user document in the request cache."
+        self._cache[doc['_id']] = doc
+        key = "{0}:{1}".format(constants.USER, doc['email'])
+        self._cache[key] = doc
+        if doc.get('username'):
+            key = "{0}:{1}".format(constants.USER, doc['username'])
+            self._cache[key] = doc
+
+    async def get_users(self, names):
+        """Get the user documents by the accounts' usernames or emails.
+        Those not in the cache are fetched in at most two round-trips.
+        Names for which there is no user are skipped."""
+        emails = [n for n in names if '@' in n]
+        usernames = [n for n in names if '@' not in n]
+        result = dict()
+        for viewname, keys in [('user/email', emails),
+                               ('user/username', usernames)]:
+            for name, doc in (await self.get_named_docs(
+                    constants.USER, viewname, keys)).items():
+                self.cache_user(doc)
+                result[name] = doc
+        return [result[n] for n in names if n in result]
+
+    async def get_named_docs(self, doctype, viewname, names):
+        """Return a dict of the documents of the doctype given by the names.
+        Those not in the request cache or the mirror are fetched from
+        the view in one multi-key round-trip. Unknown names are skipped."""
+        result = dict()
+        missing = []
+        for name in names:
+            key = "{0}:{1}".format(doctype, name)
+            try:
+                result[name] = self._cache[key]
+            except KeyError:
+                doc = self.get_mirror_doc("get_{0}".format(doctype), name)
+                if doc is None:
+                    missing.append(name)
+                else:
+                    self._cache[key] = self._cache[doc['_id']] = doc
+                    result[name] = doc
+        if missing:
+            found = await self.adb.view_docs(viewname, missing)
+            for name, doc in found.items():
+                key = "{0}:{1}".format(doctype, name)
+                self._cache[key] = self._cache[doc['_id']] = doc
+                result[name] = doc
+        return result
+
+    async def get_services(self, names):
+        """Get the service documents by their names, in the given order.
+        Names for which there is no service are skipped."""
+        docs = await self.get_named_docs(constants.SERVICE,
+                                         'service/name',
+                                         names)
+        return [docs[n] for n in names if n in docs]
+
+    async def get_teams(self, names):
+        """Get the team documents by their names, in the given order.
+        Names for which there is no team are skipped."""
+        docs = await self.get_named_docs(constants.TEAM, 'team/name', names)
+        return [docs[n] for n in names if n in docs]
+
+    async def get_service(self, name):
         "Get the service document by its name."
         try:
             key = "{0}:{1}".format(constants.SERVICE, name)
             return self._cache[key]
         except KeyError:
-            result = list(self.db.view('service/name', include_docs=True, key=name))
+            doc = self.get_mirror_doc('get_service', name)
+            if doc is not None:
+                self._cache[key] = self._cache[doc['_id']] = doc
+                return doc
+            result = list(await self.adb.view('service/name',
+                                              include_docs=True, key=name))
             if len(result) == 1:
                 doc = result[0]['doc']
                 self._cache[key] = self._cache[doc['_id']] = doc
                 return doc
             raise tornado.web.HTTPError(404, reason='no such service')
 
-    def get_all_services(self):
-        return [self.get_service(r['key']) for r in self.db.view('service/name')]
+    async def get_all_services(self):
+        "Get all service documents, sorted by name, in one round-trip."
+        result = []
+        for row in await self.adb.view('service/name', include_docs=True):
+            doc = row['doc']
+            key = "{0}:{1}".format(constants.SERVICE, doc['name'])
+            self._cache[key] = self._cache[doc['_id']] = doc
+            result.append(doc)
+        return result
 
-    def get_team(self, name):
+    async def get_team(self, name):
         "Get the team document by its name."
         try:
-            key = "{0}:{1}".format(constants.SERVICE, name)
+            key = "{0}:{1}".format(constants.TEAM, name)
             return self._cache[key]
         except KeyError:
-            result = list(self.db.view('team/name', include_docs=True, key=name))
+            doc = self.get_mirror_doc('get_team', name)
+            if doc is not None:
+                self._cache[key] = self._cache[doc['_id']] = doc
+                return doc
+            result = list(await self.adb.view('team/name',
+                                              include_docs=True, key=name))
             if len(result) == 1:
                 doc = result[0]['doc']
                 self._cache[key] = self._cache[doc["_id"]] = doc
@@ -125,18 +231,28 @@ class RequestHandler(tornado.web.RequestHandler):
         if not self.is_admin():
             raise tornado.web.HTTPError(403, reason='admin role required')
 
-    def get_admins(self):
+    def get_mirror_doc(self, method, name):
+        """Return the document from the in-memory mirror, if running.
+        Return None if no mirror, or if not found there."""
+        index = mirror.get_mirror()
+        if index is None: return None
+        return getattr(index, method)(name)
+
+    async def get_admins(self):
         "Return all admin accounts as a list of documents."
-        view_rows = self.db.view('user/role', include_docs=True, key='admin')
+        index = mirror.get_mirror()
+        if index is not None:
+            return index.get_admins()
+        view_rows = await self.adb.view('user/role', include_docs=True, key='admin')
         return [r['doc'] for r in view_rows if r['doc']['status'] == 'active']
 
-    def get_doc(self, id, doctype=None):
+    async def get_doc(self, id, doctype=None):
         "Return the document given by its id, optionally checking the doctype."
         try:
             return self._cache[id]
         except KeyError:
             try:
-                doc = self.db[id]
+                doc = await self.adb[id]
                 if doctype:
                     if doctype != doc.get(constants.DB_DOCTYPE):
                         msg = 'invalid doctype'
@@ -146,30 +262,86 @@ class RequestHandler(tornado.web.RequestHandler):
             except ibm_cloud_sdk_core.api_exception.ApiException:
                 raise ValueError('no such document')
 
-    def get_logs(self, id):
-        "Return the log documents for the given doc id."
-        view_rows = self.db.view('log/doc', include_docs=True, key=id)
-        return sorted([r['doc'] for r in view_rows],
-                      key=functools.cmp_to_key(utils.cmp_modified),
-                      reverse=True)
+    async def get_doc_rev(self, id):
+        """Return the current revision of the document given by its id.
+        It is taken from the mirror if running, otherwise the document
+        header is fetched from the database, but not its body.
+        Raise ApiException if no such document."""
+        index = mirror.get_mirror()
+        if index is not None:
+            rev = index.get_rev(id)
+            if rev is not None: return rev
+        return await self.adb.get_rev(id)
+
+    def set_etag(self, *revs):
+        """Set the strong ETag header from the given document revisions.
+        For a single revision, it is used as is, otherwise hashed."""
+        if len(revs) == 1:
+            etag = revs[0]
+        else:
+            etag = hashlib.sha1('\n'.join(revs).encode('utf-8')).hexdigest()
+        self.set_header('Etag', '"{0}"'.format(etag))
+
+    def is_not_modified(self):
+        """If the ETag header matches the request's If-None-Match header,
+        respond with 304 Not Modified and return True."""
+        if not self.check_etag_header(): return False
+        self.set_status(304)
+        self.finish()
+        return True
+
+    async def get_team_member_emails(self, name):
+        "Return the emails of the members of the team given by name."
+        index = mirror.get_mirror()
+        if index is not None:
+            return index.get_members(name)
+        view_rows = await self.adb.view('user/team', key=name)
+        return [r['value'] for r in view_rows]
+
+    async def get_logs(self, id, cursor=None, limit=None):
+        """Return the log documents for the given doc id, latest first.
+        Begin at the entry given by the cursor, if any, and return at most
+        'limit' documents, if given."""
+        options = dict(start_key=[id, {}],
+                       end_key=[id],
+                       descending=True,
+                       include_docs=True)
+        if cursor:
+            try:
+                timestamp, iuid = utils.parse_log_cursor(cursor)
+            except ValueError:
+                raise tornado.web.HTTPError(400, reason='invalid cursor')
+            options['start_key'] = [id, timestamp]
+            options['start_key_doc_id'] = iuid
+        if limit:
+            options['limit'] = limit
+        view_rows = await self.adb.view('log/doc_timestamp', **options)
+        return [r['doc'] for r in view_rows]
+
+    async def get_logs_page(self, id):
+        """Return a page of the log documents for the given doc id,
+        beginning at the entry given by the 'logs_from' cursor argument,
+        and the cursor of the next older page, or None if no more."""
+        page_size = settings['LOG_PAGE_SIZE']
+        logs = await self.get_logs(id,
+                                   cursor=self.get_argument('logs_from', None),
+                                   limit=page_size + 1)
+        if len(logs) > page_size:
+            logs_next = utils.get_log_cursor(logs.pop())
+        else:
+            logs_next = None
+        return logs, logs_next
 
     def send_email(self, recipient, sender, subject, text):
-        "Send an email to the given recipient from the given sender user."
+        """Queue an email to the given recipient from the given sender user.
+        It is sent by the background mailer; this does not block."""
         mail = MIMEText(text)
         mail['Subject'] = subject
         mail['From'] = sender['email']
         mail['To'] = recipient['email']
-        server = smtplib.SMTP(host=settings['EMAIL']['HOST'],
-                              port=settings['EMAIL']['PORT'])
-        if settings['EMAIL'].get('TLS'):
-            server.starttls()
-        try:
-            server.login(settings['EMAIL']['ACCOUNT'],
-                         settings['EMAIL']['PASSWORD'])
-        except KeyError:
-            pass
-        logging.debug("sendmail from %s to %s",
+        logging.debug("queue mail from %s to %s",
                       sender['email'],
                       recipient['email'])
-        server.sendmail(sender['email'], [recipient['email']], mail.as_string())
-        server.quit()
+        mailer.get_mailer().enqueue(sender['email'],
+                                    [recipient['email']],
+                                    mail.as_string())
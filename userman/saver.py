@@ -4,27 +4,39 @@ import tornado
 
 from . import constants
 from . import utils
+from . import mirror
+from . import logsink
+from . import authcache
 
 
 class BaseSaver(object):
     """Abstract context handler creating or updating a document.
+    Use 'with' when given a db, and 'async with' when given a request handler;
+    the latter runs the database calls without blocking the IOLoop,
+    including those checking values for uniqueness, which are then
+    made on exit, before saving.
+    If a SaveBatch is given, the document is written when it exits.
     No log entry is created on saving."""
 
     doctype = None
 
-    def __init__(self, doc=None, rqh=None, db=None):
+    def __init__(self, doc=None, rqh=None, db=None, batch=None):
         assert self.doctype
+        self.batch = batch
         if rqh is not None:
             self.db = rqh.db
+            self.adb = rqh.adb
             self.current_user = rqh.current_user
         elif db is not None:
             self.db = db
+            self.adb = None
             self.current_user = dict()
         else:
             raise ValueError('neither db nor rqh given')
         self.doc = doc or dict()
         self.changed = dict()
         self.deleted = dict()
+        self.unique = []        # (viewname, key, message) to check on exit
         if '_id' in self.doc:
             assert self.doctype == self.doc[constants.DB_DOCTYPE]
         else:
@@ -38,9 +50,31 @@ class BaseSaver(object):
     def __exit__(self, type, value, tb):
         if type is not None: return False # No exceptions handled here
         self.finalize()
+        if self.batch is not None:
+            self.batch.add(self)
+            return
         self.db.save(self.doc)
+        self.after_save()
         self.log()
 
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, tb):
+        if type is not None: return False # No exceptions handled here
+        for viewname, key, message in self.unique:
+            if await self.adb.view(viewname, key=key, limit=1):
+                raise tornado.web.HTTPError(409, message)
+        self.finalize()
+        if self.batch is not None:
+            self.batch.add(self)
+            return
+        await self.adb.save(self.doc)
+        self.after_save()
+        entry = self.get_log_entry()
+        if entry and not logsink.add(entry):
+            await self.adb.save(entry)
+
     def __setitem__(self, key, value):
         "Update the key/value pair."
         try:
@@ -78,6 +112,15 @@ class BaseSaver(object):
         "Perform actions when creating the document."
         pass
 
+    def check_unique(self, viewname, value, message):
+        """Raise KeyError with the message if the view has the value as key.
+        With a request handler, the check is made on exit instead."""
+        if self.adb is None:
+            if len(list(self.db.view(viewname, key=value))) > 0:
+                raise KeyError(message)
+        else:
+            self.unique.append((viewname, value, message))
+
     def finalize(self):
         "Perform any final modifications before saving the document."
         self.doc['modified'] = utils.timestamp()
@@ -88,17 +131,121 @@ class BaseSaver(object):
         except KeyError:
             return default
 
+    def after_save(self):
+        """Perform actions after the document has been written, also when
+        by a SaveBatch: update the in-memory mirror, if running, and
+        invalidate the auth cache entries for the document."""
+        index = mirror.get_mirror()
+        if index is not None:
+            index.update(self.doc)
+        authcache.invalidate(self.doc)
+
     def log(self):
-        "Log save action; no action by default."
-        pass
+        "Log save action, if there is a log entry for it."
+        entry = self.get_log_entry()
+        if entry and not logsink.add(entry):
+            self.db.save(entry)
+
+    def get_log_entry(self):
+        "Return the log entry for the save action; none by default."
+        return None
 
 
 class DocumentSaver(BaseSaver):
     "Saver with log entry write on document save."
 
-    def log(self):
-        "Log document save action."
-        utils.log(self.db, self.doc,
-                  changed=self.changed,
-                  deleted=self.deleted,
-                  current_user=self.current_user)
+    def get_log_entry(self):
+        "Return the log entry for the document save action."
+        return utils.get_log_entry(self.doc,
+                                   changed=self.changed,
+                                   deleted=self.deleted,
+                                   current_user=self.current_user)
+
+
+class SaveBatch(object):
+    """Context handler collecting the documents of several savers, and their
+    log entries, and writing them all in one bulk request on exit.
+    Use 'with' when given a db, and 'async with' when given a request handler.
+    The results for documents that failed, such as by conflict, are
+    in 'errors' after exit; their log entries are removed again."""
+
+    def __init__(self, rqh=None, db=None):
+        if rqh is not None:
+            self.db = rqh.db
+            self.adb = rqh.adb
+        elif db is not None:
+            self.db = db
+            self.adb = None
+        else:
+            raise ValueError('neither db nor rqh given')
+        self.docs = dict()      # id -> doc, in order of addition
+        self.savers = dict()    # doc id -> the saver last adding it
+        self.entries = dict()   # doc id -> log entry
+        self.errors = []
+
+    def add(self, saver):
+        """Add the document of the saver, and its log entry, if any.
+        If the document was already added, the log entries are merged."""
+        doc = saver.doc
+        entry = saver.get_log_entry()
+        self.docs[doc['_id']] = doc
+        self.savers[doc['_id']] = saver
+        if not entry: return
+        try:
+            previous = self.entries[doc['_id']]
+        except KeyError:
+            self.entries[doc['_id']] = entry
+        else:
+            previous['changed'] = dict(previous['changed'], **entry['changed'])
+            previous['deleted'] = dict(previous['deleted'], **entry['deleted'])
+
+    def get_documents(self):
+        "Return the documents and log entries to save."
+        return list(self.docs.values()) + list(self.entries.values())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        if type is not None: return False # No exceptions handled here
+        if not self.docs: return
+        results = self.db.bulk_save(self.get_documents())
+        stray = self.check(results)
+        if stray:
+            self.db.bulk_save(stray)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, tb):
+        if type is not None: return False # No exceptions handled here
+        if not self.docs: return
+        results = await self.adb.bulk_save(self.get_documents())
+        stray = self.check(results)
+        if stray:
+            await self.adb.bulk_save(stray)
+
+    def check_errors(self):
+        "Raise HTTP 409 if any document failed to save."
+        if self.errors:
+            raise tornado.web.HTTPError(409, "could not save {0}: {1}".format(
+                ', '.join([e.get('id', '?') for e in self.errors]),
+                self.errors[0].get('error')))
+
+    def check(self, results):
+        """Record the failed documents, and call 'after_save' of the savers
+        of the saved. Return the log entries for the failed documents,
+        marked deleted."""
+        stray = []
+        for doc, result in zip(self.docs.values(), results):
+            if result.get('error'):
+                self.errors.append(result)
+                entry = self.entries.get(doc['_id'])
+                if entry and entry.get('_rev'):
+                    stray.append({'_id': entry['_id'],
+                                  '_rev': entry['_rev'],
+                                  '_deleted': True,
+                                  constants.DB_DOCTYPE: constants.LOG})
+            else:
+                self.savers[doc['_id']].after_save()
+        return stray
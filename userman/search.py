@@ -0,0 +1,84 @@
+""" Userman: In-memory prefix search index for user accounts.
+
+The index is a sorted array of (term, email) pairs, searched by bisect.
+The terms are the email, username, name and university of the account,
+and each following word of the name and university, in lowercase ASCII.
+When loading, additions are appended, and the array is sorted once when
+next used. Thereafter, additions are inserted in place.
+"""
+
+import bisect
+
+from . import utils
+
+
+def normalize(value):
+    "Return the value as a search term: lowercase ASCII."
+    return utils.to_ascii(value).decode('ascii').lower().strip()
+
+def get_terms(doc):
+    "Return the search terms for the user document."
+    result = set()
+    for key in ['email', 'username', 'name', 'university']:
+        value = normalize(doc.get(key) or '')
+        if not value: continue
+        result.add(value)
+        words = value.split()
+        for pos in range(1, len(words)):
+            result.add(' '.join(words[pos:]))
+    return result
+
+
+class SearchIndex(object):
+    "Prefix search index for user accounts. Not thread-safe."
+
+    def __init__(self):
+        self.entries = []       # (term, email); sorted unless 'unsorted'
+        self.terms = dict()     # email -> set of terms
+        self.unsorted = False
+
+    def add(self, doc):
+        "Add or replace the user document in the index."
+        self.remove(doc['email'])
+        terms = get_terms(doc)
+        self.terms[doc['email']] = terms
+        if self.unsorted or not self.entries:
+            for term in terms:
+                self.entries.append((term, doc['email']))
+            self.unsorted = True
+        else:
+            for term in terms:
+                bisect.insort(self.entries, (term, doc['email']))
+
+    def remove(self, email):
+        "Remove the user account given by email from the index."
+        try:
+            terms = self.terms.pop(email)
+        except KeyError:
+            return
+        self.sort()
+        for term in terms:
+            pos = bisect.bisect_left(self.entries, (term, email))
+            if pos < len(self.entries) and self.entries[pos] == (term, email):
+                del self.entries[pos]
+
+    def sort(self):
+        if self.unsorted:
+            self.entries.sort()
+            self.unsorted = False
+
+    def search(self, prefix, limit):
+        """Return the emails of the accounts having a term beginning
+        with the prefix, at most 'limit' of them, in order of term."""
+        prefix = normalize(prefix)
+        if not prefix: return []
+        self.sort()
+        result = []
+        pos = bisect.bisect_left(self.entries, (prefix, ''))
+        while pos < len(self.entries) and len(result) < limit:
+            term, email = self.entries[pos]
+            if not term.startswith(prefix): break
+            if email not in result:
+                result.append(email)
+            pos += 1
+        return result
@@ -30,11 +30,13 @@ class ServiceSaver(DocumentSaver):
 class Service(RequestHandler):
     "Display a service."
 
-    def get(self, name):
-        service = self.get_service(name)
+    async def get(self, name):
+        service = await self.get_service(name)
+        logs, logs_next = await self.get_logs_page(service['_id'])
         self.render('service.html',
                     service=service,
-                    logs=self.get_logs(service['_id']))
+                    logs=logs,
+                    logs_next=logs_next)
 
 
 class ServiceCreate(RequestHandler):
@@ -46,17 +48,17 @@ class ServiceCreate(RequestHandler):
         self.render('service_create.html')
 
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         self.check_xsrf_cookie()
         self.check_admin()
         name = self.get_argument('name')
         try:
-            self.get_service(name)
+            await self.get_service(name)
         except tornado.web.HTTPError:
             pass
         else:
             raise tornado.web.HTTPError(409, 'service already exists')
-        with ServiceSaver(rqh=self) as saver:
+        async with ServiceSaver(rqh=self) as saver:
             saver['name'] = name
             saver['description'] = self.get_argument('description', '')
             saver['href'] = self.get_argument('href')
@@ -70,17 +72,17 @@ class ServiceEdit(RequestHandler):
     "Edit a service."
 
     @tornado.web.authenticated
-    def get(self, name):
+    async def get(self, name):
         self.check_admin()
-        service = self.get_service(name)
+        service = await self.get_service(name)
         self.render('service_edit.html', service=service)
 
     @tornado.web.authenticated
-    def post(self, name):
+    async def post(self, name):
         self.check_xsrf_cookie()
         self.check_admin()
-        service = self.get_service(name)
-        with ServiceSaver(doc=service, rqh=self) as saver:
+        service = await self.get_service(name)
+        async with ServiceSaver(doc=service, rqh=self) as saver:
             saver['name'] = self.get_argument('name')
             saver['description'] = self.get_argument('description', '')
             saver['href'] = self.get_argument('href', service['href'])
@@ -94,20 +96,20 @@ class ServiceEdit(RequestHandler):
 class Services(RequestHandler):
     "Display all services."
 
-    def get(self):
-        self.render('services.html', services=self.get_all_services())
+    async def get(self):
+        self.render('services.html', services=await self.get_all_services())
 
 
 class ServiceBlock(RequestHandler):
     "Block a service."
 
     @tornado.web.authenticated
-    def post(self, name):
+    async def post(self, name):
         self.check_xsrf_cookie()
         self.check_admin()
-        service = self.get_service(name)
+        service = await self.get_service(name)
         if service['status'] != constants.BLOCKED:
-            with ServiceSaver(doc=service, rqh=self) as saver:
+            async with ServiceSaver(doc=service, rqh=self) as saver:
                 saver['status'] = constants.BLOCKED
         self.redirect(self.reverse_url('service', name))
 
@@ -116,11 +118,11 @@ class ServiceUnblock(RequestHandler):
     "Unblock a service."
 
     @tornado.web.authenticated
-    def post(self, name):
+    async def post(self, name):
         self.check_xsrf_cookie()
         self.check_admin()
-        service = self.get_service(name)
+        service = await self.get_service(name)
         if service['status'] != constants.ACTIVE:
-            with ServiceSaver(doc=service, rqh=self) as saver:
+            async with ServiceSaver(doc=service, rqh=self) as saver:
                 saver['status'] = constants.ACTIVE
         self.redirect(self.reverse_url('service', name))
@@ -4,8 +4,10 @@ import tornado.web
 import functools
 
 from . import constants
+from . import settings
 from . import utils
-from .saver import DocumentSaver
+from . import mirror
+from .saver import DocumentSaver, SaveBatch
 from .requesthandler import RequestHandler
 from .user import UserSaver
 
@@ -28,14 +30,32 @@ class TeamSaver(DocumentSaver):
 
 class TeamMixin(object):
 
-    def get_leaders(self, team):
-        return sorted([self.get_user(e) for e in team['leaders']],
+    async def get_leaders(self, team):
+        return sorted(await self.get_users(team['leaders']),
                       key=functools.cmp_to_key(utils.cmp_email))
 
-    def get_members(self, team):
-        return sorted([self.get_user(r['value'])
-                       for r in self.db.view('user/team', key=team['name'])],
-                      key=functools.cmp_to_key(utils.cmp_email))
+    async def get_members(self, team, start=None, limit=None):
+        """Return the member user documents of the team, sorted by email.
+        Optionally start at the given email, and limit the number returned.
+        The documents are fetched in one indexed query."""
+        index = mirror.get_mirror()
+        if index is not None:
+            emails = index.get_members(team['name'])
+            if start:
+                emails = [e for e in emails if e >= start]
+            if limit:
+                emails = emails[:limit]
+            return await self.get_users(emails)
+        options = dict(start_key=[team['name'], start or ''],
+                       end_key=[team['name'], {}],
+                       include_docs=True)
+        if limit:
+            options['limit'] = limit
+        result = []
+        for row in await self.adb.view('user/team_email', **options):
+            self.cache_user(row['doc'])
+            result.append(row['doc'])
+        return result
 
     def is_member(self, team, user=None):
         if user is None:
@@ -61,17 +81,29 @@ class Team(TeamMixin, RequestHandler):
     "Display a team."
 
     @tornado.web.authenticated
-    def get(self, name):
-        team = self.get_team(name)
+    async def get(self, name):
+        team = await self.get_team(name)
         if not team['public']:
             self.check_member(team)
+        page_size = settings['PAGE_SIZE']
+        members = await self.get_members(
+            team,
+            start=self.get_argument('members_from', None),
+            limit=page_size + 1)
+        if len(members) > page_size:
+            members_next = members.pop()['email']
+        else:
+            members_next = None
+        logs, logs_next = await self.get_logs_page(team['_id'])
         self.render('team.html',
                     team=team,
                     is_leader=self.is_leader(team),
                     is_member=self.is_member(team),
-                    leaders=self.get_leaders(team),
-                    members=self.get_members(team),
-                    logs=self.get_logs(team['_id']))
+                    leaders=await self.get_leaders(team),
+                    members=members,
+                    members_next=members_next,
+                    logs=logs,
+                    logs_next=logs_next)
 
 
 class TeamCreate(RequestHandler):
@@ -82,23 +114,26 @@ class TeamCreate(RequestHandler):
         self.render('team_create.html')
 
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         self.check_xsrf_cookie()
         name = self.get_argument('name')
         try:
-            self.get_team(name)
+            await self.get_team(name)
         except tornado.web.HTTPError:
             pass
         else:
             raise tornado.web.HTTPError(409, 'team already exists')
-        with TeamSaver(rqh=self) as saver:
-            saver['name'] = name
-            saver['leaders'] = [self.current_user['email']]
-            saver['description'] = self.get_argument('description', '')
-            saver['status'] = self.get_argument('status', constants.ACTIVE)
-            saver['public'] = utils.to_bool(self.get_argument('public', False))
-        with UserSaver(doc=self.current_user, rqh=self) as saver:
-            saver['teams'] = sorted(saver['teams'] + [name])
+        async with SaveBatch(rqh=self) as batch:
+            async with TeamSaver(rqh=self, batch=batch) as saver:
+                saver['name'] = name
+                saver['leaders'] = [self.current_user['email']]
+                saver['description'] = self.get_argument('description', '')
+                saver['status'] = self.get_argument('status', constants.ACTIVE)
+                saver['public'] = utils.to_bool(self.get_argument('public', False))
+            async with UserSaver(doc=self.current_user, rqh=self,
+                                 batch=batch) as saver:
+                saver['teams'] = sorted(saver['teams'] + [name])
+        batch.check_errors()
         self.redirect(self.reverse_url('team', name))
 
 
@@ -106,51 +141,56 @@ class TeamEdit(TeamMixin, RequestHandler):
     "Edit a team."
 
     @tornado.web.authenticated
-    def get(self, name):
-        team = self.get_team(name)
+    async def get(self, name):
+        team = await self.get_team(name)
         self.check_leader(team)
         self.render('team_edit.html',
                     team=team,
-                    leaders=[u['email'] for u in self.get_leaders(team)],
-                    members=[u['email'] for u in self.get_members(team)])
+                    leaders=[u['email'] for u in await self.get_leaders(team)],
+                    members=[u['email'] for u in await self.get_members(team)])
 
     @tornado.web.authenticated
-    def post(self, name):
+    async def post(self, name):
         self.check_xsrf_cookie()
-        team = self.get_team(name)
+        team = await self.get_team(name)
         self.check_leader(team)
-        with TeamSaver(doc=team, rqh=self) as saver:
-            new_leaders = set()
-            for email in self.get_argument('leaders').split():
-                try:
-                    new_leaders.add(self.get_user(email)['email'])
-                except tornado.web.HTTPError:
-                    pass
-            saver['leaders'] = sorted(new_leaders)
-            saver['description'] = self.get_argument('description', '')
-            saver['status'] = self.get_argument('status', team['status'])
-            saver['public'] = utils.to_bool(self.get_argument(
-                    'public', team.get('public', False)))
-        old_members = set([r['value'] for r in self.db.view('user/team', key=name)])
-        new_members = set()
-        for email in self.get_argument('members').split():
-            try:
-                new_members.add(self.get_user(email)['email'])
-            except tornado.web.HTTPError:
-                pass
-        new_members.update(new_leaders)
-        for email in new_members.difference(old_members):
-            user = self.get_user(email)
-            if name not in user['teams']:
-                with UserSaver(doc=user, rqh=self) as saver:
-                    saver['teams'] = sorted(user['teams'] + [name])
-        for email in old_members.difference(new_members):
-            user = self.get_user(email)
-            if name in user['teams']:
-                with UserSaver(doc=user, rqh=self) as saver:
-                    teams = set(user['teams'])
-                    teams.discard(name)
-                    saver['teams'] = sorted(teams)
+        async with SaveBatch(rqh=self) as batch:
+            async with TeamSaver(doc=team, rqh=self, batch=batch) as saver:
+                # All pasted leaders and members are looked up in one pass;
+                # unknown names are skipped.
+                leaders = self.get_argument('leaders').split()
+                members = self.get_argument('members').split()
+                users = dict()
+                for user in await self.get_users(leaders + members):
+                    users[user['email']] = user
+                    if user.get('username'):
+                        users[user['username']] = user
+                new_leaders = set([users[n]['email'] for n in leaders
+                                   if n in users])
+                saver['leaders'] = sorted(new_leaders)
+                saver['description'] = self.get_argument('description', '')
+                saver['status'] = self.get_argument('status', team['status'])
+                saver['public'] = utils.to_bool(self.get_argument(
+                        'public', team.get('public', False)))
+            old_members = set(await self.get_team_member_emails(name))
+            new_members = set([users[n]['email'] for n in members
+                               if n in users])
+            new_members.update(new_leaders)
+            for email in new_members.difference(old_members):
+                user = await self.get_user(email)
+                if name not in user['teams']:
+                    async with UserSaver(doc=user, rqh=self,
+                                         batch=batch) as saver:
+                        saver['teams'] = sorted(user['teams'] + [name])
+            for user in await self.get_users(
+                    sorted(old_members.difference(new_members))):
+                if name in user['teams']:
+                    async with UserSaver(doc=user, rqh=self,
+                                         batch=batch) as saver:
+                        teams = set(user['teams'])
+                        teams.discard(name)
+                        saver['teams'] = sorted(teams)
+        batch.check_errors()
         self.redirect(self.reverse_url('team', team['name']))
 
 
@@ -158,9 +198,9 @@ class Teams(TeamMixin, RequestHandler):
     "Display all teams."
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         teams = [r['doc'] for r in
-                 self.db.view('team/name', include_docs=True)]
+                 await self.adb.view('team/name', include_docs=True)]
         for team in teams:
             team['is_member'] = self.is_member(team)
         self.render('teams.html', teams=teams)
@@ -170,14 +210,14 @@ class TeamJoin(RequestHandler):
     "The current user joins the team."
 
     @tornado.web.authenticated
-    def post(self, name):
+    async def post(self, name):
         self.check_xsrf_cookie()
         user = self.get_current_user()
         if name not in user['teams']:
-            team = self.get_team(name)
+            team = await self.get_team(name)
             if not team['public']:
                 raise tornado.web.HTTPError(403, 'this is not a public team')
-            with UserSaver(doc=user, rqh=self) as saver:
+            async with UserSaver(doc=user, rqh=self) as saver:
                 saver['teams'] = sorted(user['teams'] + [name])
         self.redirect(self.reverse_url('team', name))
 
@@ -186,19 +226,21 @@ class TeamLeave(RequestHandler):
     "The current user leaves the team."
 
     @tornado.web.authenticated
-    def post(self, name):
+    async def post(self, name):
         self.check_xsrf_cookie()
         user = self.get_current_user()
         if name in user['teams']:
-            team = self.get_team(name)
-            with TeamSaver(doc=team, rqh=self) as saver:
-                leaders = set(team['leaders'])
-                leaders.discard(user['email'])
-                saver['leaders'] = sorted(leaders)
-                with UserSaver(doc=user, rqh=self) as saver:
+            team = await self.get_team(name)
+            async with SaveBatch(rqh=self) as batch:
+                async with TeamSaver(doc=team, rqh=self, batch=batch) as saver:
+                    leaders = set(team['leaders'])
+                    leaders.discard(user['email'])
+                    saver['leaders'] = sorted(leaders)
+                async with UserSaver(doc=user, rqh=self, batch=batch) as saver:
                     teams = set(user['teams'])
                     teams.discard(name)
                     saver['teams'] = sorted(teams)
+            batch.check_errors()
         self.redirect(self.reverse_url('user', user['email']))
 
 
@@ -206,12 +248,12 @@ class TeamBlock(TeamMixin, RequestHandler):
     "Block a team."
 
     @tornado.web.authenticated
-    def post(self, name):
+    async def post(self, name):
         self.check_xsrf_cookie()
-        team = self.get_team(name)
+        team = await self.get_team(name)
         self.check_leader(team)
         if team['status'] != constants.BLOCKED:
-            with TeamSaver(doc=team, rqh=self) as saver:
+            async with TeamSaver(doc=team, rqh=self) as saver:
                 saver['status'] = constants.BLOCKED
         self.redirect(self.reverse_url('team', name))
 
@@ -220,11 +262,11 @@ class TeamUnblock(TeamMixin, RequestHandler):
     "Unblock a team."
 
     @tornado.web.authenticated
-    def post(self, name):
+    async def post(self, name):
         self.check_xsrf_cookie()
-        team = self.get_team(name)
+        team = await self.get_team(name)
         self.check_leader(team)
         if team['status'] != constants.ACTIVE:
-            with TeamSaver(doc=team, rqh=self) as saver:
+            async with TeamSaver(doc=team, rqh=self) as saver:
                 saver['status'] = constants.ACTIVE
         self.redirect(self.reverse_url('team', name))
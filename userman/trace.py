@@ -0,0 +1,149 @@
+""" Userman: Tracing of the database calls made while handling a request.
+
+When DB_TRACE is set, the coroutine database handle of each request is
+wrapped so that every call is recorded with its name, a summary of its
+arguments and its duration. The totals per call name are sent in the
+'Server-Timing' response header, and requests taking longer than
+DB_TRACE_SLOW milliseconds are logged with all their calls as JSON.
+When METRICS is set, the handle is wrapped for recording the metrics
+of the calls; the summaries of the arguments are then made only if
+DB_TRACE is also set. When neither is set, nothing is wrapped, and there
+is no cost.
+"""
+
+import json
+import time
+
+from . import metrics
+from . import asyncdb
+
+
+def get_summary(value, length=40):
+    "Return a short string summary of an argument value."
+    if isinstance(value, str):
+        result = value
+    else:
+        result = json.dumps(value, sort_keys=True)
+    if len(result) > length:
+        result = result[:length-3] + '...'
+    return result
+
+
+class Trace(object):
+    "The database calls made while handling a request."
+
+    def __init__(self):
+        self.calls = []         # (name, arguments summary, milliseconds)
+
+    def add(self, name, summary, start):
+        "Record the call, which started at the given perf_counter value."
+        self.calls.append((name, summary, 1000.0 * (time.perf_counter()-start)))
+
+    def get_totals(self):
+        "Return the number of calls and total milliseconds, per call name."
+        result = dict()
+        for name, summary, duration in self.calls:
+            count, total = result.get(name, (0, 0.0))
+            result[name] = (count + 1, total + duration)
+        return result
+
+    def get_server_timing(self):
+        "Return the value for the 'Server-Timing' header."
+        totals = self.get_totals()
+        items = ['db;dur={0:.1f};desc="{1} calls"'.format(
+            sum([t for c, t in totals.values()]), len(self.calls))]
+        for name, (count, total) in sorted(totals.items()):
+            items.append('db-{0};dur={1:.1f};desc="{2} calls"'.format(
+                name.replace('_', '-'), total, count))
+        return ', '.join(items)
+
+    def get_log(self, handler):
+        "Return the structured log record for the request, as JSON."
+        return json.dumps(dict(
+            method=handler.request.method,
+            uri=handler.request.uri,
+            status=handler.get_status(),
+            ms=round(1000.0 * handler.request.request_time(), 1),
+            db_calls=len(self.calls),
+            db_ms=round(sum([c[2] for c in self.calls]), 1),
+            calls=[dict(name=n, args=s, ms=round(d, 1))
+                   for n, s, d in self.calls]))
+
+
+class TracingDatabaseWrapper(asyncdb.AsyncDatabase):
+    """Coroutine interface recording each call of the wrapped handle
+    in the trace, if any, and in the metrics, if enabled."""
+
+    def __init__(self, adb, trace=None, metrics=False):
+        self.adb = adb
+        self.trace = trace
+        self.metrics = metrics
+
+    async def call(self, name, view, summary, func, *args, **kwargs):
+        """Call the function of the wrapped handle, and record it.
+        The view name is for the metrics, the summary for the trace."""
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            if self.trace is not None:
+                self.trace.add(name, summary, start)
+            if self.metrics:
+                metrics.observe_db(name, view, time.perf_counter() - start)
+
+    def __getitem__(self, doc_id):
+        return self.call('get', '', doc_id, self.adb.__getitem__, doc_id)
+
+    def get_rev(self, doc_id):
+        return self.call('get_rev', '', doc_id, self.adb.get_rev, doc_id)
+
+    def view(self, viewname, **options):
+        summary = None
+        if self.trace is not None:
+            summary = ' '.join([viewname] +
+                               ["{0}={1}".format(k, get_summary(v))
+                                for k, v in sorted(options.items())])
+        return self.call('view', viewname, summary,
+                         self.adb.view, viewname, **options)
+
+    def view_docs(self, viewname, keys):
+        summary = "{0} {1} keys".format(viewname, len(keys))
+        return self.call('view_docs', viewname, summary,
+                         self.adb.view_docs, viewname, keys)
+
+    def save(self, document):
+        return self.call('save', '', document.get('_id'),
+                         self.adb.save, document)
+
+    def bulk_save(self, documents):
+        summary = "{0} docs".format(len(documents))
+        return self.call('bulk_save', '', summary,
+                         self.adb.bulk_save, documents)
+
+    def delete(self, document):
+        return self.call('delete', '', document.get('_id'),
+                         self.adb.delete, document)
+
+    def get_attachment(self, doc_id, attachment_name):
+        summary = "{0}/{1}".format(doc_id, attachment_name)
+        return self.call('get_attachment', '', summary,
+                         self.adb.get_attachment, doc_id, attachment_name)
+
+    def put_attachment(self, doc_id, data, attachment_name, content_type, rev):
+        summary = "{0}/{1}".format(doc_id, attachment_name)
+        return self.call('put_attachment', '', summary,
+                         self.adb.put_attachment,
+                         doc_id, data, attachment_name, content_type, rev)
+
+    def all_docs(self):
+        return self.call('all_docs', '', '', self.adb.all_docs)
+
+    def changes(self, **options):
+        summary = None
+        if self.trace is not None:
+            summary = ' '.join(["{0}={1}".format(k, get_summary(v))
+                                for k, v in sorted(options.items())])
+        return self.call('changes', '', summary, self.adb.changes, **options)
+
+    def info(self):
+        return self.call('info', '', '', self.adb.info)
@@ -19,6 +19,7 @@ class UserSaver(DocumentSaver):
     def initialize(self):
         self['status'] = constants.PENDING
         self['services'] = []
+        self['services_granted'] = []
         self['teams'] = []
         self['created'] = utils.timestamp()
 
@@ -35,8 +36,7 @@ class UserSaver(DocumentSaver):
             raise ValueError("at-sign '@' not used correcly in email")
         if len(parts[1].split('.')) < 2:
             raise ValueError('invalid domain name part in email')
-        if len(list(self.db.view('user/email', key=value))) > 0:
-            raise KeyError("email already in use")
+        self.check_unique('user/email', value, 'email already in use')
 
     def check_username(self, value):
         """Raise ValueError if the given username has wrong format.
@@ -47,8 +47,21 @@ class UserSaver(DocumentSaver):
             raise ValueError("slash '/' disallowed in username")
         if '@' in value:
             raise ValueError("at-sign '@' disallowed in username")
-        if len(list(self.db.view('user/username', key=value))) > 0:
-            raise KeyError('username already in use')
+        self.check_unique('user/username', value, 'username already in use')
+
+    def finalize(self):
+        """Record in 'services_granted' the services the account has had
+        enabled while active, for reporting their removal to the services."""
+        if self.doc.get('status') == constants.ACTIVE:
+            granted = set(self.doc.get('services_granted', []))
+            if not granted.issuperset(self.doc.get('services', [])):
+                granted.update(self.doc['services'])
+                self['services_granted'] = sorted(granted)
+        super(UserSaver, self).finalize()
+
+    def revoke(self):
+        "Record the time the access was revoked, for the signed assertions."
+        self['revoked'] = utils.timestamp()
 
     def convert_email(self, value):
         "Convert email value to lower case."
@@ -84,40 +97,42 @@ class User(UserMixin, RequestHandler):
     "Display a user account."
 
     @tornado.web.authenticated
-    def get(self, email):
-        user = self.get_user(email)
+    async def get(self, email):
+        user = await self.get_user(email)
         self.check_access_user(user)
-        services = [self.get_service(n) for n in user['services']]
-        teams = [self.get_team(n) for n in user['teams']]
+        services = await self.get_services(user['services'])
+        teams = await self.get_teams(user['teams'])
+        logs, logs_next = await self.get_logs_page(user['_id'])
         self.render('user.html',
                     user=user,
                     services=services,
                     teams=teams,
-                    logs=self.get_logs(user['_id']))
+                    logs=logs,
+                    logs_next=logs_next)
 
 
 class UserEdit(UserMixin, RequestHandler):
     "Edit a user account."
 
     @tornado.web.authenticated
-    def get(self, email):
-        user = self.get_user(email)
+    async def get(self, email):
+        user = await self.get_user(email)
         self.check_access_user(user)
-        teams = [self.get_team(n) for n in user['teams']]
+        teams = await self.get_teams(user['teams'])
         leading = [t for t in teams if email in t['leaders']]
         self.render('user_edit.html',
                     user=user,
-                    services=self.get_all_services(),
+                    services=await self.get_all_services(),
                     teams=teams,
                     leading=leading,
                     countries=sorted([c.name for c in pycountry.countries]))
 
     @tornado.web.authenticated
-    def post(self, email):
+    async def post(self, email):
         self.check_xsrf_cookie()
-        user = self.get_user(email)
+        user = await self.get_user(email)
         self.check_access_user(user)
-        with UserSaver(doc=user, rqh=self) as saver:
+        async with UserSaver(doc=user, rqh=self) as saver:
             if self.is_admin():
                 role = self.get_argument('role', None)
                 if role in constants.ROLES:
@@ -134,10 +149,10 @@ class UserEdit(UserMixin, RequestHandler):
 class UserApproveMixin(object):
     "Mixin to factor out common approval code."
 
-    def approve_user(self, user):
+    async def approve_user(self, user):
         "Approve the given user."
         assert self.is_admin()
-        with UserSaver(doc=user, rqh=self) as saver:
+        async with UserSaver(doc=user, rqh=self) as saver:
             activation_code = utils.get_iuid()
             deadline = utils.timestamp(days=settings['ACTIVATION_PERIOD'])
             saver['activation'] = dict(code=activation_code, deadline=deadline)
@@ -146,7 +161,7 @@ class UserApproveMixin(object):
         url_with_params = self.get_absolute_url('user_activate',
                                                 email=user['email'],
                                                 activation_code=activation_code)
-        text = open(settings['ACTIVATION_EMAIL']).read().format(
+        text = utils.get_message(settings['ACTIVATION_EMAIL']).format(
             period=settings['ACTIVATION_PERIOD'],
             url=url,
             url_with_params=url_with_params,
@@ -169,11 +184,11 @@ class UserCreate(UserApproveMixin, RequestHandler):
         self.render('user_create.html',
                     countries=sorted([c.name for c in pycountry.countries]))
 
-    def post(self):
+    async def post(self):
         "Create the user account."
         self.check_xsrf_cookie()
         # Some fields initialized by UserSaver
-        with UserSaver(rqh=self) as saver:
+        async with UserSaver(rqh=self) as saver:
             saver['email'] = self.get_argument('email')
             saver['username'] = self.get_argument('username', None)
             saver['role'] = constants.USER
@@ -181,29 +196,30 @@ class UserCreate(UserApproveMixin, RequestHandler):
             saver['department'] = self.get_argument('department', None)
             saver['university'] = self.get_argument('university', None)
             saver['country'] = self.get_argument('country')
-            saver['services'] = [r['key'] for r in self.db.view('service/public')]
+            view_rows = await self.adb.view('service/public')
+            saver['services'] = [r['key'] for r in view_rows]
             user = saver.doc
         if self.is_admin(): # Activate immediately if admin creator is admin.
-            self.approve_user(user)
+            await self.approve_user(user)
         else:               # Require approval by admin if non-admin creator.
             text = "Review Userman account {email} for approval: {url}".format(
                 email=user['email'],
                 url=self.get_absolute_url('user', user['email']))
-            for admin in self.get_admins():
+            for admin in await self.get_admins():
                 self.send_email(admin,
                                 admin,
                                 'Review Userman account for approval',
                                 text)
-                url = self.reverse_url('user_acknowledge', user['email'])
-                self.redirect(url)
+            url = self.reverse_url('user_acknowledge', user['email'])
+            self.redirect(url)
 
 
 class UserAcknowledge(RequestHandler):
     """Acknowledge the creation of the user account.
     Explain what is going to happen."""
 
-    def get(self, name):
-        user = self.get_user(name)
+    async def get(self, name):
+        user = await self.get_user(name)
         if user['status'] != constants.PENDING:
             raise tornado.web.HTTPError(409, 'account not pending')
         self.render('user_acknowledge.html', user=user)
@@ -213,28 +229,29 @@ class UserApprove(UserApproveMixin, RequestHandler):
     "Approve a user account; email the activation code."
 
     @tornado.web.authenticated
-    def post(self, name):
+    async def post(self, name):
         self.check_xsrf_cookie()
         self.check_admin()
-        user = self.get_user(name)
+        user = await self.get_user(name)
         if user['status'] != constants.PENDING:
             raise tornado.web.HTTPError(409, 'account not pending')
-        self.approve_user(user)
+        await self.approve_user(user)
 
 
 class UserBlock(RequestHandler):
     "Block a user account."
 
     @tornado.web.authenticated
-    def post(self, name):
+    async def post(self, name):
         self.check_xsrf_cookie()
         self.check_admin()
-        user = self.get_user(name)
+        user = await self.get_user(name)
         if user['status'] != constants.BLOCKED:
             if user['role'] == constants.ADMIN:
                 raise tornado.web.HTTPError(409, 'cannot block admin account')
-            with UserSaver(doc=user, rqh=self) as saver:
+            async with UserSaver(doc=user, rqh=self) as saver:
                 saver['status'] = constants.BLOCKED
+                saver.revoke()
         self.redirect(self.reverse_url('user', user['email']))
 
 
@@ -242,12 +259,12 @@ class UserUnblock(RequestHandler):
     "Unblock a user account."
 
     @tornado.web.authenticated
-    def post(self, name):
+    async def post(self, name):
         self.check_xsrf_cookie()
         self.check_admin()
-        user = self.get_user(name)
+        user = await self.get_user(name)
         if user['status'] != constants.ACTIVE:
-            with UserSaver(doc=user, rqh=self) as saver:
+            async with UserSaver(doc=user, rqh=self) as saver:
                 saver['status'] = constants.ACTIVE
         self.redirect(self.reverse_url('user', user['email']))
 
@@ -260,7 +277,7 @@ class UserActivate(RequestHandler):
                     email=self.get_argument('email', ''),
                     activation_code=self.get_argument('activation_code', ''))
 
-    def post(self):
+    async def post(self):
         self.check_xsrf_cookie()
         email = self.get_argument('email', None)
         activation_code = self.get_argument('activation_code', None)
@@ -276,7 +293,7 @@ class UserActivate(RequestHandler):
                 raise ValueError('passwords do not match')
             message = 'no such user, or invalid or expired activation code'
             try:
-                user = self.get_user(email)
+                user = await self.get_user(email)
             except:
                 raise ValueError(message)
             activation = user.get('activation', dict())
@@ -284,7 +301,7 @@ class UserActivate(RequestHandler):
                 raise ValueError(message)
             if activation.get('deadline', '') < utils.timestamp():
                 raise ValueError(message)
-            with UserSaver(doc=user, rqh=self) as saver:
+            async with UserSaver(doc=user, rqh=self) as saver:
                 del saver['activation']
                 saver['password'] = password
                 saver['status'] = constants.ACTIVE
@@ -303,30 +320,31 @@ class UserReset(RequestHandler):
     def get(self):
         self.render('user_reset.html')
 
-    def post(self):
+    async def post(self):
         self.check_xsrf_cookie()
         try:
-            user = self.get_user(self.get_argument('email'))
+            user = await self.get_user(self.get_argument('email'))
             if user.get('status') not in (constants.APPROVED, constants.ACTIVE):
                 raise ValueError('account status not active')
-            with UserSaver(doc=user, rqh=self) as saver:
+            async with UserSaver(doc=user, rqh=self) as saver:
                 activation_code = utils.get_iuid()
                 deadline = utils.timestamp(days=settings['ACTIVATION_PERIOD'])
                 saver['activation'] = dict(code=activation_code, deadline=deadline)
                 saver['password'] = utils.get_iuid()
                 saver['status'] = constants.APPROVED
+                saver.revoke()
             url = self.get_absolute_url('user_activate')
             url_with_params = self.get_absolute_url('user_activate',
                                                     email=user['email'],
                                                     activation_code=activation_code)
-            text = open(settings['RESET_EMAIL']).read().format(
+            text = utils.get_message(settings['RESET_EMAIL']).format(
                 period=settings['ACTIVATION_PERIOD'],
                 url=url,
                 url_with_params=url_with_params,
                 email=user['email'],
                 activation_code=activation_code)
             self.send_email(user,
-                            self.get_admins()[0], # Arbitrarily the first admin
+                            (await self.get_admins())[0], # Arbitrarily the first admin
                             'Userman account password reset',
                             text)
         except (tornado.web.HTTPError, ValueError) as msg:
@@ -334,31 +352,103 @@ class UserReset(RequestHandler):
         self.redirect(self.reverse_url('home'))
 
 
-class Users(RequestHandler):
+class UsersMixin(object):
+    """List user accounts, in pages or streamed.
+    All accounts are listed by email. The accounts of a given status
+    are listed by modification timestamp, oldest first, unless the
+    argument 'prefix' is given, which selects the accounts with emails
+    beginning with it, listed by email.
+    The argument 'from' gives the first account of the page: its email,
+    or its cursor when listed by modification timestamp.
+    If the argument 'stream' is true, all selected accounts are listed,
+    and the rows are sent as they are fetched."""
+
+    STREAM_MARKER = b'<!-- users rows -->'
+
+    async def render_users(self, template, status=None):
+        prefix = self.get_argument('prefix', '')
+        start = self.get_argument('from', '')
+        options = dict(include_docs=True, limit=settings['PAGE_SIZE'] + 1)
+        if status is None:
+            viewname = 'user/email'
+            options['start_key'] = start or prefix
+            options['end_key'] = prefix + constants.HIGH_CHAR
+        elif prefix:
+            viewname = 'user/status_email'
+            options['start_key'] = [status, start or prefix]
+            options['end_key'] = [status, prefix + constants.HIGH_CHAR]
+        else:
+            viewname = 'user/status_modified'
+            options['start_key'] = [status]
+            options['end_key'] = [status, {}]
+            if start:
+                try:
+                    modified, iuid = utils.parse_log_cursor(start)
+                except ValueError:
+                    raise tornado.web.HTTPError(400, reason='invalid from')
+                options['start_key'] = [status, modified]
+                options['start_key_doc_id'] = iuid
+        if utils.to_bool(self.get_argument('stream', False)):
+            await self.stream_users(template, viewname, options, prefix)
+            return
+        view_rows = await self.adb.view(viewname, **options)
+        if len(view_rows) > settings['PAGE_SIZE']:
+            row = view_rows.pop()
+            if viewname == 'user/status_modified':
+                users_next = "{0},{1}".format(row['key'][1], row['id'])
+            else:
+                users_next = row['doc']['email']
+        else:
+            users_next = None
+        self.render(template,
+                    users=[r['doc'] for r in view_rows],
+                    prefix=prefix,
+                    users_next=users_next)
+
+    async def stream_users(self, template, viewname, options, prefix):
+        "Send the page in parts, with the rows for each chunk of accounts."
+        html = self.render_string(template,
+                                  users=None,
+                                  prefix=prefix,
+                                  users_next=None)
+        head, tail = html.split(self.STREAM_MARKER)
+        self.write(head)
+        await self.flush()
+        while True:
+            view_rows = await self.adb.view(viewname, **options)
+            if view_rows:
+                self.write(self.render_string('users_rows.html',
+                                              users=[r['doc'] for r in view_rows]))
+                await self.flush()
+            if len(view_rows) < options['limit']: break
+            options['start_key'] = view_rows[-1]['key']
+            options['start_key_doc_id'] = view_rows[-1]['id']
+            options['skip'] = 1
+        self.write(tail)
+
+
+class Users(UsersMixin, RequestHandler):
     "List of all user accounts."
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         self.check_admin()
-        users = [r['doc'] for r in self.db.view('user/email', include_docs=True)]
-        self.render('users.html', users=users)
+        await self.render_users('users.html')
 
 
-class UsersPending(RequestHandler):
+class UsersPending(UsersMixin, RequestHandler):
     "List of pending user accounts."
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         self.check_admin()
-        users = [r['doc'] for r in self.db.view('user/pending', include_docs=True)]
-        self.render('users_pending.html', users=users)
+        await self.render_users('users_pending.html', status=constants.PENDING)
 
 
-class UsersBlocked(RequestHandler):
+class UsersBlocked(UsersMixin, RequestHandler):
     "List of blocked user accounts."
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         self.check_admin()
-        users = [r['doc'] for r in self.db.view('user/blocked', include_docs=True)]
-        self.render('users_blocked.html', users=users)
+        await self.render_users('users_blocked.html', status=constants.BLOCKED)
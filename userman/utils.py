@@ -1,8 +1,14 @@
 " Userman: Various utility functions. "
 
 import os
+import copy
+import json
+import time
 import socket
 import logging
+import functools
+import threading
+import collections
 import urllib.parse
 import uuid
 import hashlib
@@ -11,25 +17,169 @@ import unicodedata
 
 from ibmcloudant import CouchDbSessionAuthenticator, cloudant_v1
 import ibm_cloud_sdk_core
+from ibm_cloud_sdk_core.http_adapter import SSLHTTPAdapter
 import yaml
 
 from userman import constants
 from userman import settings
+from userman import logsink
+from userman import memorydb
+
+class LruCache(object):
+    """Bounded LRU cache of values by key, with time-to-live, shared
+    between requests and threads. An entry is dropped when older than
+    the time-to-live, or when the number of entries, or the approximate
+    total size of the values as JSON if 'max_bytes' is given, exceeds
+    the limits. The values are stored as given; callers copy if needed."""
+
+    def __init__(self, max_count, ttl, max_bytes=None):
+        self.max_count = max_count
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # key -> (value, size, time)
+        self.bytes = 0
+        self.counters = dict(hits=0, misses=0, evictions=0, invalidations=0)
+
+    def get(self, key):
+        "Return the value for the key, or None if none or expired."
+        with self.lock:
+            try:
+                value, size, created = self.entries[key]
+            except KeyError:
+                self.counters['misses'] += 1
+                return None
+            if time.time() - created > self.ttl:
+                self.pop(key)
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return value
+
+    def put(self, key, value):
+        "Store the value for the key, evicting the least recently used."
+        size = len(json.dumps(value)) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes: return
+        with self.lock:
+            self.pop(key)
+            self.entries[key] = (value, size, time.time())
+            self.bytes += size
+            while len(self.entries) > self.max_count or \
+                  (self.max_bytes and self.bytes > self.max_bytes):
+                self.pop(next(iter(self.entries)))
+                self.counters['evictions'] += 1
+
+    def remove(self, key):
+        "Remove the entry for the key, if any."
+        with self.lock:
+            if self.pop(key):
+                self.counters['invalidations'] += 1
+
+    def remove_if(self, predicate):
+        "Remove the entries for which predicate(value) is true."
+        with self.lock:
+            for key in [k for k, e in self.entries.items() if predicate(e[0])]:
+                self.pop(key)
+                self.counters['invalidations'] += 1
+
+    def pop(self, key):
+        "Remove the entry; return True if there was one. Lock must be held."
+        try:
+            value, size, created = self.entries.pop(key)
+        except KeyError:
+            return False
+        self.bytes -= size
+        return True
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def get_counters(self):
+        "Return the counters, the current size and the hit ratio."
+        with self.lock:
+            result = dict(self.counters)
+            result['entries'] = len(self.entries)
+            if self.max_bytes:
+                result['bytes'] = self.bytes
+        total = result['hits'] + result['misses']
+        result['hit_ratio'] = round(result['hits'] / total, 3) if total else 0.0
+        return result
+
+
+class DocumentCache(LruCache):
+    """LRU cache of documents by id, shared between requests and threads.
+    Entries are revalidated against the database using their '_rev', so
+    a hit still costs a request; it saves the transfer of the body only.
+    The revalidations are counted as 'unchanged' or 'changed'.
+    Only the doctypes read back by id are cached; not log entries."""
+
+    doctypes = (constants.USER, constants.TEAM, constants.SERVICE)
+
+    def __init__(self, max_count, max_bytes, ttl):
+        super(DocumentCache, self).__init__(max_count, ttl, max_bytes=max_bytes)
+        self.counters.update(unchanged=0, changed=0)
+
+    def get(self, doc_id):
+        "Return a copy of the cached document, or None if none or expired."
+        doc = super(DocumentCache, self).get(doc_id)
+        if doc is None: return None
+        return copy.deepcopy(doc)
+
+    def put(self, doc):
+        """Store a copy of the document, evicting the least recently used.
+        A document of a doctype not cached is ignored."""
+        if doc.get(constants.DB_DOCTYPE) not in self.doctypes: return
+        super(DocumentCache, self).put(doc['_id'], copy.deepcopy(doc))
+
 
 class CloudantDatabaseWrapper:
     # Wrap a CloudantV1 client to provide a minimal CouchDB-like database interface.
-    def __init__(self, client, db_name):
+    def __init__(self, client, db_name, cache=None):
         self.client = client
         self.db_name = db_name
+        self.cache = cache
     
     def __getitem__(self, doc_id):
-        """Mimics db['doc_id']"""
-        response = self.client.get_document(
-            db=self.db_name,
-            doc_id=doc_id
-        ).get_result()
+        """Mimics db['doc_id']
+        A cached document is revalidated by its revision; unchanged if 304."""
+        if self.cache is None:
+            return self.client.get_document(
+                db=self.db_name,
+                doc_id=doc_id
+            ).get_result()
+        cached = self.cache.get(doc_id)
+        if cached is None:
+            response = self.client.get_document(
+                db=self.db_name,
+                doc_id=doc_id
+            ).get_result()
+        else:
+            try:
+                response = self.client.get_document(
+                    db=self.db_name,
+                    doc_id=doc_id,
+                    if_none_match='"{0}"'.format(cached['_rev'])
+                ).get_result()
+            except ibm_cloud_sdk_core.api_exception.ApiException as error:
+                if error.code == 304:
+                    self.cache.count('unchanged')
+                    return cached
+                self.cache.remove(doc_id)
+                raise
+            self.cache.count('changed')
+        self.cache.put(response)
         return response
     
+    def get_rev(self, doc_id):
+        """Return the current revision of the document, without its body."""
+        response = self.client.head_document(
+            db=self.db_name,
+            doc_id=doc_id
+        )
+        return response.get_headers()['ETag'].strip('"')
+
     def __iter__(self):
         """Make the database wrapper iterable by document IDs"""
         try:
@@ -56,6 +206,12 @@ class CloudantDatabaseWrapper:
         ).get_result()
         return response.get('rows', [])
     
+    def view_docs(self, viewname, keys):
+        """Return the documents for the given keys in the view, in one
+        multi-key request, as a dict keyed by view key. Missing keys are absent."""
+        rows = self.view(viewname, keys=list(keys), include_docs=True)
+        return get_view_docs(rows)
+
     def save(self, document):
         """Mimics db.save(doc)"""
         if '_id' in document:
@@ -68,12 +224,30 @@ class CloudantDatabaseWrapper:
             doc_id=doc_id,
             document=document
         ).get_result()
+        document['_rev'] = response['rev']
+        if self.cache is not None:
+            self.cache.put(document)
         return response
     
+    def bulk_save(self, documents):
+        """Save the documents in one '_bulk_docs' request.
+        Return the list of results, in the same order as the documents;
+        each has 'id', and either 'rev', or 'error' and 'reason'."""
+        for document in documents:
+            if '_id' not in document:
+                document['_id'] = uuid.uuid4().hex
+        response = self.client.post_bulk_docs(
+            db=self.db_name,
+            bulk_docs=dict(docs=documents)
+        ).get_result()
+        return set_bulk_saved(documents, response, self.cache)
+    
     def delete(self, document):
         """Mimics db.delete(doc)"""
         if '_id' not in document or '_rev' not in document:
             raise ValueError("Document must have '_id' and '_rev' to be deleted")
+        if self.cache is not None:
+            self.cache.remove(document['_id'])
         response = self.client.delete_document(
             db=self.db_name,
             doc_id=document['_id'],
@@ -81,6 +255,22 @@ class CloudantDatabaseWrapper:
         ).get_result()
         return response
 
+    def changes(self, **options):
+        """Return the changes feed result; a dict with 'results' and 'last_seq'.
+        The options are those of the CouchDB '_changes' request."""
+        response = self.client.post_changes(
+            db=self.db_name,
+            **options
+        ).get_result()
+        return response
+
+    def info(self):
+        """Return the database information, such as 'update_seq'."""
+        response = self.client.get_database_information(
+            db=self.db_name
+        ).get_result()
+        return response
+
     def get_attachment(self, doc_id, attachment_name):
         """Get an attachment from a document."""
         response = self.client.get_attachment(
@@ -157,12 +347,20 @@ def load_settings(filepath=None):
             raise ValueError("setting '{0}' has invalid value".format(key))
     if len(settings['COOKIE_SECRET']) < 10:
         raise ValueError('setting COOKIE_SECRET too short')
+    if settings.get('NOTIFY') and not settings.get('NOTIFY_SECRET'):
+        raise ValueError('setting NOTIFY_SECRET required for NOTIFY')
     # Prepend source code base dir to relative filepaths
     for key in ['ACTIVATION_EMAIL', 'RESET_EMAIL']:
         if not os.path.isabs(settings[key]):
             settings[key] = os.path.join(basedir, settings[key])
     # Settings computable from others
-    settings['DB_SERVER_VERSION'] = get_couchdb_client().get_server_information().get_result().get("version")
+    if settings['DB_BACKEND'] == 'memory':
+        problems = memorydb.check_views()
+        if problems:
+            raise ValueError('in-memory database views: ' + '; '.join(problems))
+        settings['DB_SERVER_VERSION'] = 'memory'
+    else:
+        settings['DB_SERVER_VERSION'] = get_couchdb_client().get_server_information().get_result().get("version")
     if 'PORT' not in settings:
         parts = urllib.parse.urlparse(settings['BASE_URL'])
         items = parts.netloc.split(':')
@@ -175,23 +373,109 @@ def load_settings(filepath=None):
         else:
             raise ValueError('could not determine port from BASE_URL')
 
+# The process-wide CouchDB client, shared by all requests and threads.
+# It is created on first use, and again if the process has been forked.
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_client_counters = dict(handles=0, token_requests=0, auth_retries=0)
+
+def _create_couchdb_client():
+    """Create a CouchDB client with a keep-alive connection pool.
+    The session cookie is obtained on the first request, and renewed only
+    when it expires, or when the server has invalidated it."""
+    authenticator = CouchDbSessionAuthenticator(settings.get("DB_USERNAME"),
+                                                settings.get("DB_PASSWORD"))
+    cloudant = cloudant_v1.CloudantV1(authenticator=authenticator)
+    cloudant.set_service_url(settings.get("DB_SERVER"))
+    cloudant.set_http_config(
+        dict(timeout=(settings['DB_CONNECT_TIMEOUT'],
+                      settings['DB_READ_TIMEOUT'])))
+    cloudant.http_adapter = SSLHTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=settings['DB_POOL_SIZE'],
+        _disable_ssl_verification=cloudant.disable_ssl_verification)
+    cloudant.http_client.mount('http://', cloudant.http_adapter)
+    cloudant.http_client.mount('https://', cloudant.http_adapter)
+    token_manager = authenticator.token_manager
+    request_token = token_manager.request_token
+    def counting_request_token():
+        with _client_lock:
+            _client_counters['token_requests'] += 1
+        return request_token()
+    token_manager.request_token = counting_request_token
+    def expire_session(response, *args, **kwargs):
+        # Session invalidated by the server; login again on next request.
+        if response.status_code == 401:
+            with _client_lock:
+                _client_counters['auth_retries'] += 1
+            token_manager.expire_time = 0
+    cloudant.http_client.hooks['response'].append(expire_session)
+    return cloudant
+
 def get_couchdb_client():
-    "Return the handle for the CouchDB server."
-    try:
-        cloudant = cloudant_v1.CloudantV1(
-            authenticator=CouchDbSessionAuthenticator(
-                settings.get("DB_USERNAME"), settings.get("DB_PASSWORD")
-            )
-        )
-        cloudant.set_service_url(settings.get("DB_SERVER"))
-        return cloudant
-    except Exception as e:
-        raise KeyError("Could not connect to CouchDB server: %s" % str(e))
+    "Return the handle for the CouchDB server; shared within the process."
+    global _client, _client_pid
+    with _client_lock:
+        _client_counters['handles'] += 1
+        if _client is None or _client_pid != os.getpid():
+            try:
+                _client = _create_couchdb_client()
+            except Exception as e:
+                raise KeyError("Could not connect to CouchDB server: %s" % str(e))
+            _client_pid = os.getpid()
+        return _client
+
+def get_couchdb_client_counters():
+    """Return the counters for the shared CouchDB client: the number of
+    handles given out, session token requests, sessions expired by the
+    server, connections and requests made, and the number of logins and
+    connections avoided by reusing the client. Without it, each handle
+    would have required a login; token refreshes and sessions expired by
+    the server are included in the token requests."""
+    with _client_lock:
+        result = dict(_client_counters)
+        client = _client
+    connections = requests = 0
+    if client is not None:
+        pools = client.http_adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None: continue
+            connections += pool.num_connections
+            requests += pool.num_requests
+    result['connections'] = connections
+    result['requests'] = requests
+    result['logins_avoided'] = max(0, result['handles'] -
+                                   result['token_requests'])
+    result['connections_avoided'] = max(0, requests - connections)
+    return result
+
+# The process-wide document caches, one per database name.
+_document_caches = dict()
+
+def get_document_cache(db_name):
+    "Return the document cache for the database, or None if disabled."
+    if not settings['DOC_CACHE_SIZE']: return None
+    with _client_lock:
+        try:
+            return _document_caches[db_name]
+        except KeyError:
+            cache = DocumentCache(settings['DOC_CACHE_SIZE'],
+                                  settings['DOC_CACHE_BYTES'],
+                                  settings['DOC_CACHE_TTL'])
+            _document_caches[db_name] = cache
+            return cache
 
 def get_db():
-    "Return the handle for the CouchDB database."
+    """Return the handle for the CouchDB database.
+    For DB_BACKEND 'memory', it is the process-wide in-memory database."""
+    if settings['DB_BACKEND'] == 'memory':
+        return memorydb.get_database(settings['DB_DATABASE'])
     try:
-        return CloudantDatabaseWrapper(get_couchdb_client(), settings['DB_DATABASE'])
+        return CloudantDatabaseWrapper(get_couchdb_client(),
+                                       settings['DB_DATABASE'],
+                                       cache=get_document_cache(settings['DB_DATABASE']))
     except ibm_cloud_sdk_core.api_exception.ApiException:
         raise KeyError("CouchDB database '%s' does not exist" %
                        settings['DB_DATABASE'])
@@ -210,6 +494,31 @@ def get_user_doc(db, name):
         raise ValueError("no such user account '{0}'".format(name))
     return result[0]['doc']
 
+def set_bulk_saved(documents, results, cache=None):
+    """Set the new '_rev' of each document successfully saved in bulk,
+    and write it through to the cache, if any. Return the results."""
+    for document, result in zip(documents, results):
+        if result.get('error') or not result.get('rev'): continue
+        document['_rev'] = result['rev']
+        if cache is not None:
+            cache.put(document)
+    return results
+
+def get_view_docs(rows):
+    """Return the documents in the view rows as a dict keyed by view key.
+    If a key occurs more than once, the first document is used."""
+    result = dict()
+    for row in rows:
+        if row.get('doc') is None: continue
+        result.setdefault(row['key'], row['doc'])
+    return result
+
+@functools.lru_cache(maxsize=None)
+def get_message(filepath):
+    "Return the text of the email message template file; read only once."
+    with open(filepath) as infile:
+        return infile.read()
+
 def get_iuid():
     "Return a unique instance identifier."
     return uuid.uuid4().hex
@@ -223,6 +532,13 @@ def timestamp(days=None):
     instant = instant.isoformat()
     return instant[:-9] + "%06.3f" % float(instant[-9:]) + "Z"
 
+def timestamp_before(value, seconds):
+    """Return the timestamp the given number of seconds before the value.
+    Raise ValueError if the value is not in the format of 'timestamp'."""
+    instant = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
+    instant -= datetime.timedelta(seconds=seconds)
+    return instant.isoformat(timespec='milliseconds') + 'Z'
+
 def to_ascii(value):
     "Convert any non-ASCII character to its closest equivalent."
     if not isinstance(value, str):
@@ -232,6 +548,7 @@ def to_ascii(value):
 def to_bool(value):
     " Convert the value into a boolean, interpreting various string values."
     if not value: return False
+    if isinstance(value, bool): return value
     value = value.lower()
     return value in ['true', 'yes'] or value[0] in ['t', 'y']
 
@@ -246,8 +563,8 @@ def hashed_password(password):
     m.update(password.encode('utf-8'))
     return m.hexdigest()
 
-def log(db, doc, changed={}, deleted={}, current_user=None):
-    "Create a log entry for the given document."
+def get_log_entry(doc, changed={}, deleted={}, current_user=None):
+    "Return a new log entry for the given document."
     entry = dict(_id=get_iuid(),
                  doc=doc['_id'],
                  doctype=doc[constants.DB_DOCTYPE],
@@ -260,7 +577,26 @@ def log(db, doc, changed={}, deleted={}, current_user=None):
             entry['operator'] = current_user['email']
     except KeyError:
         pass
-    db.save(entry)
+    return entry
+
+def log(db, doc, changed={}, deleted={}, current_user=None):
+    """Create a log entry for the given document.
+    It is queued for writing if the write-behind log sink is running."""
+    entry = get_log_entry(doc,
+                          changed=changed,
+                          deleted=deleted,
+                          current_user=current_user)
+    if not logsink.add(entry):
+        db.save(entry)
+
+def get_log_cursor(log):
+    "Return the cursor for a page of logs beginning with the given entry."
+    return "{0},{1}".format(log['timestamp'], log['_id'])
+
+def parse_log_cursor(cursor):
+    "Return the timestamp and doc id of the cursor; raise ValueError if bad."
+    timestamp, iuid = cursor.split(',')
+    return timestamp, iuid
 
 def cmp_modified(i, j):
     "Compare the two documents by their 'modified' values."
@@ -297,16 +633,33 @@ class BasePatch(object):
         "Is the relevant document relevant for patch?"
         return constants.DB_DOCTYPE in doc
 
-    def patch_all(self):
+    def patch_all(self, batch_size=100):
         """Run through all documents and patch the relevant ones.
+        The patched documents are saved in bulk, batch_size at a time.
         Return the number of documents patched."""
         count = 0
+        patched = []
         for key in self.db:
             doc = self.db[key]
             if self.is_relevant(doc):
                 if self.patch_doc(doc):
-                    self.db.save(doc)
-                    count += 1
+                    patched.append(doc)
+                    if len(patched) >= batch_size:
+                        count += self.save_patched(patched)
+                        patched = []
+        if patched:
+            count += self.save_patched(patched)
+        return count
+
+    def save_patched(self, docs):
+        "Save the patched documents in bulk. Return the number saved."
+        count = 0
+        for result in self.db.bulk_save(docs):
+            if result.get('error'):
+                logging.warning("patch of %s failed: %s %s", result.get('id'),
+                                result['error'], result.get('reason'))
+            else:
+                count += 1
         return count
 
     def patch_doc(self, doc):
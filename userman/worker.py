@@ -0,0 +1,44 @@
+""" Userman: Process-wide background workers.
+
+A worker is an object whose 'start' method loads its state and starts
+its daemon threads using 'start_thread'. Each worker module keeps its
+single instance in a 'Singleton', and provides thin functions to start
+and get it; these return None for a worker not started in this process.
+"""
+
+import threading
+
+
+def start_thread(target, name):
+    "Start a daemon thread running the target. Return the thread."
+    thread = threading.Thread(target=target, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+class Singleton(object):
+    "Holder of the process-wide instance of a worker."
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.instance = None
+
+    def start(self, factory):
+        "Create the instance by calling the factory, start it, and return it."
+        with self.lock:
+            instance = factory()
+            instance.start()
+            self.instance = instance
+            return instance
+
+    def get(self, factory=None):
+        """Return the instance, or None if not started.
+        If a factory is given, the instance is created and started
+        on the first call, if not already done."""
+        if self.instance is None and factory is not None:
+            with self.lock:
+                if self.instance is None:
+                    instance = factory()
+                    instance.start()
+                    self.instance = instance
+        return self.instance